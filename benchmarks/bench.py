@@ -0,0 +1,337 @@
+"""
+离线压测：生成合成 fixture，以不同并发度调用 /call，输出吞吐量、延迟分位数与峰值 RSS
+
+    python -m benchmarks.bench --concurrency 1,8,32 --requests 200 --out benchmarks/results/run.json
+    python -m benchmarks.bench --compare benchmarks/results/base.json benchmarks/results/run.json
+
+未指定 --url 时在随机端口启动一个本地服务（关闭限流），结束后自动停止
+带结果缓存的场景默认每次请求在 fixture 末尾追加随机字节，测量的是未命中缓存的耗时；加 --cached 则上传相同内容，测量缓存命中
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional
+
+import requests
+
+from benchmarks.fixtures import PYC_VERSIONS, ListenerFarm, write_fixtures
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Scenario(NamedTuple):
+    name: str
+    plugin: str
+    method: str
+    args: dict
+    fixture: Optional[str] = None
+    # the plugin caches results by upload hash, each request gets a random tail unless --cached
+    cached: bool = False
+
+
+def build_scenarios(fixtures: Dict[str, str], zip_entries: List[int], farm: ListenerFarm) -> List[Scenario]:
+    scenarios = [Scenario('releasenote.releases', 'releasenote', 'releases', {})]
+    for entries in zip_entries:
+        scenarios.append(Scenario(f'ziputil.pseudo_check[{entries}]', 'ziputil', 'pseudo_check', {},
+                                  f'zip-{entries}-pseudo'))
+        scenarios.append(Scenario(f'ziputil.convert_to_pseudo[{entries}]', 'ziputil', 'convert_to_pseudo', {},
+                                  f'zip-{entries}'))
+    for major, minor in PYC_VERSIONS:
+        scenarios.append(Scenario(f'pycdecompile.decompile[{major}.{minor}]', 'pycdecompile', 'decompile', {},
+                                  f'pyc-{major}.{minor}', cached=True))
+    scenarios.append(Scenario('binwalker.scan', 'binwalker', 'scan', {}, 'firmware', cached=True))
+    scenarios.append(Scenario('binwalker.scan[signature]', 'binwalker', 'scan', {'extract': False}, 'firmware',
+                              cached=True))
+    scenarios.append(Scenario('binwalker.scan_stream', 'binwalker', 'scan_stream', {}, 'firmware'))
+    scenarios.append(Scenario('portscan.scan', 'portscan', 'scan',
+                              {'host': farm.host, 'ports': farm.port_spec(closed=64)}))
+    return [scenario for scenario in scenarios if scenario.fixture is None or scenario.fixture in fixtures]
+
+
+def process_tree_rss(pid: int) -> Optional[int]:
+    """
+    进程及其所有子进程的 RSS 字节数（仅 Linux）
+    """
+    if not os.path.isdir('/proc'):
+        return None
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                # the command name may contain spaces, fields after it are fixed
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f'/proc/{current}/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class RssSampler:
+    def __init__(self, pid: Optional[int], interval: float = 0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        while not self.stopped.is_set():
+            rss = process_tree_rss(self.pid)
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        if self.pid is not None:
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))
+    return round(ordered[index], 6)
+
+
+def run_scenario(base_url: str, scenario: Scenario, fixtures: Dict[str, str], concurrency: int, total: int,
+                 server_pid: Optional[int], cached: bool = False) -> dict:
+    local = threading.local()
+    content = None
+    if scenario.fixture is not None:
+        with open(fixtures[scenario.fixture], 'rb') as f:
+            content = f.read()
+    unique = scenario.cached and not cached
+
+    def call():
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        data = {'args': json.dumps(scenario.args)}
+        body = content + os.urandom(16) if unique and content is not None else content
+        files = {'file': (os.path.basename(fixtures[scenario.fixture]), body)} if body is not None else None
+        t1 = time.perf_counter()
+        try:
+            response = local.session.post(f'{base_url}/call/{scenario.plugin}', params={'method': scenario.method},
+                                          data=data, files=files, timeout=300)
+            # read the whole body so streamed downloads are part of the latency
+            _ = response.content
+            code = response.status_code
+        except requests.RequestException:
+            code = 0
+        return code, time.perf_counter() - t1
+
+    with RssSampler(server_pid) as sampler:
+        t1 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(lambda _: call(), range(total)))
+        elapsed = time.perf_counter() - t1
+    latencies = [latency for code, latency in results if code == 200]
+    status_codes = {}
+    for code, _ in results:
+        status_codes[str(code)] = status_codes.get(str(code), 0) + 1
+    return {
+        'name': scenario.name,
+        'plugin': scenario.plugin,
+        'method': scenario.method,
+        'concurrency': concurrency,
+        'requests': total,
+        'cached': scenario.cached and cached,
+        'ok': len(latencies),
+        'errors': total - len(latencies),
+        'status_codes': status_codes,
+        'elapsed': round(elapsed, 6),
+        'throughput': round(len(latencies) / elapsed, 3) if elapsed else None,
+        'latency': {
+            'mean': round(statistics.fmean(latencies), 6) if latencies else None,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': round(max(latencies), 6) if latencies else None
+        },
+        'peak_rss': sampler.peak
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workers: int, timeout: float):
+    port = free_port()
+    env = dict(os.environ, WORKERS=str(workers), RATE_LIMIT='off')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(port),
+         '--workers', str(workers), '--log-level', 'warning'],
+        cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'server exited with code {process.returncode}')
+        try:
+            if requests.get(f'{base_url}/status', timeout=1).ok:
+                return process, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('server did not become ready in time')
+
+
+def wait_for_plugins(base_url: str, timeout: float) -> set:
+    # plugins load in the background after the server starts accepting requests
+    deadline = time.time() + timeout
+    while True:
+        futures = requests.get(f'{base_url}/available-futures').json()
+        if not futures.get('loading') or time.time() > deadline:
+            return {plugin['name'] for plugin in futures['plugins']}
+        time.sleep(0.5)
+
+
+def run(options) -> dict:
+    server = None
+    base_url = options.url.rstrip('/') if options.url else None
+    farm = ListenerFarm(count=options.listeners).start()
+    fixture_dir = options.fixture_dir or tempfile.mkdtemp(prefix='ctfever-bench-')
+    try:
+        fixtures = write_fixtures(fixture_dir, options.zip_entries, options.firmware_size)
+        if base_url is None:
+            server, base_url = start_server(options.workers, options.startup_timeout)
+        available = wait_for_plugins(base_url, options.startup_timeout)
+        results, skipped = [], []
+        for scenario in build_scenarios(fixtures, options.zip_entries, farm):
+            if options.only and not any(pattern in scenario.name for pattern in options.only):
+                continue
+            if scenario.plugin not in available:
+                skipped.append(scenario.name)
+                continue
+            for concurrency in options.concurrency:
+                result = run_scenario(base_url, scenario, fixtures, concurrency, options.requests,
+                                      server.pid if server else None, options.cached)
+                print(f'{result["name"]:<40} c={concurrency:<4} {result["throughput"]} req/s  '
+                      f'p50={result["latency"]["p50"]} p95={result["latency"]["p95"]} '
+                      f'p99={result["latency"]["p99"]} errors={result["errors"]}', file=sys.stderr)
+                results.append(result)
+        return {
+            'meta': {
+                'created': time.time(),
+                'revision': git_revision(),
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'url': options.url,
+                'workers': None if options.url else options.workers,
+                'requests': options.requests,
+                'concurrency': options.concurrency,
+                'cached': options.cached
+            },
+            'skipped': skipped,
+            'scenarios': results
+        }
+    finally:
+        farm.stop()
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(base_path: str, head_path: str, threshold: float) -> int:
+    """
+    对比两次结果，吞吐量下降或 p95 上升超过 threshold 时返回 1
+    """
+    with open(base_path, 'r', encoding='utf-8') as f:
+        base = {(s['name'], s['concurrency']): s for s in json.load(f)['scenarios']}
+    with open(head_path, 'r', encoding='utf-8') as f:
+        head = {(s['name'], s['concurrency']): s for s in json.load(f)['scenarios']}
+    regressed = False
+    for key in sorted(base.keys() & head.keys()):
+        before, after = base[key], head[key]
+        if not before['throughput'] or not after['throughput'] or not before['latency']['p95']:
+            continue
+        throughput = after['throughput'] / before['throughput'] - 1
+        p95 = after['latency']['p95'] / before['latency']['p95'] - 1
+        flag = throughput < -threshold or p95 > threshold
+        regressed = regressed or flag
+        print(f'{"!" if flag else " "} {key[0]:<40} c={key[1]:<4} throughput {throughput:+.1%}  p95 {p95:+.1%}')
+    return 1 if regressed else 0
+
+
+def int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(',') if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='CTFever plugin benchmark')
+    parser.add_argument('--url', help='benchmark a running server instead of starting one')
+    parser.add_argument('--workers', type=int, default=1, help='workers of the local server')
+    parser.add_argument('--concurrency', type=int_list, default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=100, help='requests per scenario and concurrency level')
+    parser.add_argument('--zip-entries', type=int_list, default=[10, 1000, 20000])
+    parser.add_argument('--firmware-size', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--listeners', type=int, default=32, help='local TCP listeners for portscan')
+    parser.add_argument('--only', action='append', help='run scenarios whose name contains this, repeatable')
+    parser.add_argument('--cached', action='store_true',
+                        help='upload identical content so cached scenarios measure cache hits')
+    parser.add_argument('--fixture-dir', help='keep generated fixtures in this directory')
+    parser.add_argument('--startup-timeout', type=float, default=300)
+    parser.add_argument('--out', default=os.path.join(ROOT_DIR, 'benchmarks', 'results',
+                                                      time.strftime('%Y%m%d-%H%M%S') + '.json'))
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'HEAD'), help='compare two result files')
+    parser.add_argument('--threshold', type=float, default=0.2, help='regression threshold for --compare')
+    options = parser.parse_args(argv)
+    if options.compare:
+        return compare(*options.compare, options.threshold)
+    report = run(options)
+    os.makedirs(os.path.dirname(os.path.abspath(options.out)), exist_ok=True)
+    with open(options.out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(options.out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+import asyncio
+import gzip
+import io
+import os
+import random
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import zipfile
+from typing import Dict, List, Optional, Tuple
+
+# 3.7 / 3.8 / 3.9 / 3.10，覆盖 decompyle3 与 pycdc 两条反编译路径
+PYC_VERSIONS = ((3, 7), (3, 8), (3, 9), (3, 10))
+# compile_pyc output for each version, built with the matching interpreters
+PYC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pyc')
+
+PYC_SOURCE = '''
+import os
+
+
+def walk(path, depth=0):
+    for name in sorted(os.listdir(path)):
+        full = os.path.join(path, name)
+        if os.path.isdir(full) and depth < 3:
+            yield from walk(full, depth + 1)
+        else:
+            yield full
+
+
+class Counter:
+    def __init__(self):
+        self.items = {}
+
+    def add(self, key, amount=1):
+        self.items[key] = self.items.get(key, 0) + amount
+        return self.items[key]
+'''
+
+
+def compile_pyc(version: Tuple[int, int], save_path: str, source: str = PYC_SOURCE) -> bool:
+    """
+    用 PATH 中对应版本的解释器（pythonX.Y）编译 pyc
+    :return: 找不到或无法运行对应版本的解释器时返回 False
+    """
+    interpreter = shutil.which(f'python{version[0]}.{version[1]}')
+    if interpreter is None:
+        return False
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source_path = os.path.join(temp_dir, 'bench.py')
+        with open(source_path, 'w') as f:
+            f.write(source)
+        try:
+            # pyenv shims exist on PATH even when the version is not selected
+            subprocess.run([interpreter, '-c', 'import py_compile, sys; '
+                                               'py_compile.compile(sys.argv[1], sys.argv[2], "bench.py", doraise=True)',
+                            source_path, save_path], check=True, capture_output=True)
+        except (OSError, subprocess.CalledProcessError):
+            return False
+    return True
+
+
+def make_pyc(version: Tuple[int, int]) -> Optional[bytes]:
+    """
+    目标版本的 pyc 文件内容
+    * marshal 格式随版本变化，代码对象必须由对应版本的解释器编译：优先使用 PYC_DIR 中的 fixture，缺失时用 compile_pyc 生成
+    :return: 两者都不可用时返回 None，该版本的场景会被跳过
+    """
+    path = os.path.join(PYC_DIR, f'bench-{version[0]}.{version[1]}.pyc')
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'bench.pyc')
+        if not compile_pyc(version, path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+def make_zip(entries: int, entry_size: int = 64, encrypted: bool = False, seed: int = 0) -> bytes:
+    """
+    生成包含 entries 个文件的 zip，encrypted 时设置伪加密标志位
+    """
+    rng = random.Random(seed)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for i in range(entries):
+            archive.writestr(f'dir{i % 16}/file{i}.txt', bytes(rng.getrandbits(8) for _ in range(entry_size)))
+    data = bytearray(buffer.getvalue())
+    if encrypted:
+        for signature, flag_offset in ((b'PK\x03\x04', 6), (b'PK\x01\x02', 8)):
+            offset = data.find(signature)
+            while offset != -1:
+                data[offset + flag_offset] |= 0x01
+                offset = data.find(signature, offset + 4)
+    return bytes(data)
+
+
+def make_firmware(size: int = 1024 * 1024, seed: int = 0) -> bytes:
+    """
+    生成嵌入了常见签名（gzip、zip、PNG、ELF、squashfs 魔数）的随机固件
+    """
+    rng = random.Random(seed)
+    blob = bytearray(rng.getrandbits(8) for _ in range(size))
+    payloads = [
+        gzip.compress(b'bench firmware payload\n' * 256),
+        make_zip(8, seed=seed),
+        b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x10\x00\x00\x00\x10\x08\x06\x00\x00\x00',
+        b'\x7fELF\x02\x01\x01\x00' + b'\x00' * 8 + struct.pack('<HHI', 2, 0x3e, 1),
+        b'hsqs' + struct.pack('<IIIIIHHHHHH', 4, int(time.time()), 131072, 0, 1, 17, 0, 0, 0, 0, 4),
+    ]
+    step = size // (len(payloads) + 1)
+    for i, payload in enumerate(payloads):
+        offset = step * (i + 1)
+        blob[offset:offset + len(payload)] = payload
+    return bytes(blob)
+
+
+def write_fixtures(fixture_dir: str, zip_entries: List[int], firmware_size: int) -> Dict[str, str]:
+    """
+    将所有 fixture 写入目录
+    :return: fixture 名称到文件路径的映射
+    """
+    os.makedirs(fixture_dir, exist_ok=True)
+    fixtures = {}
+    for version in PYC_VERSIONS:
+        pyc = make_pyc(version)
+        if pyc is not None:
+            fixtures[f'pyc-{version[0]}.{version[1]}'] = pyc
+    for entries in zip_entries:
+        fixtures[f'zip-{entries}'] = make_zip(entries, seed=entries)
+        fixtures[f'zip-{entries}-pseudo'] = make_zip(entries, encrypted=True, seed=entries)
+    fixtures['firmware'] = make_firmware(firmware_size)
+    paths = {}
+    for name, content in fixtures.items():
+        ext = '.pyc' if name.startswith('pyc') else '.zip' if name.startswith('zip') else '.bin'
+        path = os.path.join(fixture_dir, f'{name}{ext}')
+        with open(path, 'wb') as f:
+            f.write(content)
+        paths[name] = path
+    return paths
+
+
+class ListenerFarm:
+    """
+    本地 TCP 监听端口集合，作为端口扫描的目标
+    * 在独立线程的事件循环中运行，接受连接后立即关闭
+    """
+
+    def __init__(self, host: str = '127.0.0.1', count: int = 32):
+        self.host = host
+        self.count = count
+        self.ports = []
+        self.loop = None
+        self.thread = None
+        self.ready = threading.Event()
+        self.stopped = None
+
+    async def serve(self):
+        self.stopped = asyncio.Event()
+        servers = []
+        for _ in range(self.count):
+            server = await asyncio.start_server(lambda reader, writer: writer.close(), self.host, 0)
+            servers.append(server)
+            self.ports.append(server.sockets[0].getsockname()[1])
+        self.ready.set()
+        try:
+            await self.stopped.wait()
+        finally:
+            for server in servers:
+                server.close()
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self.serve(),), daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+            self.thread.join(timeout=5)
+            self.loop.close()
+            self.loop = None
+
+    def port_spec(self, closed: int = 0) -> str:
+        """
+        扫描端口参数：所有监听端口，外加 closed 个大概率关闭的端口
+        """
+        spec = [str(port) for port in sorted(self.ports)]
+        if closed:
+            highest, lowest = max(self.ports), min(self.ports)
+            # no room above the highest listener, take the ports below the lowest one instead
+            if highest < 65535:
+                spec.append(f'{highest + 1}-{min(65535, highest + closed)}')
+            elif lowest > 1:
+                spec.append(f'{max(1, lowest - closed)}-{lowest - 1}')
+        return ','.join(spec)
@@ -1,3 +1,14 @@
+from core.admission import AdmissionController
+from core.cache import ResultCache
+from core.executor import BoundedProcessPool, WarmWorkerPool
+from core.http import PrecomputedResponse, RangeFileResponse, iter_zip
+from core.janitor import TempJanitor
+from core.jobs import Job, JobManager
+from core.metrics import MetricsRegistry
 from core.plugin import Plugin, PluginManager
+from core.schema import Param
+from core.upload import SpooledUpload, UploadView, spool_upload_file, upload_size
 
-__all__ = ['Plugin', 'PluginManager']
+__all__ = ['AdmissionController', 'BoundedProcessPool', 'Job', 'JobManager', 'MetricsRegistry', 'Param',
+           'Plugin', 'PluginManager', 'PrecomputedResponse', 'RangeFileResponse', 'ResultCache', 'SpooledUpload',
+           'TempJanitor', 'UploadView', 'WarmWorkerPool', 'iter_zip', 'spool_upload_file', 'upload_size']
@@ -0,0 +1,127 @@
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException, status
+
+
+class TokenBuckets:
+    """
+    按客户端划分的加权令牌桶（进程内）
+    * 多 worker 部署时使用 core.shared.SharedTokenBuckets
+    """
+
+    def __init__(self, max_keys: int = 65536):
+        self.max_keys = max_keys
+        # key -> (tokens, updated)
+        self.buckets: Dict[str, Tuple[float, float]] = {}
+
+    def take(self, key: str, cost: float, capacity: float, refill_rate: float) -> float:
+        """
+        从令牌桶中取出 cost 个令牌
+        :param key:         客户端标识
+        :param cost:        本次调用的开销
+        :param capacity:    桶容量
+        :param refill_rate: 每秒补充的令牌数
+        :return:            0 表示成功，否则为令牌足够前需等待的秒数
+        """
+        now = time.time()
+        tokens, updated = self.buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * refill_rate)
+        if tokens < cost:
+            self.buckets[key] = (tokens, now)
+            return (cost - tokens) / refill_rate
+        if key not in self.buckets and len(self.buckets) >= self.max_keys:
+            self.purge(now, capacity, refill_rate)
+        self.buckets[key] = (tokens - cost, now)
+        return 0
+
+    def give(self, key: str, amount: float, capacity: float, refill_rate: float):
+        """
+        向令牌桶退还 amount 个令牌，不超过桶容量
+        """
+        now = time.time()
+        tokens, updated = self.buckets.get(key, (capacity, now))
+        self.buckets[key] = (min(capacity, tokens + (now - updated) * refill_rate + amount), now)
+
+    def purge(self, now: float, capacity: float, refill_rate: float):
+        # buckets that have refilled completely carry no state
+        full_after = capacity / refill_rate
+        for key in [k for k, (_, updated) in self.buckets.items() if now - updated >= full_after]:
+            self.buckets.pop(key)
+
+
+class AdmissionController:
+    """
+    按开销准入：每个客户端一个加权令牌桶，每个插件一个并发信号量
+    * 令牌不足返回 429，插件排队已满返回 503，均附带 Retry-After
+    * 调用未实际执行时（排队被拒、流式响应体未开始）由调用方 refund 退还开销
+    """
+
+    def __init__(self, capacity: float = 180, refill_rate: float = 3, buckets=None, enabled: bool = True):
+        """
+        :param capacity:    每个客户端令牌桶的容量，也是单次调用的最大开销
+        :param refill_rate: 每秒补充的令牌数
+        :param buckets:     令牌桶存储，默认进程内
+        :param enabled:     False 时不扣除令牌，并发上限仍然生效
+        """
+        self.enabled = enabled
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.buckets = buckets or TokenBuckets()
+        # plugin name -> [semaphore, waiting, max concurrency]
+        self.slots: Dict[str, list] = {}
+
+    def charge(self, client: str, cost: float):
+        if not self.enabled:
+            return
+        cost = self.clamp(cost)
+        wait = self.buckets.take(client, cost, self.capacity, self.refill_rate)
+        if wait > 0:
+            raise HTTPException(
+                status.HTTP_429_TOO_MANY_REQUESTS,
+                f'rate limit exceeded, this call costs {round(cost, 2)} token(s)',
+                headers={'Retry-After': str(max(1, math.ceil(wait)))}
+            )
+
+    def refund(self, client: str, cost: float):
+        """
+        退还 charge 扣除的开销
+        """
+        if not self.enabled:
+            return
+        self.buckets.give(client, self.clamp(cost), self.capacity, self.refill_rate)
+
+    def clamp(self, cost: float) -> float:
+        return min(max(cost, 0), self.capacity)
+
+    @asynccontextmanager
+    async def limit(self, plugin_name: str, max_concurrency: Optional[int], max_queue: int):
+        """
+        在插件并发上限内执行，排队数超过 max_queue 时直接拒绝
+        """
+        if not max_concurrency:
+            yield
+            return
+        slot = self.slots.get(plugin_name)
+        if slot is None or slot[2] != max_concurrency:
+            # a reloaded plugin may declare a different limit
+            slot = self.slots[plugin_name] = [asyncio.Semaphore(max_concurrency), 0, max_concurrency]
+        semaphore = slot[0]
+        if semaphore.locked() and slot[1] >= max_queue:
+            raise HTTPException(
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+                f'{plugin_name} is busy, please retry later',
+                headers={'Retry-After': '5'}
+            )
+        slot[1] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            slot[1] -= 1
+        try:
+            yield
+        finally:
+            semaphore.release()
@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+from core.shared import FileLock
+
+
+class ResultCache:
+    """
+    以内容哈希为键的两级结果缓存：内存 LRU + 磁盘 JSON
+    * 磁盘层按总字节数与存活时间淘汰，淘汰时调用 on_evict 以便清理关联文件
+    * 读写会阻塞（文件锁、磁盘 IO、on_evict），在事件循环中应通过 asyncio.to_thread 调用
+    * 内存层命中时确认磁盘条目仍在，其他进程淘汰的条目（及其关联文件）不会再从内存层返回
+    """
+
+    def __init__(self, cache_dir: str, max_entries: int = 128, max_bytes: Optional[int] = None,
+                 max_age: Optional[float] = None, weigher: Callable[[str, Any], int] = None,
+                 on_evict: Callable[[str, Any], None] = None):
+        """
+        :param cache_dir:   磁盘层目录
+        :param max_entries: 内存层最大条目数
+        :param max_bytes:   磁盘层最大字节数，None 表示不限制
+        :param max_age:     条目最大存活秒数，None 表示不过期
+        :param weigher:     计算条目额外占用字节数的函数（如关联的产物文件）
+        :param on_evict:    磁盘层条目被淘汰时的回调
+        """
+        self.logger = logging.getLogger('cache')
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.weigher = weigher
+        self.on_evict = on_evict
+        self.memory = OrderedDict()
+        # key -> [stored time, size in bytes], kept in LRU order
+        self.index = OrderedDict()
+        self.total_bytes = 0
+        os.path.exists(self.cache_dir) or os.makedirs(self.cache_dir, exist_ok=True)
+        # 磁盘层可能被多个 worker 进程共享
+        self.lock = FileLock(os.path.join(self.cache_dir, '.lock'))
+        self._load_index()
+
+    def _entry_path(self, key: str):
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def _load_index(self):
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith('.json'):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, file_name))
+            entries.append((stat.st_mtime, os.path.splitext(file_name)[0], stat.st_size))
+        for mtime, key, size in sorted(entries):
+            if self.weigher:
+                try:
+                    with open(self._entry_path(key), 'r', encoding='utf-8') as f:
+                        size += self.weigher(key, json.load(f)['value'])
+                except (OSError, ValueError, KeyError):
+                    pass
+            self.index[key] = [mtime, size]
+            self.total_bytes += size
+
+    def _expired(self, stored_at: float):
+        return self.max_age is not None and time.time() - stored_at > self.max_age
+
+    def get(self, key: str, default=None):
+        with self.lock:
+            if key in self.memory:
+                stored_at, value = self.memory[key]
+                if not os.path.exists(self._entry_path(key)):
+                    # evicted by another process, which has run on_evict already
+                    self._forget(key)
+                    return default
+                if not self._expired(stored_at):
+                    self.memory.move_to_end(key)
+                    self._touch(key)
+                    return value
+                self.evict(key)
+                return default
+            if key not in self.index and not self._adopt(key):
+                return default
+            try:
+                with open(self._entry_path(key), 'r', encoding='utf-8') as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                self.evict(key)
+                return default
+            if self._expired(record['stored_at']):
+                self.evict(key)
+                return default
+            self._remember(key, record['stored_at'], record['value'])
+            self._touch(key)
+            return record['value']
+
+    def set(self, key: str, value):
+        with self.lock:
+            stored_at = time.time()
+            content = json.dumps({'stored_at': stored_at, 'value': value}, ensure_ascii=False)
+            entry_path = self._entry_path(key)
+            temp_path = f'{entry_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(temp_path, entry_path)
+            size = len(content.encode('utf-8'))
+            if self.weigher:
+                size += self.weigher(key, value)
+            if key in self.index:
+                self.total_bytes -= self.index.pop(key)[1]
+            self.index[key] = [stored_at, size]
+            self.total_bytes += size
+            self._remember(key, stored_at, value)
+            self._shrink()
+
+    def evict(self, key: str):
+        with self.lock:
+            value = None
+            if key in self.memory:
+                value = self.memory.pop(key)[1]
+            if key in self.index:
+                self.total_bytes -= self.index.pop(key)[1]
+                entry_path = self._entry_path(key)
+                if value is None and self.on_evict:
+                    try:
+                        with open(entry_path, 'r', encoding='utf-8') as f:
+                            value = json.load(f)['value']
+                    except (OSError, ValueError, KeyError):
+                        pass
+                if os.path.exists(entry_path):
+                    os.remove(entry_path)
+            if self.on_evict and value is not None:
+                try:
+                    self.on_evict(key, value)
+                except Exception as e:
+                    self.logger.error(f'failed to evict cache entry {key}: {e}')
+
+    def _forget(self, key: str):
+        self.memory.pop(key, None)
+        if key in self.index:
+            self.total_bytes -= self.index.pop(key)[1]
+
+    def _adopt(self, key: str):
+        """
+        将其他进程写入磁盘层的条目纳入本进程的索引
+        """
+        try:
+            stat = os.stat(self._entry_path(key))
+        except OSError:
+            return False
+        self.index[key] = [stat.st_mtime, stat.st_size]
+        self.total_bytes += stat.st_size
+        return True
+
+    def _remember(self, key: str, stored_at: float, value):
+        self.memory[key] = (stored_at, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _touch(self, key: str):
+        if key in self.index:
+            self.index.move_to_end(key)
+
+    def _shrink(self):
+        if self.max_age is not None:
+            for key in [k for k, (stored_at, _) in self.index.items() if self._expired(stored_at)]:
+                self.evict(key)
+        if self.max_bytes is None:
+            return
+        while self.total_bytes > self.max_bytes and len(self.index) > 1:
+            self.evict(next(iter(self.index)))
@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import time
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional
+
+from fastapi import HTTPException, status
+
+
+class BoundedProcessPool:
+    """
+    有界进程池：最多 workers 个任务并行执行，额外最多 queue_size 个任务排队
+    * 队列已满时立即抛出 503 并附带 Retry-After，而不是无限堆积请求
+    """
+
+    def __init__(self, name: str, workers: Optional[int] = None, queue_size: int = 16,
+                 initializer: Callable = None, initargs: tuple = ()):
+        """
+        :param name:        进程池名称，用于日志
+        :param workers:     工作进程数，默认为 CPU 核心数
+        :param queue_size:  排队任务数上限
+        :param initializer: 工作进程启动时调用的函数
+        :param initargs:    initializer 的参数
+        """
+        self.logger = logging.getLogger(f'executor.{name}')
+        self.name = name
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.initializer = initializer
+        self.initargs = initargs
+        self.executor = None
+        self.in_flight = 0
+        # 池内任务与 reserve() 占用的工作进程名额，在事件循环中创建
+        self.slots = None
+        # exponentially weighted moving average of task duration, used for Retry-After
+        self.avg_duration = 1.0
+
+    @property
+    def queued(self):
+        return max(0, self.in_flight - self.workers)
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn' if os.name == 'nt' else 'fork'),
+                initializer=self.initializer,
+                initargs=self.initargs
+            )
+            self.logger.info(f'started {self.workers} worker(s), queue size {self.queue_size}')
+        return self.executor
+
+    def shutdown(self, wait: bool = True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait, cancel_futures=True)
+            self.executor = None
+
+    def retry_after(self):
+        return max(1, math.ceil(self.avg_duration * (self.queued + 1) / self.workers))
+
+    def check_capacity(self):
+        """
+        排队已满时抛出 503
+        """
+        if self.in_flight >= self.workers + self.queue_size:
+            raise HTTPException(
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+                f'{self.name} is busy, please retry later',
+                headers={'Retry-After': str(self.retry_after())}
+            )
+
+    @asynccontextmanager
+    async def reserve(self):
+        """
+        占用一个工作进程名额直到退出，排队已满时抛出 503
+        * 池外运行的子进程（如流式输出结果的扫描）也通过它与池内任务共享并发与排队上限
+        """
+        self.check_capacity()
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.workers)
+        self.in_flight += 1
+        t1 = time.time()
+        try:
+            async with self.slots:
+                yield
+        finally:
+            self.in_flight -= 1
+            self.avg_duration = self.avg_duration * 0.8 + (time.time() - t1) * 0.2
+
+    async def submit(self, func: Callable, *args):
+        """
+        提交任务到进程池并等待结果
+        :param func:    可被 pickle 的模块级函数
+        :param args:    参数
+        :return:        执行结果
+        """
+        async with self.reserve():
+            return await self.execute(func, *args)
+
+    async def execute(self, func: Callable, *args):
+        executor = self.start()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            # a worker died (crash or OOM kill), the executor is unusable from now on
+            if self.executor is executor:
+                self.logger.error('a worker process died abruptly, restarting the pool')
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+            raise HTTPException(
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+                f'{self.name} worker crashed, please retry later',
+                headers={'Retry-After': str(self.retry_after())}
+            )
+
+
+def _warm_worker_main(conn, initializer, initargs):
+    if initializer is not None:
+        try:
+            initializer(*initargs)
+        except Exception as e:
+            logging.getLogger('executor').error(f'worker initializer failed: {e}')
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        func, args = job
+        try:
+            conn.send((True, func(*args)))
+        except Exception as e:
+            conn.send((False, f'{type(e).__name__}: {e}'))
+    conn.close()
+
+
+class WarmWorker:
+    def __init__(self, context, initializer: Callable, initargs: tuple):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_warm_worker_main, args=(child_conn, initializer, initargs),
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=1)
+        self.kill()
+
+
+class WarmWorkerPool(BoundedProcessPool):
+    """
+    常驻工作进程池：工作进程启动时完成耗时的 import，之后通过管道接收任务
+    * 单个任务超时将杀死并替换该工作进程，返回 504
+    * 每个工作进程执行 max_jobs 个任务后回收重建，避免内存持续增长
+    """
+
+    def __init__(self, name: str, workers: Optional[int] = None, queue_size: int = 16,
+                 initializer: Callable = None, initargs: tuple = (), timeout: float = 30, max_jobs: int = 100):
+        """
+        :param timeout:     单个任务的超时秒数
+        :param max_jobs:    工作进程回收前最多执行的任务数
+        """
+        super().__init__(name, workers, queue_size, initializer, initargs)
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.context = multiprocessing.get_context('spawn' if os.name == 'nt' else 'fork')
+        self.idle = None
+        # 正在执行任务的工作进程，关闭时与空闲进程一起结束
+        self.busy = set()
+
+    def spawn(self):
+        return WarmWorker(self.context, self.initializer, self.initargs)
+
+    def start(self):
+        if self.idle is None:
+            self.idle = asyncio.Queue()
+            for _ in range(self.workers):
+                self.idle.put_nowait(self.spawn())
+            self.logger.info(f'started {self.workers} warm worker(s), queue size {self.queue_size}')
+        return self.idle
+
+    def shutdown(self, wait: bool = True):
+        if self.idle is not None:
+            while not self.idle.empty():
+                self.idle.get_nowait().stop()
+            self.idle = None
+        # running jobs fail with the worker, their replacement is not returned to the pool
+        for worker in list(self.busy):
+            worker.kill()
+        self.busy.clear()
+
+    async def execute(self, func: Callable, *args):
+        idle = self.start()
+        worker = taken = await idle.get()
+        self.busy.add(taken)
+        try:
+            if not worker.process.is_alive():
+                worker.kill()
+                worker = self.spawn()
+            worker.conn.send((func, args))
+            try:
+                replied = await asyncio.to_thread(worker.conn.poll, self.timeout)
+            except asyncio.CancelledError:
+                # the reply would be picked up by the next job, so drop this worker
+                worker.kill()
+                worker = self.spawn()
+                raise
+            if not replied:
+                self.logger.warning(f'job timed out after {self.timeout}s, killing worker {worker.process.pid}')
+                worker.kill()
+                worker = self.spawn()
+                raise HTTPException(status.HTTP_504_GATEWAY_TIMEOUT, f'{self.name} timed out')
+            try:
+                ok, result = worker.conn.recv()
+            except EOFError:
+                worker.kill()
+                worker = self.spawn()
+                raise RuntimeError(f'{self.name} worker exited unexpectedly')
+            worker.jobs += 1
+            if worker.jobs >= self.max_jobs:
+                retired, worker = worker, self.spawn()
+                # stop waits for the worker to exit, keep it off the event loop
+                await asyncio.to_thread(retired.stop)
+            if not ok:
+                raise RuntimeError(result)
+            return result
+        finally:
+            self.busy.discard(taken)
+            if self.idle is idle:
+                idle.put_nowait(worker)
+            else:
+                # the pool was shut down while the job ran
+                worker.kill()
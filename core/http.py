@@ -0,0 +1,233 @@
+import hashlib
+import json
+import os
+import re
+import stat
+import zipfile
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Awaitable, Callable, Iterable, Optional, Tuple
+
+import anyio
+from fastapi.encoders import jsonable_encoder
+from starlette.datastructures import Headers
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+from starlette.types import Receive, Scope, Send
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class PrecomputedResponse:
+    """
+    预先序列化的调用结果，附带 ETag 与 Last-Modified，供频繁轮询且很少变化的接口使用
+    """
+
+    def __init__(self, result, last_modified: Optional[float] = None):
+        """
+        :param result:          调用结果，与 /call 的 result 字段一致
+        :param last_modified:   结果的最后修改时间戳
+        """
+        self.body = json.dumps({
+            'status': 0,
+            'spent': 0,
+            'result': jsonable_encoder(result)
+        }, ensure_ascii=False).encode('utf-8')
+        self.etag = f'"{hashlib.sha1(self.body).hexdigest()}"'
+        self.last_modified = last_modified
+
+    def response(self):
+        headers = {'ETag': self.etag, 'Cache-Control': 'no-cache'}
+        if self.last_modified is not None:
+            headers['Last-Modified'] = formatdate(self.last_modified, usegmt=True)
+        return Response(content=self.body, media_type='application/json', headers=headers)
+
+
+class ReleasingResponse(Response):
+    """
+    包装响应，发送结束后（包括发送出错或客户端断开）调用 release，用于释放响应体运行期间占用的资源
+    * 响应被替换而不发送时（如 304），需用替换后的响应重新包装以调用 release
+    """
+
+    def __init__(self, response: Response, release: Callable[[], Awaitable]):
+        """
+        :param response:    被包装的响应，头部与之共享
+        :param release:     无参协程函数
+        """
+        self.response = response
+        self.release = release
+        self.status_code = response.status_code
+        self.media_type = response.media_type
+        self.background = None
+        self.raw_headers = response.raw_headers
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            await self.release()
+
+
+def not_modified(request: Request, response: Response) -> Optional[Response]:
+    """
+    按请求的 If-None-Match / If-Modified-Since 判断响应是否未变化
+    :param request:     请求
+    :param response:    插件返回的响应
+    :return:            未变化时返回 304 响应，否则返回 None
+    """
+    etag = response.headers.get('etag')
+    last_modified = response.headers.get('last-modified')
+    if_none_match = request.headers.get('if-none-match')
+    if_modified_since = request.headers.get('if-modified-since')
+    fresh = False
+    if etag and if_none_match:
+        fresh = etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    elif last_modified and if_modified_since:
+        try:
+            fresh = parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            fresh = False
+    if not fresh:
+        return None
+    headers = {k: v for k, v in response.headers.items() if k in ('etag', 'last-modified', 'cache-control')}
+    return Response(status_code=304, headers=headers)
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析单段 Range 请求头
+    :param header:  Range 请求头
+    :param size:    文件大小
+    :return:        闭区间 (start, end)；无法满足时抛出 ValueError；多段、格式不符或无效时返回 None（按完整文件响应）
+    """
+    match = RANGE_PATTERN.match(header.strip())
+    if match is None:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # suffix range: the last N bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError('empty suffix range')
+        if size == 0:
+            return None
+        return max(0, size - length), size - 1
+    start = int(start)
+    # RFC 9110 14.1.1: last-pos before first-pos makes the header invalid, it is ignored rather than unsatisfiable
+    if end and int(end) < start:
+        return None
+    if start >= size:
+        raise ValueError('range not satisfiable')
+    end = min(int(end), size - 1) if end else size - 1
+    return start, end
+
+
+class RangeFileResponse(FileResponse):
+    """
+    支持单段 Range 请求的文件响应，在线程中按 chunk_size 分块读取请求的区间并发送
+    * 不做零拷贝：ASGI 应用拿不到客户端 socket，无法调用 os.sendfile；uvicorn 0.20 也不提供 http.response.zerocopysend 扩展
+    """
+
+    chunk_size = 256 * 1024
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+        except FileNotFoundError:
+            raise RuntimeError(f'File at path {self.path} does not exist.')
+        if not stat.S_ISREG(stat_result.st_mode):
+            raise RuntimeError(f'File at path {self.path} is not a file.')
+        self.set_stat_headers(stat_result)
+        self.headers['accept-ranges'] = 'bytes'
+        size = stat_result.st_size
+        start, end = 0, size - 1
+        request_headers = Headers(scope=scope)
+        range_header = request_headers.get('range')
+        if_range = request_headers.get('if-range')
+        if range_header and (not if_range or if_range in (self.headers['etag'], self.headers['last-modified'])):
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                await Response(status_code=416, headers={'content-range': f'bytes */{size}'})(scope, receive, send)
+                return
+            if byte_range is not None:
+                start, end = byte_range
+                self.status_code = 206
+                self.headers['content-range'] = f'bytes {start}-{end}/{size}'
+                self.headers['content-length'] = str(end - start + 1)
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if self.send_header_only or scope.get('method') == 'HEAD' or size == 0:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        else:
+            async with await anyio.open_file(self.path, mode='rb') as file:
+                await file.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = await file.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': remaining > 0})
+                if remaining > 0:
+                    # the file shrank while being sent
+                    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        if self.background is not None:
+            await self.background()
+
+
+class _ZipSink:
+    """
+    供 zipfile 写入的不可回退输出，写入的数据由 iter_zip 取走
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def iter_zip(entries: Iterable[Tuple[str, str]], chunk_size: int = 256 * 1024):
+    """
+    边读取文件边生成 zip 数据流，不在磁盘或内存中构建完整压缩包
+    :param entries:     (压缩包内文件名, 文件路径) 列表
+    :param chunk_size:  读取文件的分块大小
+    :return:            zip 数据块
+    """
+    sink = _ZipSink()
+    # 输出不可 seek，zipfile 会在每个文件后写入 data descriptor
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for arcname, path in entries:
+            try:
+                file_stat = os.stat(path)
+                source = open(path, 'rb')
+            except OSError:
+                continue
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            info.file_size = file_stat.st_size
+            with source, archive.open(info, 'w', force_zip64=True) as target:
+                while True:
+                    chunk = source.read(chunk_size)
+                    if not chunk:
+                        break
+                    target.write(chunk)
+                    if sink.chunks:
+                        yield sink.drain()
+    # local headers, data descriptors and the central directory left in the sink
+    if sink.chunks:
+        yield sink.drain()
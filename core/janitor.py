@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from core.safe import singleton
+
+
+class TempQuota:
+    """
+    单个插件临时目录的配额与文件索引
+    """
+
+    def __init__(self, temp_dir: str, max_bytes: Optional[int] = None, max_age: Optional[float] = None):
+        """
+        :param temp_dir:    临时目录
+        :param max_bytes:   目录最大字节数，None 表示不限制
+        :param max_age:     文件最大存活秒数，None 表示不过期
+        """
+        self.temp_dir = temp_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # path -> [mtime, size]，按 mtime 从旧到新排列
+        self.index = OrderedDict()
+        self.total_bytes = 0
+        # 请求处理在事件循环中登记，清理在后台线程中对账
+        self.lock = threading.Lock()
+
+    def add(self, path: str, mtime: float, size: int):
+        with self.lock:
+            self._add(path, mtime, size)
+
+    def _add(self, path: str, mtime: float, size: int):
+        if path in self.index:
+            self.total_bytes -= self.index.pop(path)[1]
+        self.index[path] = [mtime, size]
+        self.total_bytes += size
+
+    def discard(self, path: str):
+        """
+        移除文件的登记，path 为目录时移除其中所有文件
+        """
+        with self.lock:
+            if path in self.index:
+                self.total_bytes -= self.index.pop(path)[1]
+                return
+            prefix = os.path.join(path, '')
+            for child in [child for child in self.index if child.startswith(prefix)]:
+                self.total_bytes -= self.index.pop(child)[1]
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.index.items())
+
+    def reconcile(self):
+        """
+        与临时目录对账：移除已不存在的文件，纳入其他进程或工作进程写入的文件
+        * 只修正差异，扫描期间新登记的文件保留在索引中
+        """
+        started = time.time()
+        found = {}
+        for root, _, files in os.walk(self.temp_dir):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                # extracted files keep the mtime stored in the archive, ctime tells when they landed here
+                found[path] = (max(stat.st_mtime, stat.st_ctime), stat.st_size)
+        with self.lock:
+            for path, (mtime, size) in list(self.index.items()):
+                if path not in found and mtime < started:
+                    self.total_bytes -= self.index.pop(path)[1]
+            newest = next(reversed(self.index.values()), [0])[0]
+            unordered = False
+            for path, (mtime, size) in found.items():
+                if path not in self.index:
+                    unordered = unordered or mtime < newest
+                    newest = max(newest, mtime)
+                    self._add(path, mtime, size)
+            if unordered:
+                self.index = OrderedDict(sorted(self.index.items(), key=lambda item: item[1][0]))
+
+    def usage(self):
+        oldest = next(iter(self.index.values()), None)
+        return {
+            'files': len(self.index),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'max_age': self.max_age,
+            'oldest': oldest[0] if oldest else None
+        }
+
+
+@singleton
+class TempJanitor:
+    """
+    临时文件清理器：在后台按插件配额删除过期或超额的临时文件
+    * 请求处理只需登记新文件，目录扫描与删除都在后台线程中完成
+    """
+
+    def __init__(self, interval: float = 60, grace: float = 300):
+        """
+        :param interval:    清理间隔秒数
+        :param grace:       新文件的保护期秒数，避免删除仍在处理中的上传文件
+        """
+        self.logger = logging.getLogger('janitor')
+        self.interval = interval
+        self.grace = grace
+        self.quotas: Dict[str, TempQuota] = {}
+        self.task = None
+
+    def register(self, plugin_name: str, temp_dir: str, max_bytes: Optional[int] = None,
+                 max_age: Optional[float] = None):
+        self.quotas[plugin_name] = TempQuota(temp_dir, max_bytes, max_age)
+
+    def unregister(self, plugin_name: str):
+        self.quotas.pop(plugin_name, None)
+
+    def track(self, plugin_name: str, path: str, size: Optional[int] = None):
+        """
+        登记插件新写入的临时文件
+        :param plugin_name: 插件名
+        :param path:        文件路径
+        :param size:        文件大小，None 时读取文件信息
+        """
+        quota = self.quotas.get(plugin_name)
+        if quota is None:
+            return
+        if size is None:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return
+        quota.add(path, time.time(), size)
+
+    def untrack(self, plugin_name: str, path: str):
+        """
+        取消登记插件已删除的临时文件
+        :param plugin_name: 插件名
+        :param path:        文件路径，为目录时取消登记其中的所有文件
+        """
+        quota = self.quotas.get(plugin_name)
+        if quota is not None:
+            quota.discard(path)
+
+    def usage(self):
+        return {plugin_name: quota.usage() for plugin_name, quota in self.quotas.items()}
+
+    def sweep(self):
+        """
+        按配额清理所有插件的临时目录
+        :return: 删除的文件数
+        """
+        removed = 0
+        now = time.time()
+        for plugin_name, quota in list(self.quotas.items()):
+            if not os.path.isdir(quota.temp_dir):
+                continue
+            quota.reconcile()
+            for path, (mtime, size) in quota.snapshot():
+                if now - mtime < self.grace:
+                    break
+                expired = quota.max_age is not None and now - mtime > quota.max_age
+                oversize = quota.max_bytes is not None and quota.total_bytes > quota.max_bytes
+                if not expired and not oversize:
+                    break
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    self.logger.error(f'failed to remove {path}: {e}')
+                    continue
+                quota.discard(path)
+            self.prune_dirs(quota.temp_dir, now)
+        return removed
+
+    def prune_dirs(self, temp_dir: str, now: float):
+        for root, dirs, files in os.walk(temp_dir, topdown=False):
+            if root == temp_dir or dirs or files:
+                continue
+            try:
+                if now - os.path.getmtime(root) >= self.grace:
+                    os.rmdir(root)
+            except OSError:
+                pass
+
+    async def run(self):
+        while True:
+            try:
+                removed = await asyncio.to_thread(self.sweep)
+                if removed:
+                    self.logger.info(f'removed {removed} temporary file(s)')
+            except Exception as e:
+                self.logger.error(f'sweep failed: {e}', exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import FileResponse, Response
+
+from core.http import RangeFileResponse
+from core.safe import singleton
+from core.shared import SharedJobStore
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+class Job:
+    def __init__(self, plugin_name: str, method_name: str, job_id: str = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.plugin_name = plugin_name
+        self.method_name = method_name
+        self.status = JOB_PENDING
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.error_code = None
+        self.changed = asyncio.Event()
+
+    @property
+    def done(self):
+        return self.status in (JOB_DONE, JOB_FAILED)
+
+    @property
+    def has_response(self):
+        return isinstance(self.result, Response)
+
+    def set_status(self, job_status: str):
+        self.status = job_status
+        # wake up every subscriber, then arm a fresh event for the next change
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'plugin': self.plugin_name,
+            'method': self.method_name,
+            'state': self.status,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'spent': round(self.finished - self.started, 3) if self.finished and self.started else None,
+            'result': None if self.has_response else self.result,
+            'download': self.has_response,
+            'error': self.error,
+            'error_code': self.error_code
+        }
+
+    def to_record(self):
+        record = jsonable_encoder(self.to_dict())
+        if isinstance(self.result, FileResponse):
+            record['download_path'] = self.result.path
+            record['download_filename'] = self.result.filename
+        return record
+
+    @classmethod
+    def from_record(cls, record: dict):
+        """
+        从共享存储中的记录还原任务（由其他 worker 执行）
+        """
+        job = cls(record['plugin'], record['method'], record['id'])
+        job.status = record['state']
+        job.created = record['created']
+        job.started = record['started']
+        job.finished = record['finished']
+        job.result = record['result']
+        job.error = record['error']
+        job.error_code = record['error_code']
+        if record.get('download_path'):
+            job.result = RangeFileResponse(path=record['download_path'], filename=record['download_filename'])
+        return job
+
+
+@singleton
+class JobManager:
+    """
+    异步任务管理器：立即返回任务 ID，在后台执行插件方法
+    * 任务记录按数量与存活时间有界保留
+    """
+
+    def __init__(self, max_jobs: int = 1024, ttl: float = 3600, concurrency: int = 8,
+                 store: Optional[SharedJobStore] = None):
+        """
+        :param max_jobs:    最多保留的任务记录数
+        :param ttl:         已结束任务的保留秒数
+        :param concurrency: 同时执行的任务数
+        :param store:       多 worker 部署时共享任务记录的存储
+        """
+        self.logger = logging.getLogger('job_manager')
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self.semaphore = None
+        self.store = store
+        self.jobs = OrderedDict()
+        self.tasks = set()
+
+    def get_job(self, job_id: str) -> Optional[Job]:
+        job = self.jobs.get(job_id)
+        if job is None and self.store is not None:
+            record = self.store.load(job_id)
+            if record is not None:
+                job = Job.from_record(record)
+        return job
+
+    async def watch(self, job_id: str, timeout: float = 15, poll_interval: float = 0.5):
+        """
+        订阅任务状态变化，任务结束后停止
+        :param job_id:          任务 ID
+        :param timeout:         无变化时产出 None（用于保活）的间隔秒数
+        :param poll_interval:   任务在其他 worker 上执行时轮询共享存储的间隔秒数
+        :return:                依次产出任务记录，或 None
+        """
+        last_status = None
+        idle_since = time.time()
+        while True:
+            job = self.get_job(job_id)
+            if job is None:
+                return
+            changed = job.changed
+            if job.status != last_status:
+                last_status = job.status
+                idle_since = time.time()
+                yield job
+            if job.done:
+                return
+            try:
+                if job_id in self.jobs:
+                    await asyncio.wait_for(changed.wait(), timeout=timeout)
+                else:
+                    await asyncio.sleep(poll_interval)
+                    if time.time() - idle_since >= timeout:
+                        raise asyncio.TimeoutError()
+            except asyncio.TimeoutError:
+                idle_since = time.time()
+                yield None
+
+    def save(self, job: Job):
+        if self.store is not None:
+            self.store.save(job.id, job.to_record())
+
+    def submit(self, plugin_name: str, method_name: str, func: Callable[[], Awaitable]) -> Job:
+        """
+        提交任务
+        :param plugin_name: 插件名
+        :param method_name: 方法名
+        :param func:        返回协程的无参函数
+        :return:            任务记录
+        """
+        self.purge()
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        job = Job(plugin_name, method_name)
+        self.jobs[job.id] = job
+        self.save(job)
+        task = asyncio.create_task(self.run(job, func))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return job
+
+    async def run(self, job: Job, func: Callable[[], Awaitable]):
+        async with self.semaphore:
+            job.started = time.time()
+            job.set_status(JOB_RUNNING)
+            self.save(job)
+            try:
+                job.result = await func()
+                job.finished = time.time()
+                job.set_status(JOB_DONE)
+            except HTTPException as e:
+                job.error, job.error_code = e.detail, e.status_code
+                job.finished = time.time()
+                job.set_status(JOB_FAILED)
+            except Exception as e:
+                self.logger.error(f'job {job.id} ({job.plugin_name}.{job.method_name}) failed: {e}', exc_info=True)
+                job.error, job.error_code = str(e), 500
+                job.finished = time.time()
+                job.set_status(JOB_FAILED)
+            self.save(job)
+
+    def purge(self):
+        now = time.time()
+        if self.store is not None:
+            self.store.purge(now - self.ttl)
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.done and now - job.finished > self.ttl]:
+            self.jobs.pop(job_id)
+        while len(self.jobs) >= self.max_jobs:
+            finished = next((job_id for job_id, job in self.jobs.items() if job.done), None)
+            if finished is None:
+                raise HTTPException(503, 'too many pending jobs, please retry later')
+            self.jobs.pop(finished)
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import zipfile
+from typing import Optional, Sequence
+from urllib.parse import parse_qs, urlparse
+
+import patoolib
+import requests
+
+from core.safe import singleton
+from core.shared import FileLock
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class PackageError(RuntimeError):
+    pass
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def package_file_name(url: str) -> str:
+    """
+    从 URL 推断数据包文件名：优先取 file_name 查询参数，其次取路径最后一段
+    """
+    parsed = urlparse(url)
+    query = parse_qs(parsed.query)
+    if query.get('file_name'):
+        return os.path.basename(query['file_name'][0])
+    return os.path.basename(parsed.path)
+
+
+@singleton
+class PackageStore:
+    """
+    数据包仓库：多个插件共享的下载缓存，可从离线目录直接提供数据包
+    * 首次获取数据包时记录其 SHA-256，此后缓存命中或重新下载都会按记录校验
+    * 调用方传入或已记录 SHA-256 时按其校验；ALLOW_UNPINNED_PACKAGES=off 时拒绝下载没有期望 SHA-256 的数据包
+    * 同一数据包加锁获取，多个 worker 进程或插件并发启动时只下载一次
+    """
+
+    def __init__(self, cache_dir: str = 'data/.packages', bundle_dir: Optional[str] = None, timeout: float = 10,
+                 allow_unpinned: Optional[bool] = None):
+        """
+        :param cache_dir:       下载缓存目录
+        :param bundle_dir:      离线数据包目录，默认读取环境变量 DATA_PACKAGE_DIR
+        :param timeout:         下载连接超时秒数
+        :param allow_unpinned:  是否允许下载没有期望 SHA-256 的数据包（首次获取时记录），默认读取环境变量 ALLOW_UNPINNED_PACKAGES
+        """
+        self.logger = logging.getLogger('packages')
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.bundle_dir = bundle_dir or os.getenv('DATA_PACKAGE_DIR') or None
+        self.timeout = timeout
+        if allow_unpinned is None:
+            allow_unpinned = os.getenv('ALLOW_UNPINNED_PACKAGES', 'on') != 'off'
+        self.allow_unpinned = allow_unpinned
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.manifest_path = os.path.join(self.cache_dir, 'manifest.json')
+        self.manifest_lock = FileLock(f'{self.manifest_path}.lock')
+
+    def pinned_sha256(self, file_name: str) -> Optional[str]:
+        with self.manifest_lock:
+            if not os.path.exists(self.manifest_path):
+                return None
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f).get(file_name)
+
+    def pin_sha256(self, file_name: str, sha256: str):
+        with self.manifest_lock:
+            manifest = {}
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+            manifest[file_name] = sha256
+            temp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, indent=4)
+            os.replace(temp_path, self.manifest_path)
+
+    def verified(self, path: str, sha256: Optional[str]) -> bool:
+        if not os.path.isfile(path):
+            return False
+        if sha256 is None:
+            return True
+        actual = file_sha256(path)
+        if actual != sha256:
+            self.logger.warning(f'checksum mismatch for {path}: expected {sha256}, got {actual}')
+            return False
+        return True
+
+    def download(self, url: str, save_path: str):
+        temp_path = f'{save_path}.{os.getpid()}.part'
+        try:
+            with requests.get(url, stream=True, timeout=self.timeout) as req:
+                if req.status_code != 200:
+                    raise PackageError(f'failed to retrieve data package from {url}: HTTP {req.status_code}')
+                with open(temp_path, 'wb') as f:
+                    for chunk in req.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        if chunk:
+                            f.write(chunk)
+            os.replace(temp_path, save_path)
+        except requests.RequestException as e:
+            raise PackageError(f'failed to fetch data package: {e}') from e
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def fetch(self, url: str, file_name: Optional[str] = None, sha256: Optional[str] = None,
+              search_dirs: Sequence[str] = ()) -> str:
+        """
+        获取数据包文件：下载缓存 -> 离线目录 -> search_dirs -> 网络
+        :param url:         数据包 URL
+        :param file_name:   数据包文件名，默认从 URL 推断
+        :param sha256:      期望的 SHA-256，None 时使用首次获取时记录的值
+        :param search_dirs: 其他可能已有该数据包的目录（如旧版本下载到的插件数据目录）
+        :return:            缓存中的数据包路径
+        """
+        file_name = file_name or package_file_name(url)
+        if not file_name:
+            raise PackageError(f'can not infer package file name from {url}')
+        cache_path = os.path.join(self.cache_dir, file_name)
+        with FileLock(f'{cache_path}.lock'):
+            expected = sha256 or self.pinned_sha256(file_name)
+            local_dirs = ([self.bundle_dir] if self.bundle_dir else []) + list(search_dirs)
+            if self.verified(cache_path, expected):
+                self.logger.info(f'\033[1;32mpackage cached: {file_name}\033[0m')
+            else:
+                local_path = next((os.path.join(d, file_name) for d in local_dirs
+                                   if self.verified(os.path.join(d, file_name), expected)), None)
+                if local_path is not None:
+                    self.logger.info(f'\033[1;32mpackage found locally: {local_path}\033[0m')
+                    shutil.copyfile(local_path, cache_path)
+                else:
+                    if expected is None and not self.allow_unpinned:
+                        raise PackageError(f'refusing to download {file_name} without a pinned SHA-256')
+                    self.logger.info(f'\033[1;32mdownloading package: {file_name} ...\033[0m')
+                    self.download(url, cache_path)
+                    if not self.verified(cache_path, expected):
+                        os.remove(cache_path)
+                        raise PackageError(f'checksum mismatch for downloaded package {file_name}')
+            if expected is None:
+                self.pin_sha256(file_name, file_sha256(cache_path))
+        return cache_path
+
+    def extract(self, package_path: str, dest_dir: str) -> str:
+        """
+        解压数据包到 dest_dir/<包名>，包内容未变化时跳过
+        :return: 解压目录
+        """
+        extract_dir = os.path.join(dest_dir, os.path.splitext(os.path.basename(package_path))[0])
+        marker_path = os.path.join(extract_dir, '.package-sha256')
+        with FileLock(f'{extract_dir}.lock'):
+            sha256 = file_sha256(package_path)
+            if os.path.exists(marker_path):
+                with open(marker_path, 'r') as f:
+                    if f.read().strip() == sha256:
+                        return extract_dir
+            self.extract_archive(package_path, extract_dir)
+            with open(marker_path, 'w') as f:
+                f.write(sha256)
+        return extract_dir
+
+    @staticmethod
+    def extract_archive(package_path: str, extract_dir: str):
+        try:
+            patoolib.extract_archive(package_path, outdir=extract_dir, verbosity=-1, interactive=False)
+        except patoolib.util.PatoolError:
+            if not zipfile.is_zipfile(package_path):
+                raise PackageError(f'failed to extract data package {package_path}')
+            with zipfile.ZipFile(package_path, 'r') as zip_file:
+                for member in zip_file.namelist():
+                    target_path = os.path.join(extract_dir, member)
+                    if os.path.isfile(target_path):
+                        os.remove(target_path)
+                    zip_file.extract(member, path=extract_dir)
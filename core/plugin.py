@@ -1,25 +1,32 @@
-import hashlib
+import asyncio
 import importlib
 import inspect
 import json
 import logging
 import os
-import re
 import shutil
+import sys
 import time
-import zipfile
-from typing import List
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List, NamedTuple, Optional
 
-import patoolib
-import requests
 from fastapi import UploadFile
-from tqdm import tqdm
 
+from core.janitor import TempJanitor
+from core.metrics import (plugin_call_duration, plugin_call_errors, plugin_calls, plugin_calls_in_flight,
+                          plugin_upload_bytes)
+from core.packages import PackageStore
 from core.safe import singleton
+from core.schema import Param, compile_params, method_openapi, plugin_openapi
+from core.shared import FileLock
+from core.upload import SpooledUpload, spool_upload_file
 
 reserved_plugin_methods = ['load', 'unload', 'activate', 'deactivate', 'logger', 'data_dir', 'fs_write',
-                           'params_validater', 'fetch_data_package', 'methods', 'ConfigUtil',
-                           'save_upload_file_as_temporary', 'keep_temporary_file', 'purge_temporary_files']
+                           'params_validater', 'method_cost', 'fetch_data_package', 'methods', 'ConfigUtil',
+                           'save_upload_file_as_temporary', 'spool_upload_file', 'remove_temporary_file',
+                           'purge_temporary_files']
 
 
 class Plugin:
@@ -27,9 +34,27 @@ class Plugin:
     _logger_name = 'plugin'
     _data_dir = 'data/plugin'
     _temp_dir = 'data/plugin/temp'
+    # 单个上传文件允许的最大字节数，None 表示不限制
+    _max_upload_size = None
+    # 临时目录的字节数与文件存活时间配额，由 TempJanitor 在后台执行，None 表示不限制
+    _temp_max_bytes = None
+    _temp_max_age = 24 * 3600
+    # 方法开销：方法名 -> 固定权重或 callable(params)，未声明的方法开销为 1，按开销从客户端令牌桶扣除
+    _method_costs = {}
+    # 同时执行的调用数上限与排队上限，None 表示不限制
+    _max_concurrency = None
+    _max_queue = 64
+    # params_validater 需要读取的上传文件前缀字节数，设置后由核心读取并以 prefix 参数传入，校验器不再自行读取上传文件
+    _validate_prefix_size = None
+    # 返回文件或流式响应的方法：响应体在请求中发送，不能提交为异步任务或在 /batch 中调用
+    _response_methods = ()
+    # 可通过 GET /call 调用的只读方法，GET 响应可被客户端与代理缓存或预取，不能修改状态或消耗大量资源
+    _get_methods = ()
 
     def __init__(self):
         self.logger = logging.getLogger(self._logger_name)
+        # 正在执行的调用数，热重载时旧实例需等待其归零后才卸载
+        self._in_flight = 0
 
     async def __callmethod__(self, method_name, *args, **kwargs):
         """
@@ -92,117 +117,91 @@ class Plugin:
     def deactivate(self):
         pass
 
-    def methods(self):
+    def methods(self) -> Optional[Dict[str, Dict[str, Param]]]:
         """
-        todo: 2023年3月7日15点30分 该接口尚未实现
-        重写此方法，告知插件管理器插件公开的方法。该接口会覆盖 __getmethods__
+        重写此方法，告知插件管理器插件公开的方法及其参数声明。该接口会覆盖 __getmethods__
+        * 参数声明在插件加载时编译为校验函数与 OpenAPI 文档，调用时先于 params_validater 执行
+        * 无参数的方法声明为空字典
         @see: __getmethods__
-        :return: 方法列表
+        :return: 方法名到参数声明的映射，None 表示通过 __getmethods__ 反射获取
         """
         return None
 
+    def method_cost(self, method_name, params) -> float:
+        """
+        估算一次调用的开销，在参数校验通过后、执行前调用
+        :param method_name: 方法名
+        :param params:      调用参数
+        :return:            开销权重
+        """
+        cost = self._method_costs.get(method_name, 1)
+        if callable(cost):
+            try:
+                cost = cost(params)
+            except Exception as e:
+                self.logger.warning(f'failed to estimate cost of {method_name}: {e}')
+                cost = 1
+        return cost
+
     # todo: params validater
-    def params_validater(self, params):
+    def params_validater(self, params, prefix: bytes = None):
         """
         重写此方法，在调用时验证参数是否合法
         :param params:  待验证的参数
+        :param prefix:  上传文件开头 _validate_prefix_size 个字节，未设置或未上传文件时为 None
         :return:        返回任何非 False 表示参数不合法
         """
         return False
 
-    def fetch_data_package(self, url):
+    def fetch_data_package(self, url, sha256: str = None, file_name: str = None):
         """
-        通过 HTTP GET 下载数据包
-        :param url: 数据包 URL
-        :return:    None
+        获取并解压数据包，优先使用本地缓存与离线数据包目录
+        :param url:         数据包 URL
+        :param sha256:      期望的 SHA-256，None 时使用首次获取时记录的值
+        :param file_name:   数据包文件名，默认从 URL 推断
+        :return:            解压目录
         """
-        try:
-            req = requests.get(url, stream=True, timeout=10)
-        except Exception as e:
-            self.logger.error(f'failed to fetch data package: {e}')
-            return
-        if req.status_code == 200:
-            try:
-                disposition = req.headers.get('content-disposition', '')
-                matches = re.findall('filename=\"(.+)\"', disposition)
-                file_name = matches[0] if len(matches) > 0 else url.split('/')[-1].split('?')[0]
-                file_size = int(req.headers.get('content-length', 0))
-                file_save_path = os.path.join(self._data_dir, file_name)
-                if os.path.exists(file_save_path):
-                    self.logger.info(f'\033[1;32mpackage already exists: {file_name}\033[0m')
-                else:
-                    self.logger.info(f'\033[1;32mdownloading package: {file_name} ...\033[0m')
-                    time.sleep(0.1)
-                    with open(file_save_path, 'wb+') as f, tqdm(
-                            desc=file_name,
-                            total=file_size,
-                            unit='iB',
-                            unit_scale=True,
-                            unit_divisor=1024,
-                            leave=False,
-                            smoothing=0.1
-                    ) as progress_bar:
-                        for chunk in req.iter_content(chunk_size=1024):
-                            if chunk:
-                                progress_bar.update(f.write(chunk))
-                        f.close()
-                try:
-                    patoolib.extract_archive(
-                        file_save_path,
-                        outdir=os.path.join(
-                            self._data_dir,
-                            os.path.splitext(os.path.basename(file_save_path))[0]
-                        ),
-                        verbosity=-1,
-                        interactive=False
-                    )
-                    # self.logger.info(f'\033[1;32m- extracted package: {file_name}\033[0m')
-                except patoolib.util.PatoolError as e:
-                    if zipfile.is_zipfile(file_save_path):
-                        with zipfile.ZipFile(file_save_path, 'r') as zip_file:
-                            extract_folder = os.path.join(
-                                self._data_dir,
-                                os.path.splitext(os.path.basename(file_save_path))[0],
-                            )
-                            # zip_file.extractall(extract_folder)
-                            for member in zip_file.namelist():
-                                target_path = os.path.join(extract_folder, member)
-                                if os.path.exists(target_path):
-                                    os.remove(target_path)
-                                zip_file.extract(member, path=extract_folder)
-                    else:
-                        pass
-                except Exception as e:
-                    self.logger.error(f'failed to extract data package: {e}', exc_info=True)
-            except Exception as e:
-                self.logger.error(f'failed to fetch data package: {e}', exc_info=True)
-                PluginManager().unload_plugin(self._plugin_name, crash=True)
-        else:
-            self.logger.error(f'failed to retrieve data package info from {url}')
-            PluginManager().unload_plugin(self._plugin_name, crash=True)
+        store = PackageStore()
+        package_path = store.fetch(url, file_name=file_name, sha256=sha256, search_dirs=[self._data_dir])
+        return store.extract(package_path, self._data_dir)
 
-    async def save_upload_file_as_temporary(self, file: UploadFile, sub_dir: str = ''):
-        origin_name = file.filename
-        origin_basename, origin_ext = os.path.splitext(origin_name)
-        temporal_name = f'{origin_basename}_{hashlib.md5(str(time.time()).encode()).hexdigest()[:6]}{origin_ext}'
-        file_content = await file.read()
+    async def spool_upload_file(self, file: UploadFile, sub_dir: str = '') -> SpooledUpload:
+        """
+        将上传文件分块写入插件临时目录，受 _max_upload_size 限制
+        :param file:    上传的文件
+        :param sub_dir: 临时目录下的子目录
+        :return:        保存路径、文件大小与 SHA-256
+        """
+        origin_basename, origin_ext = os.path.splitext(os.path.basename(file.filename or 'upload'))
+        temporal_name = f'{origin_basename}_{uuid.uuid4().hex[:8]}{origin_ext}'
         file_save_path = os.path.join(self._temp_dir, sub_dir, temporal_name)
-        file_save_dir = os.path.dirname(file_save_path)
-        if not os.path.exists(file_save_dir):
-            os.makedirs(file_save_dir)
-        with open(file_save_path, 'wb') as f:
-            f.write(file_content)
-        return file_save_path, file_save_dir
-
-    def keep_temporary_file(self, keep_count: int = 10):
-        if len(os.listdir(self._temp_dir)) > keep_count:
-            files = os.listdir(self._temp_dir)
-            files.sort(key=lambda fn: os.path.getmtime(os.path.join(self._temp_dir, fn)))
-            os.remove(os.path.join(self._temp_dir, files[0]))
+        upload = await spool_upload_file(file, file_save_path, self._max_upload_size)
+        TempJanitor().track(self._plugin_name, upload.path, upload.size)
+        plugin_upload_bytes.inc(upload.size, plugin=self._plugin_name)
+        return upload
+
+    async def save_upload_file_as_temporary(self, file: UploadFile, sub_dir: str = ''):
+        upload = await self.spool_upload_file(file, sub_dir)
+        return upload.path, os.path.dirname(upload.path)
+
+    def remove_temporary_file(self, path: str):
+        """
+        删除插件临时目录中的文件或目录，并取消其在 TempJanitor 中的登记
+        :param path:    文件或目录路径，不存在时忽略
+        """
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        TempJanitor().untrack(self._plugin_name, path)
 
     def purge_temporary_files(self):
         shutil.rmtree(self._temp_dir)
         os.mkdir(self._temp_dir)
+        TempJanitor().untrack(self._plugin_name, self._temp_dir)
 
     def fs_write(self, filename, content):
         file_path = os.path.join(self._data_dir, filename)
@@ -217,40 +216,130 @@ class Plugin:
         return self._data_dir
 
     class ConfigUtil:
+        # 待写入操作中表示删除键的标记
+        _DELETED = object()
+
         def __init__(self, data_dir: str, cfg_name: str = 'config.json', default_cfg=None):
+            """
+            :param data_dir:    配置文件所在目录
+            :param cfg_name:    配置文件名
+            :param default_cfg: 配置文件不存在时写入的默认配置
+            """
             self.default_cfg = default_cfg
             if self.default_cfg is None:
                 self.default_cfg = {}
             self.cfg_path = os.path.join(data_dir, cfg_name)
+            # 多个 worker 进程共享同一配置文件，写入前需加锁并重新读取
+            self.lock = FileLock(f'{self.cfg_path}.lock')
+            self.mtime = None
+            # 当前事务中尚未写入文件的修改：key -> value 或 _DELETED
+            self.pending = {}
+            self.depth = 0
             self.cfg = self.read_cfg()
 
         def read_cfg(self):
-            if not os.path.exists(self.cfg_path):
-                with open(self.cfg_path, 'w', encoding='utf-8') as f:
-                    f.write(json.dumps(self.default_cfg))
-            with open(self.cfg_path, 'r', encoding='utf-8') as f:
-                cfg = json.load(f)
+            with self.lock:
+                if not os.path.exists(self.cfg_path):
+                    self.write_file(self.default_cfg)
+                with open(self.cfg_path, 'r', encoding='utf-8') as f:
+                    cfg = json.load(f)
+                self.mtime = os.stat(self.cfg_path).st_mtime_ns
+                # keep changes of the open transaction on top of what is on disk
+                for key, value in self.pending.items():
+                    if value is self._DELETED:
+                        cfg.pop(key, None)
+                    else:
+                        cfg[key] = value
             return cfg
 
+        def reload_if_changed(self):
+            try:
+                mtime = os.stat(self.cfg_path).st_mtime_ns
+            except FileNotFoundError:
+                return False
+            if mtime == self.mtime:
+                return False
+            self.cfg = self.read_cfg()
+            return True
+
+        @contextmanager
+        def transaction(self):
+            """
+            在跨进程锁内读取最新配置并合并多次修改，退出最外层事务时在释放锁前写入一次
+            * 加锁与写入会阻塞，在事件循环中应通过 asyncio.to_thread 执行
+            """
+            with self.lock:
+                if self.depth == 0:
+                    self.reload_if_changed()
+                self.depth += 1
+                try:
+                    yield self
+                finally:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        self.flush()
+
+        def flush(self):
+            """
+            将待写入的修改合并到磁盘上的最新配置并原子写入
+            """
+            with self.lock:
+                if not self.pending:
+                    return
+                self.reload_if_changed()
+                self.write_file(self.cfg, indent=4)
+                self.pending.clear()
+
+        def write_file(self, cfg, indent=None):
+            temp_path = f'{self.cfg_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(cfg, f, indent=indent)
+            os.replace(temp_path, self.cfg_path)
+            self.mtime = os.stat(self.cfg_path).st_mtime_ns
+
         def write_cfg(self):
-            with open(self.cfg_path, 'w', encoding='utf-8') as f:
-                json.dump(self.cfg, f, indent=4)
+            with self.transaction():
+                self.pending.update(self.cfg)
 
         def get_cfg(self, key, default=None):
+            self.reload_if_changed()
             return self.cfg.get(key, default)
 
         def set_cfg(self, key, value):
-            self.cfg[key] = value
-            self.write_cfg()
+            with self.transaction():
+                self.cfg[key] = value
+                self.pending[key] = value
 
         def del_cfg(self, key):
-            self.cfg.pop(key)
-            self.write_cfg()
+            with self.transaction():
+                self.cfg.pop(key)
+                self.pending[key] = self._DELETED
 
         def get_all_cfg(self):
+            self.reload_if_changed()
             return self.cfg
 
 
+class PluginMethod(NamedTuple):
+    """
+    插件方法调度表项，在插件加载/激活时预先生成，避免每次调用时反射
+    """
+    name: str
+    func: Callable
+    args: List[str]
+    is_coroutine: bool
+    plugin: 'Plugin' = None
+    # 由 Plugin.methods() 的参数声明编译得到，未声明时为 None
+    validator: Optional[Callable] = None
+    openapi: Optional[dict] = None
+    returns_response: bool = False
+    allow_get: bool = False
+
+    @property
+    def arity(self):
+        return len(self.args)
+
+
 @singleton
 class PluginManager:
 
@@ -263,49 +352,287 @@ class PluginManager:
         os.path.exists(self.plugin_dir) or os.mkdir(self.plugin_dir)
 
         self.plugins = {}
+        # 已发现但尚未加载完成的插件
+        self.loading = {}
+        # 插件模块文件的修改时间，用于检测变更并热重载
+        self.module_mtimes = {}
+        self.reload_lock = None
+        # 热重载后等待旧实例调用结束的最长秒数
+        self.drain_timeout = 300
+        self.retiring = set()
+        self.dispatch: Dict[str, Dict[str, PluginMethod]] = {}
+
+    def build_dispatch(self, plugin_name, plugin: 'Plugin' = None):
+        """
+        为插件生成方法调度表
+        :param plugin_name: 插件名
+        :param plugin:      插件实例，默认为已发布的实例；尚未发布的实例需先生成调度表再发布
+        :return:            方法名到调度表项的映射
+        """
+        plugin = plugin or self.plugins[plugin_name]
+        schemas = plugin.methods()
+        if schemas is None:
+            methods = plugin.__getmethods__()
+        else:
+            methods = {}
+            for method_name in schemas:
+                if method_name.startswith('_') or method_name in reserved_plugin_methods:
+                    raise AttributeError(f'cannot expose reserved method \'{method_name}\'')
+                args = inspect.getfullargspec(getattr(plugin, method_name)).args
+                methods[method_name] = [arg for arg in args if arg != 'self']
+        # the table is rebuilt on activation, schemas of the same instance are compiled only once
+        previous = self.dispatch.get(plugin_name, {})
+        table = {}
+        for method_name, args in methods.items():
+            func = getattr(plugin, method_name)
+            validator, openapi = None, None
+            cached = previous.get(method_name)
+            if cached is not None and cached.plugin is plugin:
+                validator, openapi = cached.validator, cached.openapi
+            elif schemas is not None:
+                validator = compile_params(schemas[method_name])
+                openapi = method_openapi(method_name, schemas[method_name], inspect.getdoc(func))
+            table[method_name] = PluginMethod(
+                name=method_name,
+                func=func,
+                args=args,
+                is_coroutine=inspect.iscoroutinefunction(func),
+                plugin=plugin,
+                validator=validator,
+                openapi=openapi,
+                returns_response=method_name in plugin._response_methods,
+                allow_get=method_name in plugin._get_methods
+            )
+        self.dispatch[plugin_name] = table
+        return table
+
+    def get_plugin_methods(self, plugin_name):
+        """
+        获取插件公开的方法及其参数列表
+        :param plugin_name: 插件名
+        :return:            方法名到参数列表的映射
+        """
+        if plugin_name not in self.dispatch:
+            raise AttributeError(f'\'{plugin_name}\' is not a plugin')
+        return {name: entry.args for name, entry in self.dispatch[plugin_name].items()}
+
+    def get_method(self, plugin_name, method_name) -> Optional[PluginMethod]:
+        return self.dispatch.get(plugin_name, {}).get(method_name)
 
-    def load_plugins(self):
-        for plugin_file in os.listdir(self.plugin_dir):
+    def get_method_validator(self, plugin_name, method_name) -> Optional[Callable]:
+        entry = self.get_method(plugin_name, method_name)
+        return entry.validator if entry is not None else None
+
+    def openapi_paths(self):
+        """
+        已加载插件的 OpenAPI 路径项，每个声明了参数的插件一个 /call/{plugin} 操作
+        """
+        paths = {}
+        for plugin_name, table in list(self.dispatch.items()):
+            methods = {name: entry.openapi for name, entry in table.items() if entry.openapi is not None}
+            if methods:
+                paths[f'/call/{plugin_name}'] = plugin_openapi(plugin_name, methods)
+        return paths
+
+    def discover_plugins(self):
+        """
+        导入插件模块并实例化插件类，待 load_plugins 加载
+        :return: 插件名到插件实例的映射
+        """
+        for plugin_file in sorted(os.listdir(self.plugin_dir)):
             if plugin_file.endswith('.py'):
                 plugin_name = os.path.splitext(plugin_file)[0]
-                self.logger.info(f'load plugin: \033[1;33m{plugin_name}\033[0m')
-                plugin_module = importlib.import_module(f'{self.plugin_dir}.{plugin_name}')
-                if hasattr(plugin_module, plugin_name.capitalize()):
-                    plugin_class = getattr(plugin_module, plugin_name.capitalize())
-                    # Assign plugin name and logger name
-                    setattr(plugin_class, '_logger_name', f'plugin.{plugin_name}')
-                    setattr(plugin_class, '_plugin_name', plugin_name)
-                    # Assign a data directory and create it if not exists
-                    setattr(plugin_class, '_data_dir', os.path.abspath(f'data/{plugin_name.lower()}'))
-                    os.path.exists(getattr(plugin_class, '_data_dir')) or os.mkdir(getattr(plugin_class, '_data_dir'))
-                    setattr(plugin_class, '_temp_dir', os.path.join(getattr(plugin_class, '_data_dir'), 'temp'))
-                    os.path.exists(getattr(plugin_class, '_temp_dir')) or os.mkdir(getattr(plugin_class, '_temp_dir'))
-                    plugin = plugin_class()
-                    try:
-                        plugin.load()
-                    except NotImplementedError:
-                        self.logger.error(f'plugin \'{plugin_name}\' does not implement load method')
-                        continue
-                    except Exception as e:
-                        self.logger.error(f'plugin \'{plugin_name}\' failed to load: {e}')
-                        continue
-                    self.plugins[plugin_name] = plugin
-                else:
-                    self.logger.error(f'plugin \'{plugin_name}\' has no class \'{plugin_name.capitalize()}\'')
+                if plugin_name in self.plugins or plugin_name in self.loading:
                     continue
+                self.module_mtimes[plugin_name] = self.module_mtime(plugin_name)
+                plugin = self.instantiate_plugin(plugin_name)
+                if plugin is not None:
+                    self.loading[plugin_name] = plugin
+        return self.loading
+
+    def module_mtime(self, plugin_name):
+        try:
+            return os.stat(os.path.join(self.plugin_dir, f'{plugin_name}.py')).st_mtime_ns
+        except OSError:
+            return None
+
+    def instantiate_plugin(self, plugin_name, reload: bool = False):
+        """
+        导入（或重新导入）插件模块并实例化插件类
+        :param plugin_name: 插件名
+        :param reload:      是否重新执行已导入的模块
+        :return:            插件实例，模块中没有插件类时返回 None
+        """
+        module_name = f'{self.plugin_dir}.{plugin_name}'
+        if reload and module_name in sys.modules:
+            importlib.invalidate_caches()
+            plugin_module = importlib.reload(sys.modules[module_name])
+        else:
+            plugin_module = importlib.import_module(module_name)
+        if not hasattr(plugin_module, plugin_name.capitalize()):
+            self.logger.error(f'plugin \'{plugin_name}\' has no class \'{plugin_name.capitalize()}\'')
+            return None
+        plugin_class = getattr(plugin_module, plugin_name.capitalize())
+        # Assign plugin name and logger name
+        setattr(plugin_class, '_logger_name', f'plugin.{plugin_name}')
+        setattr(plugin_class, '_plugin_name', plugin_name)
+        # Assign a data directory and create it if not exists
+        setattr(plugin_class, '_data_dir', os.path.abspath(f'data/{plugin_name.lower()}'))
+        os.path.exists(getattr(plugin_class, '_data_dir')) or os.mkdir(getattr(plugin_class, '_data_dir'))
+        setattr(plugin_class, '_temp_dir', os.path.join(getattr(plugin_class, '_data_dir'), 'temp'))
+        os.path.exists(getattr(plugin_class, '_temp_dir')) or os.mkdir(getattr(plugin_class, '_temp_dir'))
+        TempJanitor().register(plugin_name, getattr(plugin_class, '_temp_dir'),
+                               max_bytes=getattr(plugin_class, '_temp_max_bytes'),
+                               max_age=getattr(plugin_class, '_temp_max_age'))
+        return plugin_class()
+
+    def load_plugins(self, activate: bool = False, max_workers: int = None):
+        """
+        并行加载所有插件，数据包的下载与解压互不阻塞
+        :param activate:    加载完成后立即激活插件，使其不必等待其他插件即可提供服务
+        :param max_workers: 同时加载的插件数，默认全部并行
+        """
+        if not self.loading:
+            self.discover_plugins()
+        pending = list(self.loading.items())
+        if not pending:
+            return
+        with ThreadPoolExecutor(max_workers=max_workers or len(pending), thread_name_prefix='plugin-loader') as executor:
+            list(executor.map(lambda item: self.load_plugin(*item, activate=activate), pending))
+
+    def load_plugin(self, plugin_name, plugin, activate: bool = False):
+        self.logger.info(f'load plugin: \033[1;33m{plugin_name}\033[0m')
+        try:
+            if not self.prepare_plugin(plugin_name, plugin, activate):
+                return False
+            # runs in a loader thread while requests are served: the dispatch table first, then the plugin,
+            # and only then the plugin stops being 'loading', so a request never sees a half published plugin
+            self.build_dispatch(plugin_name, plugin)
+            self.plugins[plugin_name] = plugin
+        finally:
+            self.loading.pop(plugin_name, None)
+        return True
+
+    def prepare_plugin(self, plugin_name, plugin, activate: bool = False):
+        """
+        调用插件的 load（以及 activate），失败时记录日志
+        :return: 是否成功
+        """
+        try:
+            # 多个 worker 进程同时启动时，同一插件的数据包只需准备一次
+            with FileLock(os.path.join(self.data_dir, f'.{plugin_name}.lock')):
+                plugin.load()
+            if activate:
+                plugin.activate()
+        except NotImplementedError:
+            self.logger.error(f'plugin \'{plugin_name}\' does not implement load method')
+            return False
+        except Exception as e:
+            self.logger.error(f'plugin \'{plugin_name}\' failed to load: {e}')
+            return False
+        return True
+
+    async def reload_plugin(self, plugin_name):
+        """
+        热重载插件：重新导入模块并在旧实例旁加载新实例，新调用切换到新实例，旧实例在调用结束后卸载
+        :param plugin_name: 插件名
+        :return:            是否成功
+        """
+        if self.reload_lock is None:
+            self.reload_lock = asyncio.Lock()
+        async with self.reload_lock:
+            self.logger.info(f'reload plugin: \033[1;33m{plugin_name}\033[0m')
+            self.module_mtimes[plugin_name] = self.module_mtime(plugin_name)
+            try:
+                plugin = self.instantiate_plugin(plugin_name, reload=True)
+            except Exception as e:
+                self.logger.error(f'plugin \'{plugin_name}\' failed to reload: {e}', exc_info=True)
+                return False
+            if plugin is None or not await asyncio.to_thread(self.prepare_plugin, plugin_name, plugin, True):
+                # keep serving with the old instance
+                return False
+            old_plugin = self.plugins.get(plugin_name)
+            self.build_dispatch(plugin_name, plugin)
+            self.plugins[plugin_name] = plugin
+        if old_plugin is not None:
+            task = asyncio.create_task(self.retire_plugin(plugin_name, old_plugin))
+            self.retiring.add(task)
+            task.add_done_callback(self.retiring.discard)
+        return True
+
+    async def retire_plugin(self, plugin_name, plugin, poll_interval: float = 0.1):
+        """
+        等待旧实例上的调用全部结束（最多 drain_timeout 秒）后停用并卸载
+        """
+        deadline = time.time() + self.drain_timeout
+        while plugin._in_flight > 0 and time.time() < deadline:
+            await asyncio.sleep(poll_interval)
+        if plugin._in_flight > 0:
+            self.logger.warning(f'plugin \'{plugin_name}\' still has {plugin._in_flight} call(s) after '
+                                f'{self.drain_timeout}s, unloading anyway')
+        try:
+            await asyncio.to_thread(plugin.deactivate)
+            await asyncio.to_thread(plugin.unload)
+        except Exception as e:
+            self.logger.error(f'failed to unload old instance of \'{plugin_name}\': {e}', exc_info=True)
+        self.logger.info(f'retired old instance of \'{plugin_name}\'')
+
+    def changed_plugins(self):
+        """
+        比较插件目录中模块文件的修改时间
+        :return: 新增或修改的插件名列表，已删除的插件名列表
+        """
+        names = {os.path.splitext(f)[0] for f in os.listdir(self.plugin_dir) if f.endswith('.py')}
+        changed = [name for name in sorted(names)
+                   if name not in self.loading and self.module_mtimes.get(name) != self.module_mtime(name)]
+        removed = [name for name in list(self.plugins) if name not in names]
+        return changed, removed
+
+    async def watch_plugins(self, interval: float = 2.0):
+        """
+        轮询插件目录，自动热重载修改过的插件、加载新插件、卸载已删除的插件
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                changed, removed = await asyncio.to_thread(self.changed_plugins)
+                for plugin_name in changed:
+                    await self.reload_plugin(plugin_name)
+                for plugin_name in removed:
+                    plugin = self.plugins.pop(plugin_name)
+                    self.dispatch.pop(plugin_name, None)
+                    self.module_mtimes.pop(plugin_name, None)
+                    await self.retire_plugin(plugin_name, plugin)
+                    TempJanitor().unregister(plugin_name)
+            except Exception as e:
+                self.logger.error(f'failed to watch plugins: {e}', exc_info=True)
 
     async def call_plugin_method(self, plugin_name, method_name, *args, **kwargs):
-        if plugin_name not in self.plugins:
+        if plugin_name not in self.dispatch:
             raise AttributeError(f'\'{plugin_name}\' is not a plugin')
-        plugin = self.plugins[plugin_name]
-        if method_name not in plugin.__getmethods__():
+        entry = self.dispatch[plugin_name].get(method_name)
+        if entry is None:
             raise AttributeError(f'Plugin \'{plugin_name}\' has no method \'{method_name}\'')
-        if len(plugin.__getmethods__()[method_name]) == 0:
-            return await plugin.__callmethod__(method_name)
-        if len(plugin.__getmethods__()[method_name]) != len(args):
-            raise AttributeError(f'\'{method_name}\' takes {len(plugin.__getmethods__()[method_name])} arguments '
-                                 f'({len(args)} given)')
-        return await plugin.__callmethod__(method_name, *args, **kwargs)
+        if entry.arity == 0:
+            args, kwargs = (), {}
+        elif entry.arity != len(args):
+            raise AttributeError(f'\'{method_name}\' takes {entry.arity} arguments ({len(args)} given)')
+        plugin_calls.inc(plugin=plugin_name, method=method_name)
+        plugin_calls_in_flight.inc(plugin=plugin_name, method=method_name)
+        # the entry pins the instance it was built for, a reload does not switch a running call
+        entry.plugin._in_flight += 1
+        t1 = time.perf_counter()
+        try:
+            if entry.is_coroutine:
+                return await entry.func(*args, **kwargs)
+            return entry.func(*args, **kwargs)
+        except Exception as e:
+            plugin_call_errors.inc(plugin=plugin_name, method=method_name, code=getattr(e, 'status_code', 500))
+            raise
+        finally:
+            entry.plugin._in_flight -= 1
+            plugin_calls_in_flight.dec(plugin=plugin_name, method=method_name)
+            plugin_call_duration.observe(time.perf_counter() - t1, plugin=plugin_name, method=method_name)
 
     def get_plugin_logger(self, plugin_name):
         if plugin_name not in self.plugins:
@@ -316,7 +643,7 @@ class PluginManager:
         return logging.getLogger(f'plug_mgr:{plugin_name}')
 
     def unload_plugins(self):
-        for plugin_name, plugin in self.plugins.items():
+        for plugin_name, plugin in list(self.plugins.items()):
             plugin.unload()
 
     def unload_plugin(self, plugin_name, crash=False):
@@ -324,14 +651,18 @@ class PluginManager:
             raise AttributeError(f'\'{plugin_name}\' is not a plugin or never loaded')
         self.plugins[plugin_name].unload()
         self.plugins.pop(plugin_name)
+        self.dispatch.pop(plugin_name, None)
+        TempJanitor().unregister(plugin_name)
         self.logger.info(f'unload plugin: \033[1;31m{plugin_name}\033[0m{" caused by crash" if crash else ""}')
 
     def activate_plugins(self):
-        for plugin in list(self.plugins.values()):
+        for plugin_name, plugin in list(self.plugins.items()):
             plugin.activate()
+            if plugin_name in self.plugins:
+                self.build_dispatch(plugin_name)
         # for plugin_name, plugin in self.plugins.items():
         #     plugin.activate()
 
     def deactivate_plugins(self):
-        for plugin_name, plugin in self.plugins.items():
+        for plugin_name, plugin in list(self.plugins.items()):
             plugin.deactivate()
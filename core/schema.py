@@ -0,0 +1,218 @@
+import re
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+from starlette.datastructures import UploadFile
+
+from core.upload import UploadView
+
+# 参数类型到 OpenAPI 类型的映射
+OPENAPI_TYPES = {
+    str: {'type': 'string'},
+    int: {'type': 'integer'},
+    float: {'type': 'number'},
+    bool: {'type': 'boolean'},
+    list: {'type': 'array', 'items': {}},
+    dict: {'type': 'object'},
+    UploadFile: {'type': 'string', 'format': 'binary'},
+}
+
+
+class Param:
+    """
+    插件方法参数声明，由 Plugin.methods() 返回，插件加载时编译为校验函数
+    """
+
+    def __init__(self, type_: type = str, required: bool = True, default=None, minimum: float = None,
+                 maximum: float = None, min_length: int = None, max_length: int = None, pattern: str = None,
+                 choices: Sequence = None, description: str = ''):
+        """
+        :param type_:       参数类型：str、int、float、bool、list、dict 或 UploadFile
+        :param required:    是否必填，缺省或为空字符串视为未填写
+        :param default:     未填写时的默认值，会写回参数
+        :param minimum:     数值下限（含）
+        :param maximum:     数值上限（含）
+        :param min_length:  字符串或列表的最小长度
+        :param max_length:  字符串或列表的最大长度
+        :param pattern:     字符串需完整匹配的正则表达式
+        :param choices:     可选值
+        :param description: 参数说明，用于 OpenAPI 文档
+        """
+        if isinstance(type_, type) and issubclass(type_, UploadFile):
+            # fastapi.UploadFile subclasses the starlette one
+            type_ = UploadFile
+        if type_ not in OPENAPI_TYPES:
+            raise TypeError(f'unsupported param type {type_!r}')
+        self.type = type_
+        self.required = required and default is None
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+        self.min_length = min_length
+        self.max_length = max_length
+        self.pattern = pattern
+        self.choices = tuple(choices) if choices is not None else None
+        self.description = description
+
+    def compile(self) -> Callable:
+        """
+        编译为单个校验函数，只包含声明了的检查
+        :return: 接收参数值，返回 (错误信息或 None, 转换后的值)
+        """
+        checks: List[Callable] = []
+        if self.type in (int, float):
+            numeric = self.type
+
+            def convert(value):
+                # JSON args may carry numbers as strings, int() also rejects floats like 1.5
+                if isinstance(value, bool):
+                    raise ValueError
+                if numeric is int and isinstance(value, float):
+                    raise ValueError
+                return numeric(value)
+        elif self.type is UploadFile:
+            def convert(value):
+                if not isinstance(value, (UploadFile, UploadView)):
+                    raise ValueError
+                return value
+        else:
+            expected = self.type
+
+            def convert(value):
+                if not isinstance(value, expected):
+                    raise ValueError
+                return value
+        type_error = f'must be {OPENAPI_TYPES[self.type]["type"]}' if self.type is not UploadFile \
+            else 'must be a file'
+        if self.minimum is not None:
+            minimum = self.minimum
+            checks.append(lambda v: None if v >= minimum else f'must be >= {minimum}')
+        if self.maximum is not None:
+            maximum = self.maximum
+            checks.append(lambda v: None if v <= maximum else f'must be <= {maximum}')
+        if self.min_length is not None:
+            min_length = self.min_length
+            checks.append(lambda v: None if len(v) >= min_length else f'is shorter than {min_length}')
+        if self.max_length is not None:
+            max_length = self.max_length
+            checks.append(lambda v: None if len(v) <= max_length else f'is longer than {max_length}')
+        if self.pattern is not None:
+            regex = re.compile(self.pattern)
+            checks.append(lambda v: None if regex.fullmatch(v) else 'is malformed')
+        if self.choices is not None:
+            choices = self.choices
+            checks.append(lambda v: None if v in choices else f'must be one of {", ".join(map(str, choices))}')
+
+        def check(value):
+            try:
+                value = convert(value)
+            except (TypeError, ValueError):
+                return type_error, value
+            for rule in checks:
+                error = rule(value)
+                if error is not None:
+                    return error, value
+            return None, value
+
+        return check
+
+    def openapi(self) -> dict:
+        schema = dict(OPENAPI_TYPES[self.type])
+        for key, value in (('minimum', self.minimum), ('maximum', self.maximum), ('pattern', self.pattern),
+                           ('default', self.default), ('description', self.description or None)):
+            if value is not None:
+                schema[key] = value
+        if self.min_length is not None:
+            schema['minItems' if self.type is list else 'minLength'] = self.min_length
+        if self.max_length is not None:
+            schema['maxItems' if self.type is list else 'maxLength'] = self.max_length
+        if self.choices is not None:
+            schema['enum'] = list(self.choices)
+        return schema
+
+
+def compile_params(params: Dict[str, Param]) -> Callable[[dict], Union[str, bool]]:
+    """
+    将方法的参数声明编译为校验函数，每个参数的检查在编译时确定，调用时只做一遍检查
+    * 校验通过时会写入默认值与类型转换后的值
+    :param params:  参数名到参数声明的映射
+    :return:        与 params_validater 相同约定的校验函数：返回 False 表示通过，否则为错误信息
+    """
+    compiled = [(name, param.required, param.default, param.compile()) for name, param in params.items()]
+
+    def validate(values: dict):
+        for name, required, default, check in compiled:
+            value = values.get(name)
+            if value is None or value == '':
+                if required:
+                    return f'{name} is required'
+                if default is not None:
+                    values[name] = default
+                continue
+            error, value = check(value)
+            if error is not None:
+                return f'{name} {error}'
+            values[name] = value
+        return False
+
+    return validate
+
+
+def method_openapi(method_name: str, params: Dict[str, Param], description: Optional[str] = None) -> dict:
+    """
+    生成插件方法的 multipart 请求体 schema：args 为 JSON 表单字段，文件参数为同名文件字段
+    """
+    args = {name: param.openapi() for name, param in params.items() if param.type is not UploadFile}
+    files = {name: param.openapi() for name, param in params.items() if param.type is UploadFile}
+    properties = {}
+    required = [name for name in files if params[name].required]
+    if args:
+        properties['args'] = {
+            'type': 'object',
+            'properties': args,
+            'required': [name for name in args if params[name].required],
+        }
+        if not properties['args']['required']:
+            del properties['args']['required']
+        else:
+            required.insert(0, 'args')
+    properties.update(files)
+    schema = {'title': method_name, 'type': 'object', 'properties': properties}
+    if required:
+        schema['required'] = required
+    if description:
+        schema['description'] = description
+    return schema
+
+
+def plugin_openapi(plugin_name: str, methods: Dict[str, dict]) -> dict:
+    """
+    生成插件的 OpenAPI 路径项：一个 POST /call/{plugin} 操作，method 查询参数的可选值为声明了参数的方法
+    :param plugin_name: 插件名
+    :param methods:     方法名到 method_openapi 生成的请求体 schema 的映射
+    """
+    schemas = [methods[name] for name in sorted(methods)]
+    description = '\n'.join(f'* `{schema["title"]}`: {schema.get("description", "").splitlines()[0]}'
+                            if schema.get('description') else f'* `{schema["title"]}`' for schema in schemas)
+    return {
+        'post': {
+            'tags': [plugin_name],
+            'summary': f'Call {plugin_name}',
+            'description': f'Request body matches the schema titled with `method`.\n\n{description}',
+            'operationId': f'call_{plugin_name}',
+            'parameters': [
+                {'name': 'method', 'in': 'query', 'required': True,
+                 'schema': {'type': 'string', 'enum': sorted(methods)}},
+                {'name': 'async', 'in': 'query', 'required': False,
+                 'schema': {'type': 'boolean', 'default': False}},
+            ],
+            'requestBody': {'content': {'multipart/form-data': {
+                'schema': schemas[0] if len(schemas) == 1 else {'anyOf': schemas},
+                'encoding': {'args': {'contentType': 'application/json'}},
+            }}},
+            'responses': {
+                '200': {'description': 'Successful Response'},
+                '400': {'description': 'Invalid params'},
+                '429': {'description': 'Rate limit exceeded'},
+            },
+        }
+    }
@@ -0,0 +1,199 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from limits.storage import Storage
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class FileLock:
+    """
+    跨进程文件锁（可重入）
+    * Windows 下没有 fcntl，仅在进程内加锁
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.fd = None
+
+    def acquire(self):
+        self.thread_lock.acquire()
+        if self.depth == 0 and fcntl is not None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0 and self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        self.thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+def connect_shared_db(path: str):
+    """
+    打开多进程共享的 SQLite 数据库
+    :param path:    数据库文件路径
+    :return:        连接
+    """
+    os.path.exists(os.path.dirname(path)) or os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+class SQLiteStorage(Storage):
+    """
+    基于 SQLite 的限流计数存储，供多个 worker 进程共享
+    * 用法: Limiter(storage_uri='sqlite:///abs/path/to/shared.db')
+    """
+
+    STORAGE_SCHEME = ['sqlite']
+
+    def __init__(self, uri: Optional[str] = None, **options):
+        super().__init__(uri, **options)
+        self.conn = connect_shared_db(uri[len('sqlite://'):])
+        self.conn.execute('CREATE TABLE IF NOT EXISTS rate_limits '
+                          '(key TEXT PRIMARY KEY, count INTEGER NOT NULL, expiry REAL NOT NULL)')
+
+    def incr(self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1) -> int:
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT count, expiry FROM rate_limits WHERE key = ?', (key,)).fetchone()
+                if row is None or row[1] <= now:
+                    count, expires_at = amount, now + expiry
+                else:
+                    count, expires_at = row[0] + amount, now + expiry if elastic_expiry else row[1]
+                self.conn.execute('INSERT OR REPLACE INTO rate_limits (key, count, expiry) VALUES (?, ?, ?)',
+                                  (key, count, expires_at))
+                self.conn.execute('DELETE FROM rate_limits WHERE expiry <= ?', (now,))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return count
+
+    def get(self, key: str) -> int:
+        with self.lock:
+            row = self.conn.execute('SELECT count FROM rate_limits WHERE key = ? AND expiry > ?',
+                                    (key, time.time())).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key: str) -> int:
+        with self.lock:
+            row = self.conn.execute('SELECT expiry FROM rate_limits WHERE key = ?', (key,)).fetchone()
+        return int(row[0]) if row else int(time.time())
+
+    def check(self) -> bool:
+        try:
+            with self.lock:
+                self.conn.execute('SELECT 1')
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self) -> Optional[int]:
+        with self.lock:
+            return self.conn.execute('DELETE FROM rate_limits').rowcount
+
+    def clear(self, key: str) -> None:
+        with self.lock:
+            self.conn.execute('DELETE FROM rate_limits WHERE key = ?', (key,))
+
+
+class SharedJobStore:
+    """
+    任务记录的 SQLite 存储，使任意 worker 都能查询其他 worker 上的任务
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.RLock()
+        self.conn = connect_shared_db(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS jobs '
+                          '(id TEXT PRIMARY KEY, record TEXT NOT NULL, updated REAL NOT NULL)')
+
+    def save(self, job_id: str, record: dict):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO jobs (id, record, updated) VALUES (?, ?, ?)',
+                              (job_id, json.dumps(record, ensure_ascii=False), time.time()))
+
+    def load(self, job_id: str) -> Optional[dict]:
+        with self.lock:
+            row = self.conn.execute('SELECT record FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete(self, job_id: str):
+        with self.lock:
+            self.conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def purge(self, before: float):
+        with self.lock:
+            self.conn.execute('DELETE FROM jobs WHERE updated < ?', (before,))
+
+
+class SharedTokenBuckets:
+    """
+    加权令牌桶的 SQLite 存储，与 core.admission.TokenBuckets 接口一致，供多个 worker 进程共享
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.RLock()
+        self.conn = connect_shared_db(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS token_buckets '
+                          '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    def take(self, key: str, cost: float, capacity: float, refill_rate: float) -> float:
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT tokens, updated FROM token_buckets WHERE key = ?', (key,)).fetchone()
+                tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * refill_rate)
+                wait = 0 if tokens >= cost else (cost - tokens) / refill_rate
+                if wait == 0:
+                    tokens -= cost
+                self.conn.execute('INSERT OR REPLACE INTO token_buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                                  (key, tokens, now))
+                self.conn.execute('DELETE FROM token_buckets WHERE updated < ?', (now - capacity / refill_rate,))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+        return wait
+
+    def give(self, key: str, amount: float, capacity: float, refill_rate: float):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT tokens, updated FROM token_buckets WHERE key = ?', (key,)).fetchone()
+                # a missing bucket is full, there is nothing to give back
+                if row is not None:
+                    tokens = min(capacity, row[0] + (now - row[1]) * refill_rate + amount)
+                    self.conn.execute('UPDATE token_buckets SET tokens = ?, updated = ? WHERE key = ?',
+                                      (tokens, now, key))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import os
+import uuid
+from typing import List, NamedTuple, Optional
+
+from fastapi import HTTPException, UploadFile, status
+from starlette.datastructures import UploadFile as StarletteUploadFile
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+class SpooledUpload(NamedTuple):
+    path: str
+    size: int
+    sha256: str
+
+
+async def spool_upload_file(file: UploadFile, save_path: str, max_size: Optional[int] = None,
+                            chunk_size: int = DEFAULT_CHUNK_SIZE) -> SpooledUpload:
+    """
+    以固定大小分块将上传文件写入磁盘，同时计算 SHA-256
+    :param file:        上传的文件
+    :param save_path:   保存路径
+    :param max_size:    允许的最大字节数，None 表示不限制
+    :param chunk_size:  分块大小
+    :return:            保存路径、文件大小与 SHA-256
+    """
+    digest = hashlib.sha256()
+    size = 0
+    save_dir = os.path.dirname(save_path)
+    if save_dir and not os.path.exists(save_dir):
+        os.makedirs(save_dir, exist_ok=True)
+    await file.seek(0)
+    try:
+        with open(save_path, 'wb') as f:
+            while True:
+                chunk = await file.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                        f'file too large, max {max_size} bytes')
+                digest.update(chunk)
+                await asyncio.to_thread(f.write, chunk)
+    except BaseException:
+        if os.path.exists(save_path):
+            os.remove(save_path)
+        raise
+    return SpooledUpload(save_path, size, digest.hexdigest())
+
+
+async def detach_uploads(args: dict, save_dir: str, max_size: Optional[int] = None) -> List[StarletteUploadFile]:
+    """
+    将参数中的上传文件保存为调用方持有的副本并替换原参数，供请求结束后才执行的异步任务读取
+    * 请求结束时表单中的上传文件会被关闭，副本用完后调用 release_upload 删除
+    :param args:        调用参数，原地替换
+    :param save_dir:    副本保存目录
+    :param max_size:    允许的最大字节数，None 表示不限制
+    :return:            生成的副本列表
+    """
+    detached = []
+    try:
+        for key, value in list(args.items()):
+            if not isinstance(value, (StarletteUploadFile, UploadView)):
+                continue
+            save_path = os.path.join(save_dir, f'job_{uuid.uuid4().hex}')
+            upload = await spool_upload_file(value, save_path, max_size)
+            copy = StarletteUploadFile(open(save_path, 'rb'), size=upload.size, filename=value.filename,
+                                       headers=value.headers)
+            detached.append(copy)
+            args[key] = copy
+    except BaseException:
+        for copy in detached:
+            await release_upload(copy)
+        raise
+    return detached
+
+
+async def release_upload(file: StarletteUploadFile):
+    """
+    关闭并删除 detach_uploads 生成的副本
+    """
+    await file.close()
+    if os.path.exists(file.file.name):
+        os.remove(file.file.name)
+
+
+async def read_upload_prefix(file, size: int) -> bytes:
+    """
+    读取上传文件开头至多 size 个字节，随后将读取位置复位，上传文件仍可完整保存
+    :param file:    上传的文件或 UploadView
+    :param size:    前缀字节数
+    :return:        前缀内容，文件不足 size 字节时为整个文件
+    """
+    chunks = []
+    remaining = size
+    await file.seek(0)
+    while remaining > 0:
+        chunk = await file.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    await file.seek(0)
+    return b''.join(chunks)
+
+
+def upload_size(file) -> int:
+    """
+    上传文件的字节数，用于在读取前估算调用开销
+    """
+    size = getattr(file, 'size', None)
+    if size is None and hasattr(file, 'file'):
+        position = file.file.tell()
+        size = file.file.seek(0, os.SEEK_END)
+        file.file.seek(position)
+    return size or 0
+
+
+class UploadView:
+    """
+    上传文件的独立读取视图：多个调用共享同一上传文件时各自维护读取位置
+    """
+
+    def __init__(self, upload: UploadFile, lock: asyncio.Lock):
+        """
+        :param upload:  上传的文件
+        :param lock:    同一上传文件的所有视图共享的锁
+        """
+        self.upload = upload
+        self.lock = lock
+        self.position = 0
+
+    @property
+    def filename(self):
+        return self.upload.filename
+
+    @property
+    def content_type(self):
+        return self.upload.content_type
+
+    @property
+    def size(self):
+        return upload_size(self.upload)
+
+    @property
+    def headers(self):
+        return self.upload.headers
+
+    async def seek(self, offset: int):
+        self.position = offset
+
+    async def read(self, size: int = -1) -> bytes:
+        async with self.lock:
+            await self.upload.seek(self.position)
+            data = await self.upload.read(size)
+        self.position += len(data)
+        return data
+
+    async def close(self):
+        pass
@@ -1,25 +1,43 @@
+import asyncio
 import inspect
+import json
 import logging
 import os
 import sys
 import time
+from contextlib import AsyncExitStack
 from time import sleep
 
 import uvicorn
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, UploadFile, status
-from fastapi import Form
+from fastapi import Form, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.openapi.utils import get_openapi
 # noinspection PyPackageRequirements
 from pydantic.fields import Union, Json
 # noinspection PyProtectedMember
 from slowapi import Limiter, _rate_limit_exceeded_handler as rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from slowapi.util import get_remote_address
+from starlette.datastructures import UploadFile as StarletteUploadFile
 from starlette.middleware.cors import CORSMiddleware
 from starlette.requests import Request
-from starlette.responses import FileResponse
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
 
-from core import PluginManager
+from core import AdmissionController, JobManager, MetricsRegistry, PluginManager, TempJanitor, UploadView
+from core.http import ReleasingResponse, not_modified
+from core.shared import SharedJobStore, SharedTokenBuckets
+from core.upload import detach_uploads, read_upload_prefix, release_upload
+
+env_path = '.env.dev'
+if os.environ.get('ENVIRONMENT') == 'production':
+    env_path = '.env.prod'
+load_dotenv(dotenv_path=env_path)
+
+# 多 worker 部署时，限流计数与任务记录通过本地 SQLite 在进程间共享
+workers = int(os.getenv('WORKERS', 1))
+shared_db_path = os.path.abspath(os.getenv('SHARED_DB', 'data/shared.db'))
 
 app = FastAPI()
 
@@ -37,12 +55,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-limiter = Limiter(key_func=get_remote_address)
+os.path.exists('data') or os.mkdir('data')
+limiter = Limiter(
+    key_func=get_remote_address,
+    storage_uri=f'sqlite://{shared_db_path}' if workers > 1 else 'memory://',
+    # 压测时关闭限流: RATE_LIMIT=off
+    enabled=os.getenv('RATE_LIMIT', 'on') != 'off'
+)
+
+
+def openapi():
+    """
+    在生成的文档中加入插件方法的参数声明，插件加载或热重载后即时更新
+    """
+    if app.openapi_schema is None:
+        app.openapi_schema = get_openapi(title=app.title, version=app.version, routes=app.routes)
+    return {**app.openapi_schema, 'paths': {**app.openapi_schema['paths'], **plugin_manager.openapi_paths()}}
+
+
+app.openapi = openapi
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, rate_limit_exceeded_handler)
 
 os.path.exists('log') or os.mkdir('log')
-os.path.exists('data') or os.mkdir('data')
 
 formatter = logging.Formatter(f'%(levelname)0.7s\t  %(asctime)0.19s\t  [%(name)s] %(message)s')
 console_handler = logging.StreamHandler(sys.stdout)
@@ -58,6 +93,32 @@ logger.info(f'running on {sys.platform}[{os.name.upper()} Kernel](python {sys.ve
 
 logger.info('initializing plugin manager')
 plugin_manager = PluginManager('plugins')
+job_manager = JobManager(store=SharedJobStore(shared_db_path) if workers > 1 else None)
+# 按插件声明的方法开销扣除客户端令牌（180 个令牌，每秒补充 3 个），slowapi 的次数限流仍作为兜底
+admission = AdmissionController(
+    buckets=SharedTokenBuckets(shared_db_path) if workers > 1 else None,
+    enabled=os.getenv('RATE_LIMIT', 'on') != 'off'
+)
+
+
+@app.on_event('startup')
+async def startup():
+    TempJanitor().start()
+    plugin_manager.discover_plugins()
+    # 插件在后台线程中并行加载，服务立即开始接受请求，各插件加载完成后即可调用
+    app.state.bootstrap = asyncio.create_task(asyncio.to_thread(plugin_manager.load_plugins, activate=True))
+    # 修改 plugins 目录下的模块后自动热重载，PLUGIN_WATCH=off 关闭
+    if os.getenv('PLUGIN_WATCH', 'on') != 'off':
+        app.state.plugin_watcher = asyncio.create_task(plugin_manager.watch_plugins())
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    await TempJanitor().stop()
+    if getattr(app.state, 'plugin_watcher', None) is not None:
+        app.state.plugin_watcher.cancel()
+    plugin_manager.deactivate_plugins()
+    plugin_manager.unload_plugins()
 
 
 @app.get("/")
@@ -77,16 +138,181 @@ async def status_info():
     }
 
 
+@app.get('/metrics',
+         description='Plugin call metrics in Prometheus text format',
+         response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(MetricsRegistry().render(), media_type='text/plain; version=0.0.4')
+
+
+@app.get('/temp-usage',
+         description='Disk usage of the temporary directory of each plugin')
+async def temp_usage():
+    return {
+        'status': 0,
+        'result': TempJanitor().usage()
+    }
+
+
 @app.get("/available-futures")
 async def get_plugins():
     ret = []
-    for plugin_name, plugin in plugin_manager.plugins.items():
+    # plugins are published from loader threads, iterate over a copy
+    for plugin_name in list(plugin_manager.plugins):
         ret.append({
             'name': plugin_name,
-            'methods': plugin.__getmethods__()
+            'methods': plugin_manager.get_plugin_methods(plugin_name)
         })
     return {
-        "plugins": ret
+        "plugins": ret,
+        "loading": sorted(list(plugin_manager.loading))
+    }
+
+
+async def validate_params(plugin_name: str, method: str, args: dict):
+    # args 来自客户端的 JSON，可能是列表或标量
+    if not isinstance(args, dict):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, 'args must be an object')
+    # 先按声明的参数做一遍预编译的校验，再执行插件自定义的 params_validater
+    schema_validater = plugin_manager.get_method_validator(plugin_name, method)
+    if schema_validater is not None:
+        validate = schema_validater(args)
+        if validate is not False:
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, f'params invalid: {validate}')
+    plugin = plugin_manager.plugins[plugin_name]
+    validater = plugin.params_validater
+    kwargs = {}
+    # 只读取校验器声明的前缀，上传文件留给插件方法完整保存一次
+    if plugin._validate_prefix_size and hasattr(args.get('file'), 'seek'):
+        kwargs['prefix'] = await read_upload_prefix(args['file'], plugin._validate_prefix_size)
+    if inspect.iscoroutinefunction(validater):
+        validate = await validater(args, **kwargs)
+    else:
+        validate = validater(args, **kwargs)
+    if validate is not False:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, f'params invalid: {validate}')
+
+
+def check_plugin(plugin_name: str):
+    if plugin_name in plugin_manager.loading:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, 'plugin is loading, please retry later',
+                            headers={'Retry-After': '5'})
+    if plugin_name not in plugin_manager.plugins:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, 'plugin not found')
+
+
+def hold_stream_response(response: StreamingResponse, stack: AsyncExitStack, client: str, cost: float):
+    """
+    流式响应体在插件方法返回后才执行：stack 中的名额随响应发送结束释放，响应体未开始执行时退还开销
+    """
+    iterator = response.body_iterator
+    started = False
+
+    async def body():
+        nonlocal started
+        started = True
+        async for chunk in iterator:
+            yield chunk
+
+    async def release():
+        await stack.aclose()
+        if not started:
+            admission.refund(client, cost)
+
+    response.body_iterator = body()
+    return ReleasingResponse(response, release)
+
+
+async def invoke_plugin(plugin_name: str, method: str, args: dict, client: str, submit: bool = False,
+                        inline: bool = False, readonly: bool = False):
+    """
+    校验参数、按方法开销准入后调用插件方法，submit 时提交为异步任务并返回任务记录
+    * readonly 时（GET 请求）只允许调用插件声明在 _get_methods 中的方法
+    * 流式响应在发送结束（包括出错或客户端断开）后才释放插件并发名额，返回的响应必须交给 ASGI 发送
+    * inline 时结果嵌入 JSON（/batch），与 submit 一样不能调用返回文件或流式响应的方法
+    """
+    check_plugin(plugin_name)
+    entry = plugin_manager.get_method(plugin_name, method)
+    if entry is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, 'method not found')
+    if readonly and not entry.allow_get:
+        raise HTTPException(status.HTTP_405_METHOD_NOT_ALLOWED, 'method can only be called with POST',
+                            headers={'Allow': 'POST'})
+    if (submit or inline) and entry.returns_response:
+        # 响应体只能在本次请求中发送一次：任务结果无法重复获取，也无法嵌入 JSON，拒绝在执行前
+        raise HTTPException(status.HTTP_406_NOT_ACCEPTABLE,
+                            'method returns a file or stream, call it through /call without async')
+    try:
+        await validate_params(plugin_name, method, args)
+        plugin = plugin_manager.plugins[plugin_name]
+        cost = plugin.method_cost(method, args)
+        admission.charge(client, cost)
+
+        async def limited_call(hold: bool = False):
+            async with AsyncExitStack() as stack:
+                try:
+                    await stack.enter_async_context(
+                        admission.limit(plugin_name, plugin._max_concurrency, plugin._max_queue)
+                    )
+                except HTTPException:
+                    # rejected before running, the call costs nothing
+                    admission.refund(client, cost)
+                    raise
+                ret = await plugin_manager.call_plugin_method(plugin_name, method, args)
+                if hold and isinstance(ret, StreamingResponse):
+                    # the body runs after this returns, the slot goes with the response even if it is never iterated
+                    ret = hold_stream_response(ret, stack.pop_all(), client, cost)
+                return ret
+
+        if not submit:
+            return await limited_call(hold=not inline)
+        detached = []
+
+        async def job_call():
+            try:
+                return await limited_call()
+            finally:
+                for file in detached:
+                    await release_upload(file)
+
+        try:
+            # 请求结束时表单中的上传文件会被关闭，任务改为读取自己持有的副本，结束后删除
+            detached = await detach_uploads(args, plugin._temp_dir, plugin._max_upload_size)
+            return job_manager.submit(plugin_name, method, job_call)
+        except BaseException:
+            admission.refund(client, cost)
+            for file in detached:
+                await release_upload(file)
+            raise
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        # log thru plugin logger
+        plugin_manager.get_plugin_logger(plugin_name).error(e, exc_info=True)
+        raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, str(e))
+
+
+async def call_plugin(request: Request, plugin_name: str, method: str, run_async: bool, args: dict):
+    t1 = time.time()
+    readonly = request.method == 'GET'
+    if run_async:
+        job = await invoke_plugin(plugin_name, method, args, get_remote_address(request), submit=True,
+                                  readonly=readonly)
+        return {
+            'status': 0,
+            'job': job.to_dict()
+        }
+    ret = await invoke_plugin(plugin_name, method, args, get_remote_address(request), readonly=readonly)
+    if isinstance(ret, Response):
+        fresh = not_modified(request, ret)
+        if fresh is not None and isinstance(ret, ReleasingResponse):
+            # the held response is dropped, release with the one that is sent
+            fresh = ReleasingResponse(fresh, ret.release)
+        return fresh or ret
+    return {
+        'status': 0,
+        'spent': round(time.time() - t1, 3),
+        'result': ret
     }
 
 
@@ -96,34 +322,74 @@ async def plugin_call(
         request: Request,
         plugin_name: str,
         method: str,
+        run_async: bool = Query(False, alias='async'),
         args: Union[Json, None] = Form(None),
         file: Union[UploadFile, None] = Form(None)
 ):
-    if plugin_name not in plugin_manager.plugins:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, 'plugin not found')
-    t1 = time.time()
+    # logger.info(f'arg type: {type(args)}')
+    if not args:
+        args = {}
+    if file and isinstance(args, dict):
+        args['file'] = file
+    return await call_plugin(request, plugin_name, method, run_async, args)
+
+
+@app.get("/call/{plugin_name}",
+         description='Same as POST /call without file upload, so that clients and proxies can cache the response. '
+                     'Only read-only methods can be called, others return 405')
+@limiter.limit("180/minute")
+async def plugin_call_get(
+        request: Request,
+        plugin_name: str,
+        method: str,
+        run_async: bool = Query(False, alias='async'),
+        args: Union[Json, None] = Query(None)
+):
+    return await call_plugin(request, plugin_name, method, run_async, args or {})
+
+
+MAX_BATCH_SIZE = 16
+
+
+async def call_batch_entry(entry, form, file_locks: dict, client: str):
+    # one failing entry must not fail the whole gather
     try:
-        # logger.info(f'arg type: {type(args)}')
-        if not args:
-            args = {}
-        if file:
-            args['file'] = file
-        validater = plugin_manager.plugins[plugin_name].params_validater
-        if inspect.iscoroutinefunction(validater):
-            validate = await validater(args)
-        else:
-            validate = validater(args)
-        if validate is not False:
-            raise HTTPException(status.HTTP_400_BAD_REQUEST, f'params invalid: {validate}')
-        ret = await plugin_manager.call_plugin_method(plugin_name, method, args)
+        return await run_batch_entry(entry, form, file_locks, client)
     except HTTPException as e:
-        raise e
+        return {'status': e.status_code, 'error': e.detail}
     except Exception as e:
-        # log thru plugin logger
-        plugin_manager.get_plugin_logger(plugin_name).error(e, exc_info=True)
-        raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, str(e))
-    if type(ret) is FileResponse:
-        return ret
+        logger.error(e, exc_info=True)
+        return {'status': status.HTTP_500_INTERNAL_SERVER_ERROR, 'error': str(e)}
+
+
+async def run_batch_entry(entry, form, file_locks: dict, client: str):
+    t1 = time.time()
+    if not isinstance(entry, dict) or not entry.get('plugin') or not entry.get('method'):
+        return {'status': status.HTTP_400_BAD_REQUEST, 'error': 'plugin and method are required'}
+    if not all(isinstance(entry.get(key), str) for key in ('plugin', 'method')) \
+            or not isinstance(entry.get('file') or '', str):
+        return {'status': status.HTTP_400_BAD_REQUEST, 'error': 'plugin, method and file must be strings'}
+    args = entry.get('args')
+    if args is None:
+        args = {}
+    if not isinstance(args, dict):
+        return {'status': status.HTTP_400_BAD_REQUEST, 'error': 'args must be an object'}
+    args = dict(args)
+    if entry.get('file'):
+        upload = form.get(entry['file'])
+        if not isinstance(upload, StarletteUploadFile):
+            return {'status': status.HTTP_400_BAD_REQUEST, 'error': f'file part \'{entry["file"]}\' not found'}
+        # entries may share one upload, each reads it through its own view
+        args['file'] = UploadView(upload, file_locks.setdefault(entry['file'], asyncio.Lock()))
+    ret = await invoke_plugin(entry['plugin'], entry['method'], args, client, inline=True)
+    if isinstance(ret, Response):
+        if ret.media_type == 'application/json' and hasattr(ret, 'body'):
+            # precomputed call envelopes are embedded as they are
+            return json.loads(ret.body)
+        # the method did not declare it in _response_methods, at least clean up after it
+        if ret.background is not None:
+            await ret.background()
+        return {'status': status.HTTP_406_NOT_ACCEPTABLE, 'error': 'method returns a file or stream, use /call'}
     return {
         'status': 0,
         'spent': round(time.time() - t1, 3),
@@ -131,18 +397,79 @@ async def plugin_call(
     }
 
 
+@app.post("/batch",
+          description='Run several plugin calls concurrently in one request. `calls` is a JSON list of '
+                      '{plugin, method, args, file}, where `file` names a file part of this request. '
+                      'Each entry succeeds or fails independently.')
+@limiter.limit("180/minute")
+async def batch_call(request: Request, calls: Json = Form(...)):
+    if not isinstance(calls, list) or not calls:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, 'calls must be a non-empty list')
+    if len(calls) > MAX_BATCH_SIZE:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, f'too many calls, max {MAX_BATCH_SIZE}')
+    t1 = time.time()
+    form = await request.form()
+    file_locks = {}
+    client = get_remote_address(request)
+    results = await asyncio.gather(*[call_batch_entry(entry, form, file_locks, client) for entry in calls])
+    return {
+        'status': 0,
+        'spent': round(time.time() - t1, 3),
+        'results': results
+    }
+
+
+def get_job_or_404(job_id: str):
+    job = job_manager.get_job(job_id)
+    if job is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, 'job not found')
+    return job
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    return {
+        'status': 0,
+        'job': get_job_or_404(job_id).to_dict()
+    }
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = get_job_or_404(job_id)
+    if not job.done:
+        raise HTTPException(status.HTTP_409_CONFLICT, f'job is {job.status}')
+    if job.error_code is not None:
+        raise HTTPException(job.error_code, job.error)
+    if job.has_response:
+        return job.result
+    return {
+        'status': 0,
+        'spent': job.to_dict()['spent'],
+        'result': job.result
+    }
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    job = get_job_or_404(job_id)
+
+    async def event_stream():
+        async for snapshot in job_manager.watch(job.id):
+            if snapshot is None:
+                yield ': keep-alive\n\n'
+            else:
+                yield f'event: {snapshot.status}\ndata: {json.dumps(jsonable_encoder(snapshot.to_dict()))}\n\n'
+
+    return StreamingResponse(event_stream(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
 if __name__ == '__main__':
-    env_path = '.env.dev'
-    if os.environ.get('ENVIRONMENT') == 'production':
-        env_path = '.env.prod'
-    load_dotenv(dotenv_path=env_path)
-    plugin_manager.load_plugins()
-    plugin_manager.activate_plugins()
-    logger.info('starting server')
+    logger.info(f'starting server with {workers} worker(s)')
     sleep(0.5)
     uvicorn.run(
-        app,
-        workers=1,
+        'main:app',
+        workers=workers,
         host=os.getenv('HOST'), port=int(os.getenv('PORT')),
         log_config={'version': 1, 'disable_existing_loggers': False}
     )
@@ -1,16 +1,21 @@
 import asyncio
 import hashlib
+import json
+import logging
 import os
+import re
 import shutil
 import subprocess
-from typing import List
+import sys
+import time
+from contextlib import asynccontextmanager
 
 import importlib
 from fastapi import HTTPException, UploadFile
-from starlette.background import BackgroundTasks
-from starlette.responses import FileResponse
+from starlette.responses import StreamingResponse
 
-from core import Plugin
+from core import BoundedProcessPool, Param, Plugin, RangeFileResponse, ResultCache, iter_zip, upload_size
+from core.metrics import plugin_subprocess_duration
 
 
 def random_string(size):
@@ -19,7 +24,145 @@ def random_string(size):
     return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(size))
 
 
+# SHA-256 of binwalk-2.3.2.zip, when unset the first download is pinned
+BINWALK_PACKAGE_SHA256 = os.getenv('BINWALK_PACKAGE_SHA256') or None
+
+# signature scan in a child interpreter, binwalk prints each hit as soon as it is found
+STREAM_SCAN_CODE = 'import sys, binwalk; binwalk.scan(sys.argv[1], signature=True, offset=int(sys.argv[2]), ' \
+                   'length=int(sys.argv[3]))'
+# DECIMAL       HEXADECIMAL     DESCRIPTION
+SIGNATURE_LINE = re.compile(r'^(\d+)\s+0x([0-9A-Fa-f]+)\s+(.+)$')
+
+
+def publish_artifacts(staging_dir, artifacts_dir):
+    """
+    将暂存目录整体换入产物目录，同一内容的并发扫描（包括其他 worker 中的）不会写入同一目录
+    """
+    try:
+        os.replace(staging_dir, artifacts_dir)
+    except OSError:
+        # an earlier scan of the same content left its directory, swap it out
+        retired = f'{staging_dir}.old'
+        os.replace(artifacts_dir, retired)
+        os.replace(staging_dir, artifacts_dir)
+        shutil.rmtree(retired, ignore_errors=True)
+
+
+def scan_file(path, temp_dir, artifact_id, extract=True, offset=0, length=0):
+    """
+    在工作进程中执行 binwalk 扫描与提取，产物先移动到暂存目录，完成后整体换入 artifacts/{artifact_id}
+    :param path:        待扫描文件路径
+    :param temp_dir:    插件临时目录
+    :param artifact_id: 产物目录名
+    :param extract:     是否提取，False 时只扫描签名
+    :param offset:      扫描起始偏移
+    :param length:      扫描字节数，0 表示到文件末尾
+    :return:            仅包含基本类型的扫描结果，即 scan 返回的结果
+    """
+    logger = logging.getLogger('plugin.binwalker')
+    artifacts = []
+    signature_list: list = []
+    meta = None
+    staging_dir = os.path.join(temp_dir, 'artifacts', f'.{artifact_id}.{os.getpid()}.{random_string(8)}')
+    module_binwalk = importlib.import_module('binwalk')
+    scan_result = module_binwalk.scan(path, signature=True, extract=extract, quiet=True, offset=offset, length=length)
+    for module in scan_result:
+        for result in module.results:
+            if meta is None:
+                meta = {
+                    'filename': os.path.basename(result.file.name),
+                    'size': result.file.size
+                }
+            signature_list.append({
+                'file': os.path.basename(result.file.name),
+                'offset': result.offset,
+                'description': result.description
+            })
+            logger.info("[BinWalk] [%s] at 0x%.8X\t%s" % (result.file.name.split('/')[-1],
+                                                          result.offset,
+                                                          result.description))
+            if extract and result.file.path in module.extractor.output:
+                origin_basename, origin_ext = os.path.splitext(os.path.basename(result.file.name))
+                # Carved
+                if result.offset in module.extractor.output[result.file.path].carved:
+                    try:
+                        carved_path = module.extractor.output[result.file.path].carved[result.offset]
+                        os.path.exists(staging_dir) or os.makedirs(staging_dir)
+                        carved_moved_dst, carved_moved_filename = os.path.split(shutil.move(
+                            carved_path,
+                            os.path.join(staging_dir, f'{os.path.basename(carved_path)}')
+                        ))
+                        artifacts.append(f'{carved_moved_filename}')
+                        logger.info("[BinWalk] [%s] at 0x%.8X\t- CARVE >> '%s'" % (
+                            result.file.name.split('/')[-1],
+                            result.offset,
+                            carved_path))
+                    except Exception as e:
+                        raise e
+                # Extracted
+                if result.offset in module.extractor.output[result.file.path].extracted:
+                    try:
+                        logger.info("[BinWalk] [%s] at 0x%.8X\t- EXTRACT %d files >> '%s'" % (
+                            result.file.name.split('/')[-1],
+                            result.offset,
+                            len(module.extractor.output[result.file.path].extracted[result.offset].files),
+                            module.extractor.output[result.file.path].extracted[result.offset].files[0]))
+                        for extracted_file in module.extractor.output[
+                            result.file.path
+                        ].extracted[result.offset].files:
+                            extracted_file_basename = os.path.basename(extracted_file)
+                            artifacts.append(extracted_file_basename)
+                            os.path.exists(staging_dir) or os.makedirs(staging_dir)
+                            shutil.move(
+                                extracted_file,
+                                os.path.join(staging_dir, f'{extracted_file_basename}')
+                            )
+                        shutil.rmtree(os.path.join(
+                            temp_dir,
+                            f'_{origin_basename}{origin_ext}.extracted'
+                        ))
+                        os.remove(os.path.join(
+                            temp_dir,
+                            f'{origin_basename}{origin_ext}'
+                        ))
+                    except Exception:
+                        pass
+    if os.path.isdir(staging_dir):
+        publish_artifacts(staging_dir, os.path.join(temp_dir, 'artifacts', artifact_id))
+    available = len(signature_list) > 0
+    return {
+        'available': available,
+        'meta': meta,
+        'signature': signature_list if available else None,
+        'downloads': {
+            'artifact_id': artifact_id if available and extract else None,
+            'artifacts': artifacts if available and extract else None,
+        }
+    }
+
+
 class Binwalker(Plugin):
+    _max_upload_size = 1024 * 1024 * 1024
+    # artifacts are also referenced by the scan cache, keep them as long as its entries live
+    _temp_max_bytes = 4 * 1024 * 1024 * 1024
+    _temp_max_age = 7 * 24 * 3600
+    _method_costs = {
+        'scan': lambda params: 1 + upload_size(params['file']) / (8 * 1024 * 1024),
+        'scan_stream': lambda params: 1 + upload_size(params['file']) / (8 * 1024 * 1024),
+    }
+    # each scan occupies a worker process, queue no deeper than a few rounds of the pool
+    _max_concurrency = 4
+    _response_methods = ('scan_stream', 'artifact', 'bundle')
+    _get_methods = ('artifact', 'bundle')
+    _max_queue = 16
+
+    def __init__(self):
+        super().__init__()
+        self.cfg = None
+        self.scan_cache = None
+        self.scan_pool = None
+        # scan key -> [lock, holders], scans of the same content run one at a time and share the cached result
+        self.scan_locks = {}
 
     def load(self):
         try:
@@ -30,188 +173,249 @@ class Binwalker(Plugin):
                 'https://resource.uniiem.com/index.php'
                 '?user/publicLink&fid=f6e5MJFzHcmAlfDM9s4sT7fCeE4tDJTu5G-MEMrd7mLaqBvB_n-CKYxkp2t09uh9y4df0DgFkC_'
                 'ITx00AgyUZ0rkt6F6HGMTpyUHOmPKctYDZXQdX0ZP-H-P64HQI_y3I0Pq2NHbuPDmU0vP3tNDrMjR8CXwoEW6nOp1iN4f-DG'
-                '_g58ST5FIxWjTnXFL_nxcqBzjt78kEFk&file_name=/binwalk-2.3.2.zip'
+                '_g58ST5FIxWjTnXFL_nxcqBzjt78kEFk&file_name=/binwalk-2.3.2.zip',
+                sha256=BINWALK_PACKAGE_SHA256
             )
             # setup_path = os.path.join(self.data_dir(), 'binwalk-2.3.2', 'setup.py')
             setup_path = os.path.join(self.data_dir(), 'binwalk-2.3.2')
             if not os.path.exists(setup_path):
                 raise FileNotFoundError('setup.py not found')
-
-            async def do_install():
-                process = await asyncio.create_subprocess_exec(
-                    # 'python', setup_path, 'install',
-                    'pip', 'install', setup_path,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT
-                )
-                stdout, stderr = await process.communicate()
-                return process.returncode, stdout, stderr
-
-            code, std_out, std_err = asyncio.run(do_install())
-            output = std_out.decode(
+            # load runs in a plugin loader thread, so a blocking install only delays this plugin
+            process = subprocess.run(
+                # 'python', setup_path, 'install',
+                [sys.executable, '-m', 'pip', 'install', setup_path],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT
+            )
+            output = process.stdout.decode(
                 encoding=('gbk' if os.name == 'nt' else 'utf-8'),
                 errors='replace'
             )
-            if code != 0:
+            if process.returncode != 0:
                 raise RuntimeError(f'Install binwalk failed: {output}')
+            importlib.invalidate_caches()
+            globals()['binwalk'] = importlib.import_module('binwalk')
             self.logger.info(f'binwalk has been installed successfully')
 
     def unload(self):
-        pass
+        if self.scan_pool is not None:
+            self.scan_pool.shutdown(wait=False)
 
     def activate(self):
         super().activate()
+        self.cfg = self.ConfigUtil(self.data_dir(), 'config.json', {
+            'cache': {
+                'max_entries': 256,
+                'max_bytes': 2 * 1024 * 1024 * 1024,
+                'max_age': 7 * 24 * 3600
+            },
+            'executor': {
+                'workers': None,
+                'queue_size': 16
+            }
+        })
+        executor_cfg = self.cfg.get_cfg('executor', {})
+        self.scan_pool = BoundedProcessPool(
+            'binwalker',
+            workers=executor_cfg.get('workers'),
+            queue_size=executor_cfg.get('queue_size', 16),
+            initializer=importlib.import_module,
+            initargs=('binwalk',)
+        )
+        cache_cfg = self.cfg.get_cfg('cache', {})
+        self.scan_cache = ResultCache(
+            os.path.join(self.data_dir(), 'cache'),
+            max_entries=cache_cfg.get('max_entries', 256),
+            max_bytes=cache_cfg.get('max_bytes'),
+            max_age=cache_cfg.get('max_age'),
+            weigher=self.artifacts_size,
+            on_evict=self.purge_artifacts
+        )
 
-    def __getmethods__(self, exclude: List[str] = None):
-        return super().__getmethods__(['do_scan'])
-
-    async def do_scan(self, path):
-        artifact_id = hashlib.md5(path.encode('utf-8')).hexdigest()
-        artifacts = []
-        signature_list: list = []
-        module_binwalk = importlib.import_module('binwalk')
-        globals()['binwalk'] = module_binwalk
-        scan_result = await asyncio.to_thread(module_binwalk.scan, path, signature=True, extract=True, quiet=True)
-        for module in scan_result:
-            for result in module.results:
-                result_for_resp = result
-                result_for_resp.file.name = os.path.basename(result.file.name)
-                signature_list.append(result_for_resp)
-                self.logger.info("[BinWalk] [%s] at 0x%.8X\t%s" % (result.file.name.split('/')[-1],
-                                                                   result.offset,
-                                                                   result.description))
-                if result.file.path in module.extractor.output:
-                    origin_basename, origin_ext = os.path.splitext(os.path.basename(result.file.name))
-                    # Carved
-                    if result.offset in module.extractor.output[result.file.path].carved:
-                        try:
-                            carved_path = module.extractor.output[result.file.path].carved[result.offset]
-                            os.path.exists(os.path.join(
-                                self._temp_dir,
-                                'artifacts',
-                                # f'{origin_basename}{origin_ext}'
-                                f'{artifact_id}'
-                            )) or os.makedirs(os.path.join(
-                                self._temp_dir,
-                                'artifacts',
-                                # f'{origin_basename}{origin_ext}'
-                                f'{artifact_id}'
-                            ))
-                            carved_moved_dst, carved_moved_filename = os.path.split(shutil.move(
-                                carved_path,
-                                os.path.join(
-                                    self._temp_dir,
-                                    'artifacts',
-                                    # f'{origin_basename}{origin_ext}',
-                                    f'{artifact_id}',
-                                    f'{os.path.basename(carved_path)}'
-                                )
-                            ))
-                            artifacts.append(f'{carved_moved_filename}')
-                            self.logger.info("[BinWalk] [%s] at 0x%.8X\t- CARVE >> '%s'" % (
-                                result.file.name.split('/')[-1],
-                                result.offset,
-                                carved_path))
-                        except Exception as e:
-                            raise e
-                    # Extracted
-                    if result.offset in module.extractor.output[result.file.path].extracted:
-                        try:
-                            self.logger.info("[BinWalk] [%s] at 0x%.8X\t- EXTRACT %d files >> '%s'" % (
-                                result.file.name.split('/')[-1],
-                                result.offset,
-                                len(module.extractor.output[result.file.path].extracted[result.offset].files),
-                                module.extractor.output[result.file.path].extracted[result.offset].files[0]))
-                            for extracted_file in module.extractor.output[
-                                result.file.path
-                            ].extracted[result.offset].files:
-                                extracted_file_basename = os.path.basename(extracted_file)
-                                artifacts.append(extracted_file_basename)
-                                shutil.move(
-                                    extracted_file,
-                                    os.path.join(
-                                        self._temp_dir,
-                                        'artifacts',
-                                        # f'{origin_basename}{origin_ext}',
-                                        f'{artifact_id}',
-                                        f'{extracted_file_basename}'
-                                    )
-                                )
-                            shutil.rmtree(os.path.join(
-                                self._temp_dir,
-                                f'_{origin_basename}{origin_ext}.extracted'
-                            ))
-                            os.remove(os.path.join(
-                                self._temp_dir,
-                                f'{origin_basename}{origin_ext}'
-                            ))
-                        except Exception:
-                            pass
+    def methods(self):
+        # artifact ids are the md5 or sha256 of the scanned file
+        artifact_id = Param(str, pattern=r'[0-9a-f]{32,64}')
+        window = {
+            'offset': Param(int, default=0, minimum=0, description='Scan from this byte offset'),
+            'length': Param(int, default=0, minimum=0, description='Number of bytes to scan, 0 to the end'),
+        }
         return {
-            'available': True,
-            'meta': {
-                'filename': os.path.basename(signature_list[0].file.name),
-                'size': signature_list[0].file.size
-            },
-            'signature': signature_list,
-            'artifact_id': artifact_id,
-            'artifacts': artifacts,
-            # 'files': []
-        } if len(signature_list) > 0 else {
-            'available': False,
-            'meta': {
-                'filename': None,
-                'size': None
+            'scan': {
+                'file': Param(UploadFile),
+                'extract': Param(bool, default=True, description='False to only scan signatures'),
+                **window
             },
-            'signature': [],
-            'artifacts': None,
+            'scan_stream': {'file': Param(UploadFile), **window},
+            'artifact': {'artifact_id': artifact_id, 'filename': Param(str, max_length=255)},
+            'bundle': {'artifact_id': artifact_id},
         }
 
-    async def scan(self, params):
+    def artifacts_dir(self, artifact_id):
+        return os.path.join(self._temp_dir, 'artifacts', artifact_id)
+
+    def artifacts_size(self, key, result):
+        artifact_id = result['downloads']['artifact_id']
+        if not artifact_id:
+            return 0
+        size = 0
+        for filename in result['downloads']['artifacts'] or []:
+            filepath = os.path.join(self.artifacts_dir(artifact_id), filename)
+            if os.path.isfile(filepath):
+                size += os.path.getsize(filepath)
+        return size
+
+    def artifacts_available(self, result):
+        artifact_id = result['downloads']['artifact_id']
+        if not artifact_id:
+            return True
+        return all(os.path.exists(os.path.join(self.artifacts_dir(artifact_id), filename))
+                   for filename in result['downloads']['artifacts'] or [])
+
+    def purge_artifacts(self, key, result):
+        artifact_id = result['downloads']['artifact_id']
+        if artifact_id and os.path.isdir(self.artifacts_dir(artifact_id)):
+            self.remove_temporary_file(self.artifacts_dir(artifact_id))
+
+    async def do_scan(self, path, artifact_id=None, extract=True, offset=0, length=0):
+        if artifact_id is None:
+            artifact_id = hashlib.md5(path.encode('utf-8')).hexdigest()
+        with plugin_subprocess_duration.time(plugin='binwalker', tool='binwalk'):
+            return await self.scan_pool.submit(scan_file, path, self._temp_dir, artifact_id, extract, offset, length)
+
+    @staticmethod
+    def scan_key(sha256, extract, offset, length):
+        # a full extracting scan keeps the file hash as key and artifact id, so existing cache entries stay valid
+        if extract and not offset and not length:
+            return sha256
+        return hashlib.sha256(f'{sha256}:{int(extract)}:{offset}:{length}'.encode('utf-8')).hexdigest()
+
+    async def spool_scan_target(self, params):
         file: UploadFile = params.get('file', None)
-        if not file:
-            raise HTTPException(status_code=400, detail='file is required')
         if file.filename == '':
             raise HTTPException(status_code=400, detail='file is required')
-        save_path, save_dir = await self.save_upload_file_as_temporary(file)
-        scan_result = await asyncio.create_task(self.do_scan(save_path))
-        ret = []
-        for result in scan_result['signature']:
-            ret.append({
-                'file': result.file.name.split('/')[-1],
-                'offset': result.offset,
-                'description': result.description
-            })
-        return {
-            'available': scan_result['available'],
-            'meta': scan_result['meta'] if scan_result['available'] else None,
-            'signature': ret if scan_result['available'] else None,
-            'downloads': {
-                'artifact_id': scan_result['artifact_id'] if scan_result['available'] else None,
-                'artifacts': scan_result['artifacts'] if scan_result['available'] else None,
-            }
+        upload = await self.spool_upload_file(file)
+        if params.get('offset', 0) and params['offset'] >= upload.size:
+            self.remove_temporary_file(upload.path)
+            raise HTTPException(status_code=400, detail=f'offset is beyond the end of file ({upload.size} bytes)')
+        return upload
+
+    @asynccontextmanager
+    async def scan_lock(self, key):
+        slot = self.scan_locks.get(key)
+        if slot is None:
+            slot = self.scan_locks[key] = [asyncio.Lock(), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                yield
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                self.scan_locks.pop(key, None)
+
+    async def scan(self, params):
+        extract, offset, length = params.get('extract', True), params.get('offset', 0), params.get('length', 0)
+        upload = await self.spool_scan_target(params)
+        key = self.scan_key(upload.sha256, extract, offset, length)
+        try:
+            # a concurrent scan of the same content would extract into the same artifacts, wait for its result
+            async with self.scan_lock(key):
+                # the cache blocks on its file lock, disk io and artifact removal on eviction
+                cached = await asyncio.to_thread(self.scan_cache.get, key)
+                if cached is not None and self.artifacts_available(cached):
+                    self.logger.info(f'[BinWalk] cache hit for {key}')
+                    return cached
+                result = await self.do_scan(upload.path, key, extract, offset, length)
+                await asyncio.to_thread(self.scan_cache.set, key, result)
+                return result
+        finally:
+            self.remove_temporary_file(upload.path)
+
+    async def stream_signatures(self, path, offset, length):
+        try:
+            # the child is a scan like any other, it takes a worker slot for its whole life
+            async with self.scan_pool.reserve():
+                async for event, data in self.run_signature_scan(path, offset, length):
+                    yield event, data
+        except HTTPException as e:
+            yield 'error', {'detail': e.detail}
+        finally:
+            self.remove_temporary_file(path)
+
+    async def run_signature_scan(self, path, offset, length):
+        t1 = time.time()
+        total = 0
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-u', '-c', STREAM_SCAN_CODE, path, str(offset), str(length),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        try:
+            async for line in process.stdout:
+                match = SIGNATURE_LINE.match(line.decode('utf-8', errors='replace').rstrip())
+                if match is not None:
+                    total += 1
+                    yield 'signature', {'offset': int(match.group(1)), 'description': match.group(3)}
+            await process.wait()
+        finally:
+            # client went away before the scan finished
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            plugin_subprocess_duration.observe(time.time() - t1, plugin='binwalker', tool='binwalk')
+        if process.returncode != 0:
+            yield 'error', {'detail': f'binwalk exited with code {process.returncode}'}
+        yield 'summary', {
+            'total': total,
+            'spent': round(time.time() - t1, 3)
         }
 
-    def del_file(self, path):
-        self.logger.info(f'Delete file: {path}')
-        if os.path.isfile(path):
-            os.remove(path)
+    async def scan_stream(self, params):
+        """
+        流式签名扫描：binwalk 每报告一个签名即输出一行 NDJSON，最后输出汇总，不提取文件也不缓存结果
+        * 与 scan 共享扫描进程池的并发与排队上限，排队已满时返回 503
+        """
+        self.scan_pool.check_capacity()
+        upload = await self.spool_scan_target(params)
+
+        async def ndjson():
+            async for event, data in self.stream_signatures(upload.path, params['offset'], params['length']):
+                yield json.dumps({'event': event, **data}) + '\n'
+
+        return StreamingResponse(ndjson(), media_type='application/x-ndjson')
+
+    def artifact_path(self, artifact_id, filename=''):
+        # both come from the client, keep them inside the artifacts directory
+        if not artifact_id or os.path.basename(artifact_id) != artifact_id or artifact_id in ('.', '..'):
+            raise HTTPException(status_code=400, detail='invalid artifact_id')
+        if filename and (os.path.basename(filename) != filename or filename in ('.', '..')):
+            raise HTTPException(status_code=400, detail='invalid filename')
+        return os.path.join(self.artifacts_dir(artifact_id), filename)
 
     def artifact(self, params):
         filename = params.get('filename', None)
         artifact_id = params.get('artifact_id', '')
-        if not filename:
-            raise HTTPException(status_code=400, detail='filename is required')
-        if filename == '':
-            raise HTTPException(status_code=400, detail='filename is required')
-        filepath = os.path.join(self._temp_dir, 'artifacts', artifact_id, filename)
+        filepath = self.artifact_path(artifact_id, filename)
         if os.path.isfile(filepath):
-            resp = FileResponse(
+            # artifacts stay on disk for the scan cache and ranged downloads, the janitor removes them later
+            return RangeFileResponse(
                 path=filepath,
                 filename=filename
             )
-            task = BackgroundTasks()
-            task.add_task(self.del_file, filepath)
-            return resp
         else:
             raise HTTPException(403, detail='File you required does not exists.')
+
+    def bundle(self, params):
+        artifact_id = params.get('artifact_id', '')
+        artifacts_dir = self.artifact_path(artifact_id)
+        if not os.path.isdir(artifacts_dir):
+            raise HTTPException(403, detail='Artifacts you required do not exist.')
+        entries = [(filename, os.path.join(artifacts_dir, filename)) for filename in sorted(os.listdir(artifacts_dir))
+                   if os.path.isfile(os.path.join(artifacts_dir, filename))]
+        if not entries:
+            raise HTTPException(403, detail='Artifacts you required do not exist.')
+        return StreamingResponse(
+            iter_zip(entries),
+            media_type='application/zip',
+            headers={'Content-Disposition': f'attachment; filename="{artifact_id}.zip"'}
+        )
@@ -1,35 +1,138 @@
 import asyncio
+import json
 import socket
 import time
+from collections import OrderedDict
 from typing import List, Dict
 
 from fastapi import HTTPException
+from starlette.responses import StreamingResponse
 
-from core import Plugin
+from core import Param, Plugin
 
+# comma separated ports or port ranges, e.g. 22,80,8000-8100
+PORTS_PATTERN = r'\d{1,5}(-\d{1,5})?(,\d{1,5}(-\d{1,5})?)*'
+MAX_PORTS = 1000
 
-def check_range(nums: list, min_val: int, max_val: int):
-    for num in nums:
-        if num < min_val or num > max_val:
-            return True
-    return False
+
+class TargetState:
+    def __init__(self, max_connections: int):
+        self.max_connections = max_connections
+        self.semaphore = None
+        self.users = 0
+        # smoothed RTT and its variance, estimated the same way TCP does (RFC 6298)
+        self.srtt = None
+        self.rttvar = None
+
+    def observe(self, rtt: float):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+
+class ConnectScheduler:
+    """
+    所有扫描请求共享的连接调度器
+    * 限制全局与单个目标的并发连接数，避免耗尽文件描述符
+    * 根据观测到的 RTT 调整连接超时，关闭/被过滤的端口不必每个都等满最大超时
+    """
+
+    def __init__(self, max_connections: int = 512, max_per_target: int = 128,
+                 min_timeout: float = 0.3, max_timeout: float = 3.0, max_targets: int = 1024):
+        self.max_connections = max_connections
+        self.max_per_target = max_per_target
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.max_targets = max_targets
+        self.semaphore = None
+        self.targets: OrderedDict[str, TargetState] = OrderedDict()
+
+    def target(self, host: str) -> TargetState:
+        state = self.targets.get(host)
+        if state is None:
+            state = self.targets[host] = TargetState(self.max_per_target)
+            idle = [h for h, t in self.targets.items() if t.users == 0 and h != host]
+            for h in idle[:max(0, len(self.targets) - self.max_targets)]:
+                self.targets.pop(h)
+        self.targets.move_to_end(host)
+        return state
+
+    def timeout_for(self, state: TargetState):
+        if state.srtt is None:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, state.srtt + 4 * state.rttvar))
+
+    async def connect(self, host: str, port: int) -> bool:
+        """
+        尝试建立 TCP 连接
+        :param host:    目标地址
+        :param port:    端口
+        :return:        端口是否开放
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_connections)
+        state = self.target(host)
+        if state.semaphore is None:
+            state.semaphore = asyncio.Semaphore(state.max_connections)
+        state.users += 1
+        try:
+            async with state.semaphore, self.semaphore:
+                t1 = time.monotonic()
+                try:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port),
+                                                            timeout=self.timeout_for(state))
+                except ConnectionRefusedError:
+                    # a RST is as good an RTT sample as a SYN-ACK
+                    state.observe(time.monotonic() - t1)
+                    return False
+                except (asyncio.TimeoutError, OSError):
+                    return False
+                state.observe(time.monotonic() - t1)
+                writer.close()
+                return True
+        finally:
+            state.users -= 1
+
+
+def ports_cost(params: dict) -> float:
+    # every 100 ports weigh as much as one ordinary call
+    return max(1, len(Portscan.parse_ports(params.get('ports') or '')) / 100)
 
 
 class Portscan(Plugin):
+    _method_costs = {'scan': ports_cost, 'scan_stream': ports_cost}
+    _max_concurrency = 16
+    _response_methods = ('scan_stream',)
 
     def __init__(self):
         super().__init__()
         self.cfg = None
         self.PORT_SERVICES = None
         self.HOST_BLACKLIST = None
+        self.scheduler = None
 
     def load(self):
         self.cfg = self.ConfigUtil(self.data_dir(), 'config.json', {
             'port_services': {},
-            'host_blacklist': []
+            'host_blacklist': [],
+            'scheduler': {
+                'max_connections': 512,
+                'max_per_target': 128,
+                'min_timeout': 0.3,
+                'max_timeout': 3.0
+            }
         })
         self.PORT_SERVICES = self.cfg.get_cfg('port_services')
         self.HOST_BLACKLIST = self.cfg.get_cfg('host_blacklist')
+        scheduler_cfg = self.cfg.get_cfg('scheduler', {})
+        self.scheduler = ConnectScheduler(
+            max_connections=scheduler_cfg.get('max_connections', 512),
+            max_per_target=scheduler_cfg.get('max_per_target', 128),
+            min_timeout=scheduler_cfg.get('min_timeout', 0.3),
+            max_timeout=scheduler_cfg.get('max_timeout', 3.0)
+        )
 
     def unload(self):
         pass
@@ -37,20 +140,18 @@ class Portscan(Plugin):
     def activate(self):
         super().activate()
 
-    def __getmethods__(self, exclude: List[str] = None):
-        return super().__getmethods__(['scan_port', 'scan_ports', 'scanner'])
-
-    def params_validater(self, params):
-        if not params.get('host'):
-            return 'host is required'
-        if not params.get('ports'):
-            return 'ports is required'
-        return super().params_validater(params)
+    def methods(self):
+        target = {
+            'host': Param(str, max_length=253),
+            'ports': Param(str, pattern=PORTS_PATTERN),
+        }
+        return {
+            'scan': target,
+            'scan_stream': {**target, 'format': Param(str, default='ndjson', choices=('ndjson', 'sse'))},
+        }
 
-    async def scan_port(self, host: str, port: int, results: Dict[int, dict]) -> None:
-        try:
-            conn = asyncio.open_connection(host, port)
-            reader, writer = await asyncio.wait_for(conn, timeout=3)
+    async def scan_port(self, host: str, port: int, results: Dict[int, dict]) -> dict:
+        if await self.scheduler.connect(host, port):
             results[port] = {
                 'address': host,
                 'port': port,
@@ -60,9 +161,7 @@ class Portscan(Plugin):
             service = self.PORT_SERVICES.get(str(port))
             if service:
                 results[port]['service'] = service
-            writer.close()
-        except (asyncio.TimeoutError, ConnectionRefusedError, OSError):
-            pass
+            return results[port]
 
     async def scan_ports(self, ip: str, ports: List[int]) -> Dict[int, str]:
         results = {}
@@ -71,31 +170,38 @@ class Portscan(Plugin):
         await asyncio.gather(*tasks)
         return results
 
-    async def scanner(self, host: str, ports: str) -> Dict[str, dict]:
+    @staticmethod
+    def parse_ports(ports: str) -> List[int]:
         port_list = []
         for p in ports.split(","):
             if "-" in p:
-                start_port, end_port = map(int, p.split("-"))
-                if check_range(list(range(start_port, end_port + 1)), 1, 65535):
+                start_port, end_port = sorted(map(int, p.split("-")))
+                if start_port < 1 or end_port > 65535:
                     raise HTTPException(status_code=400, detail=f"invalid port range '{p}'")
-                if start_port > end_port:
-                    start_port, end_port = end_port, start_port
-                port_list += list(range(start_port, end_port + 1))
+                count = end_port - start_port + 1
             else:
-                if not p.isdigit():
-                    raise HTTPException(status_code=400, detail=f"invalid port '{p}'")
-                if check_range([int(p)], 1, 65535):
+                if not p.isdigit() or not 1 <= int(p) <= 65535:
                     raise HTTPException(status_code=400, detail=f"invalid port '{p}'")
-                port_list.append(int(p))
-        if len(port_list) > 1000:
-            raise HTTPException(status_code=419, detail=f"too many ports, max 1000")
-        t1 = time.time()
+                start_port, count = int(p), 1
+            # bounds are checked before the range is materialized
+            if len(port_list) + count > MAX_PORTS:
+                raise HTTPException(status_code=419, detail=f"too many ports, max {MAX_PORTS}")
+            port_list.extend(range(start_port, start_port + count))
+        return port_list
+
+    @staticmethod
+    async def resolve(host: str) -> str:
         try:
             addr_info = await asyncio.get_event_loop().getaddrinfo(host, None)
-            ip_addr = addr_info[0][4][0]
-            results = await self.scan_ports(ip_addr, port_list)
         except socket.gaierror as e:
             raise HTTPException(status_code=400, detail=f"can not resolve '{host}'") from e
+        return addr_info[0][4][0]
+
+    async def scanner(self, host: str, ports: str) -> Dict[str, dict]:
+        port_list = self.parse_ports(ports)
+        t1 = time.time()
+        ip_addr = await self.resolve(host)
+        results = await self.scan_ports(ip_addr, port_list)
         self.logger.info(f"scan {host}({ip_addr}) for {len(port_list)} port(s) in {round(time.time() - t1, 3)}s")
         return {
             "host": ip_addr,
@@ -104,8 +210,55 @@ class Portscan(Plugin):
             "ports": {k: results[k] for k in sorted(results)}
         }
 
+    def check_host(self, host: str):
+        for blocked_host in self.HOST_BLACKLIST:
+            if blocked_host in host:
+                raise HTTPException(status_code=403, detail=f"host '{blocked_host}' is not allowed")
+
     async def scan(self, params: dict) -> Dict[str, dict]:
-        for host in self.HOST_BLACKLIST:
-            if host in params.get('host'):
-                raise HTTPException(status_code=403, detail=f"host '{host}' is not allowed")
+        self.check_host(params.get('host'))
         return await self.scanner(params.get('host'), params.get('ports'))
+
+    async def stream_events(self, host: str, ip_addr: str, port_list: List[int]):
+        t1 = time.time()
+        results = {}
+        tasks = [asyncio.create_task(self.scan_port(ip_addr, port, results)) for port in port_list]
+        try:
+            for task in asyncio.as_completed(tasks):
+                result = await task
+                if result is not None:
+                    yield 'open', result
+        finally:
+            # client went away before the scan finished
+            for task in tasks:
+                task.cancel()
+        self.logger.info(f"scan {host}({ip_addr}) for {len(port_list)} port(s) in {round(time.time() - t1, 3)}s")
+        yield 'summary', {
+            "host": ip_addr,
+            "total": len(port_list),
+            "open": len(results),
+            "ports": sorted(results),
+            "spent": round(time.time() - t1, 3)
+        }
+
+    async def scan_stream(self, params: dict) -> StreamingResponse:
+        """
+        流式扫描：每确认一个开放端口即输出一条事件，最后输出汇总
+        * format 为 ndjson（默认）或 sse
+        """
+        self.check_host(params.get('host'))
+        stream_format = params.get('format', 'ndjson')
+        port_list = self.parse_ports(params.get('ports'))
+        ip_addr = await self.resolve(params.get('host'))
+
+        async def ndjson():
+            async for event, data in self.stream_events(params.get('host'), ip_addr, port_list):
+                yield json.dumps({'event': event, **data}) + '\n'
+
+        async def sse():
+            async for event, data in self.stream_events(params.get('host'), ip_addr, port_list):
+                yield f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+        if stream_format == 'sse':
+            return StreamingResponse(sse(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+        return StreamingResponse(ndjson(), media_type='application/x-ndjson')
@@ -1,11 +1,19 @@
 import asyncio
 import hashlib
+import importlib
+import io
 import os
 import struct
 import subprocess
-import time
+from importlib import metadata
 
-from core import Plugin
+from fastapi import UploadFile
+
+from core import Param, Plugin, ResultCache, WarmWorkerPool
+from core.metrics import plugin_subprocess_duration
+
+# SHA-256 of pycdc.zip, when unset the first download is pinned
+PYCDC_PACKAGE_SHA256 = os.getenv('PYCDC_PACKAGE_SHA256') or None
 
 PYTHON_MAGIC = {
     # Python 1
@@ -135,7 +143,48 @@ PYTHON_MAGIC = {
 }
 
 
+# decompyle3 banner lines, which of them appear depends on the pyc header and on sys.version
+DECOMPYLE3_BANNER = (
+    '# -*- coding:',
+    '# decompyle3 version ',
+    '# Python bytecode version base ',
+    '# Decompiled from: ',
+    '# [',
+    '# Embedded file name: ',
+    '# Compiled at: ',
+    '# Size of source mod 2**32: ',
+)
+
+
+def strip_decompyle3_banner(lines: list):
+    """
+    去掉 decompyle3 输出开头的版本信息
+    """
+    start = 0
+    while start < len(lines) and lines[start].startswith(DECOMPYLE3_BANNER):
+        start += 1
+    return lines[start:]
+
+
+def decompyle3_decompile(fullpath: str):
+    """
+    在常驻工作进程中调用 decompyle3，输出与命令行一致
+    :return: 是否成功、输出
+    """
+    from decompyle3.main import decompile_file
+    out = io.StringIO()
+    try:
+        decompile_file(fullpath, out)
+    except Exception as e:
+        out.write(f'# {type(e).__name__}: {e}\n')
+        return False, out.getvalue().encode('utf-8')
+    return True, out.getvalue().encode('utf-8')
+
+
 class PycUtil:
+    def __init__(self, worker_pool: WarmWorkerPool = None):
+        self.worker_pool = worker_pool
+
     @staticmethod
     def magic_to_version(magic_word):
         if not isinstance(magic_word, int):
@@ -158,89 +207,167 @@ class PycUtil:
         magic_word = int.from_bytes(magic[:2], 'little')
         return magic_word
 
+    @staticmethod
+    def select_decompiler(pyc_version, pycdc_path: str = 'pycdc'):
+        """
+        根据 pyc 版本选择反编译器
+        :return: 可执行文件、反编译器名称、输出需跳过的行数（decompyle3 的版本信息按前缀去除）
+        """
+        # >= 3.9
+        if pyc_version[0] >= 3 and pyc_version[1] >= 9:
+            return pycdc_path, 'Decompyle++ (pycdc)', 2
+        return 'decompyle3', 'decompyle3', 0
+
+    @staticmethod
+    def decompiler_version(decompiler: str):
+        """
+        反编译器版本标识，用作缓存键的一部分
+        * decompyle3 取包版本；pycdc 没有版本号，取可执行文件的哈希
+        * 取不到时返回 None，此时不应缓存结果
+        """
+        if decompiler == 'decompyle3':
+            try:
+                return f'decompyle3-{metadata.version("decompyle3")}'
+            except metadata.PackageNotFoundError:
+                return None
+        try:
+            with open(decompiler, 'rb') as f:
+                return f'pycdc-{hashlib.sha256(f.read()).hexdigest()[:12]}'
+        except OSError:
+            return None
+
     async def decompile_pyc(self, fullpath: str, output_comment: str = '# Decompiled on CTFever Premium',
                             pycdc_path: str = 'pycdc'):
+        """
+        :return: 反编译输出、是否成功（失败的输出不应缓存）
+        """
         pyc_version = self.magic_to_version(self.fetch_pyc_magic(fullpath))
-        # >= 3.9
-        if pyc_version[0] >= 3 and pyc_version[1] >= 9:
-            decompiler = pycdc_path
-            decompiler_name = 'Decompyle++ (pycdc)'
-            split_by = 2
+        decompiler, decompiler_name, split_by = self.select_decompiler(pyc_version, pycdc_path)
+        if decompiler == 'decompyle3' and self.worker_pool is not None:
+            with plugin_subprocess_duration.time(plugin='pycdecompile', tool='decompyle3'):
+                succeeded, stdout = await self.worker_pool.submit(decompyle3_decompile, fullpath)
+            encoding, linesep = 'utf-8', '\n'
         else:
-            decompiler = 'decompyle3'
-            decompiler_name = 'decompyle3'
-            split_by = 7
-        subp = await asyncio.create_subprocess_shell(
-            f'{decompiler} {fullpath}',
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT
-        )
-        stdout, stderr = await subp.communicate()
+            with plugin_subprocess_duration.time(plugin='pycdecompile', tool=os.path.basename(decompiler)):
+                subp = await asyncio.create_subprocess_shell(
+                    f'{decompiler} {fullpath}',
+                    shell=True,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT
+                )
+                stdout, stderr = await subp.communicate()
+            succeeded = subp.returncode == 0
+            encoding, linesep = ('gbk' if os.name == 'nt' else 'utf-8'), os.linesep
         # output = stdout.decode(encoding=('gbk' if os.name == 'nt' else 'utf-8'), errors='replace')[split_by:-1]
-        output = os.linesep.join(stdout.decode(
-            encoding=('gbk' if os.name == 'nt' else 'utf-8'),
+        lines = stdout.decode(
+            encoding=encoding,
             errors='replace'
-        ).strip('\n').split(os.linesep)[split_by:])
+        ).strip('\n').split(linesep)[split_by:]
+        if decompiler == 'decompyle3':
+            lines = strip_decompyle3_banner(lines)
+        output = linesep.join(lines)
         return f'{output_comment}\n' \
                f'# Decompile engine: {decompiler_name}\n' \
                f'# Python version: {pyc_version[0]}.{pyc_version[1]}\n' \
-               f'{output}'
+               f'{output}', succeeded
 
 
 class Pycdecompile(Plugin):
+    _max_upload_size = 16 * 1024 * 1024
+    _temp_max_bytes = 64 * 1024 * 1024
+    _temp_max_age = 3600
+    # magic word and \r\n
+    _validate_prefix_size = 4
+    _method_costs = {'decompile': 5}
+    _max_concurrency = 8
+
     def __init__(self):
         super().__init__()
         self.pyc_util = None
+        self.cfg = None
+        self.decompile_cache = None
+        self.decompiler_versions = {}
 
     def load(self):
         self.fetch_data_package(
             'https://resource.uniiem.com/index.php?user/publicLink&fid=076bstR_k43lhccT-Iv3z5qq6eIuM9dmBYkrH4qp6Lp-'
             'PxxeRoK--vl_iePuie7TNelyZth6q_Ev1dXYuxcIifWJI5RuT9CtINNySWNbCtHxetN8ptQpgsNsoBTUPRf0AKnXx8ys9IyEUrAKISG'
-            '77MIlvv_jORxRCmHs8Lyj0ExhA_wH36_v0zdrpVFmGUzorPhRaQ&file_name=/pycdc.zip'
+            '77MIlvv_jORxRCmHs8Lyj0ExhA_wH36_v0zdrpVFmGUzorPhRaQ&file_name=/pycdc.zip',
+            sha256=PYCDC_PACKAGE_SHA256
         )
 
     def unload(self):
-        pass
+        if self.pyc_util is not None and self.pyc_util.worker_pool is not None:
+            self.pyc_util.worker_pool.shutdown()
 
     def activate(self):
-        self.pyc_util = PycUtil()
+        self.cfg = self.ConfigUtil(self.data_dir(), 'config.json', {
+            'cache': {
+                'max_entries': 512,
+                'max_bytes': 256 * 1024 * 1024,
+                'max_age': None
+            },
+            'workers': {
+                'workers': 2,
+                'queue_size': 16,
+                'timeout': 30,
+                'max_jobs': 100
+            }
+        })
+        workers_cfg = self.cfg.get_cfg('workers', {})
+        self.pyc_util = PycUtil(WarmWorkerPool(
+            'decompyle3',
+            workers=workers_cfg.get('workers', 2),
+            queue_size=workers_cfg.get('queue_size', 16),
+            initializer=importlib.import_module,
+            initargs=('decompyle3.main',),
+            timeout=workers_cfg.get('timeout', 30),
+            max_jobs=workers_cfg.get('max_jobs', 100)
+        ))
+        cache_cfg = self.cfg.get_cfg('cache', {})
+        self.decompile_cache = ResultCache(
+            os.path.join(self.data_dir(), 'cache'),
+            max_entries=cache_cfg.get('max_entries', 512),
+            max_bytes=cache_cfg.get('max_bytes'),
+            max_age=cache_cfg.get('max_age')
+        )
 
-    async def params_validater(self, params):
-        if not params.get('file'):
-            return 'file is required'
-        file_content = await params['file'].read()
-        if len(file_content) < 4:
+    def methods(self):
+        return {'decompile': {'file': Param(UploadFile)}}
+
+    def params_validater(self, params, prefix: bytes = None):
+        if not prefix or len(prefix) < 4:
             return 'file is required'
-        if self.pyc_util.fetch_pyc_magic_from_bytes(file_content) not in PYTHON_MAGIC:
+        if self.pyc_util.fetch_pyc_magic_from_bytes(prefix) not in PYTHON_MAGIC:
             return 'file is not a valid pyc file'
         return False
 
     async def decompile(self, params):
-        await params.get('file').seek(0)
         file_name = params.get('file').filename
-        file_basename, file_ext = os.path.splitext(file_name)
-        file_name_temp = f'{file_basename}_{hashlib.md5(str(time.time()).encode()).hexdigest()[:6]}{file_ext}'
-        file_content = await params.get('file').read()
-        version = self.pyc_util.magic_to_version(self.pyc_util.fetch_pyc_magic_from_bytes(file_content))
-        temporal_dir = os.path.join(self.data_dir(), 'temp')
-        file_save_path = os.path.join(temporal_dir, file_name_temp)
-        file_save_dir = os.path.dirname(file_save_path)
-        if not os.path.exists(file_save_dir):
-            os.makedirs(file_save_dir)
-        with open(file_save_path, 'wb') as f:
-            f.write(file_content)
-        # if not on windows, grant execute permission to pycdc
-        if os.name != 'nt':
-            os.chmod(os.path.join(self.data_dir(), 'pycdc', 'pycdc'), 0o755)
-        decompile_output = await self.pyc_util.decompile_pyc(
-            file_save_path,
-            pycdc_path=os.path.join(self.data_dir(), 'pycdc', 'pycdc')
-        )
-        if len(os.listdir(temporal_dir)) > 20:
-            files = os.listdir(temporal_dir)
-            files.sort(key=lambda fn: os.path.getmtime(os.path.join(temporal_dir, fn)))
-            os.remove(os.path.join(temporal_dir, files[0]))
+        upload = await self.spool_upload_file(params.get('file'))
+        file_save_path = upload.path
+        version = self.pyc_util.magic_to_version(self.pyc_util.fetch_pyc_magic(file_save_path))
+        pycdc_path = os.path.join(self.data_dir(), 'pycdc', 'pycdc')
+        decompiler = self.pyc_util.select_decompiler(version, pycdc_path)[0]
+        decompiler_version = self.decompiler_versions.get(decompiler)
+        if decompiler_version is None:
+            decompiler_version = self.pyc_util.decompiler_version(decompiler)
+            # unknown until the decompiler is installed, so check again next time
+            if decompiler_version is not None:
+                self.decompiler_versions[decompiler] = decompiler_version
+        cache_key = f'{upload.sha256}-{decompiler_version}' if decompiler_version is not None else None
+        decompile_output = None
+        if cache_key is not None:
+            decompile_output = await asyncio.to_thread(self.decompile_cache.get, cache_key)
+        if decompile_output is None:
+            # if not on windows, grant execute permission to pycdc
+            if os.name != 'nt':
+                os.chmod(pycdc_path, 0o755)
+            decompile_output, succeeded = await self.pyc_util.decompile_pyc(file_save_path, pycdc_path=pycdc_path)
+            if succeeded and cache_key is not None:
+                await asyncio.to_thread(self.decompile_cache.set, cache_key, decompile_output)
+        else:
+            self.remove_temporary_file(file_save_path)
         return {
             'version': f'{version[0]}.{version[1]}',
             'version_tuple': version,
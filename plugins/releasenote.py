@@ -1,16 +1,38 @@
-import json
+import asyncio
+import bisect
 import os
 import time
 
-from fastapi import HTTPException, status
+from core import Param, Plugin, PrecomputedResponse
 
-from core import Plugin
+
+class ReleaseIndex:
+    """
+    按时间戳排序的发布记录索引，并预先生成常用接口的响应
+    """
+
+    def __init__(self, cfg: dict, last_modified: float):
+        self.last_modified = last_modified
+        ascending = sorted(cfg.get('releases', []), key=lambda r: r['timestamp'])
+        self.timestamps = [release['timestamp'] for release in ascending]
+        self.descending = ascending[::-1]
+        self.by_timestamp = {release['timestamp']: release for release in ascending}
+        self.latest = self.by_timestamp.get(cfg.get('latest'))
+        self.releases_response = PrecomputedResponse({**cfg, 'releases': self.descending}, last_modified)
+        self.latest_response = PrecomputedResponse(self.latest, last_modified)
+
+    def behind(self, timestamp: int):
+        # releases newer than timestamp are the head of the descending list
+        return self.descending[:len(self.timestamps) - bisect.bisect_right(self.timestamps, timestamp)]
 
 
 class Releasenote(Plugin):
+    _get_methods = ('releases', 'releases_behind', 'latest_release')
+
     def __init__(self):
         super().__init__()
         self.release_ctl = None
+        self.index = None
 
     def load(self):
         self.release_ctl = self.ConfigUtil(self.data_dir(), 'releases.json', {
@@ -24,48 +46,62 @@ class Releasenote(Plugin):
             ]
         })
 
+        self.rebuild_index()
+
     def unload(self):
         pass
 
     def activate(self):
         super().activate()
 
+    def methods(self):
+        return {
+            'releases': {},
+            'releases_behind': {'timestamp': Param(int, minimum=0)},
+            'push_release': {
+                'title': Param(str, required=False),
+                'version': Param(str),
+                'content': Param(str),
+            },
+            'latest_release': {},
+        }
+
+    def rebuild_index(self, last_modified: float = None):
+        if last_modified is None:
+            last_modified = os.path.getmtime(self.release_ctl.cfg_path)
+        self.index = ReleaseIndex(self.release_ctl.cfg, last_modified)
+
+    def get_index(self) -> ReleaseIndex:
+        # releases.json may have been edited by hand or by another worker
+        if self.release_ctl.reload_if_changed() or self.index is None:
+            self.rebuild_index()
+        return self.index
+
     def releases(self):
-        full_releases = self.release_ctl.get_all_cfg()
-        full_releases['releases'] = sorted(full_releases['releases'], key=lambda r: r['timestamp'], reverse=True)
-        return full_releases
+        return self.get_index().releases_response.response()
 
     def releases_behind(self, params):
-        releases = self.release_ctl.get_cfg('releases')
-        return sorted(
-            [release for release in releases if release['timestamp'] > int(params['timestamp'])],
-            key=lambda r: r['timestamp'], reverse=True
-        )
-
-    def push_release(self, params):
-        title = params.get('title', None)
-        version = params.get('version', None)
-        content = params.get('content', None)
-        if version is None or content is None:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='invalid params')
-        timestamp = int(time.time())
-        releases = self.release_ctl.get_cfg('releases')
-        releases.append({
-            'timestamp': timestamp,
-            'title': title,
-            'version': version,
-            'content': content
+        index = self.get_index()
+        return PrecomputedResponse(index.behind(int(params['timestamp'])), index.last_modified).response()
+
+    def append_release(self, release: dict):
+        with self.release_ctl.transaction():
+            releases = self.release_ctl.get_cfg('releases')
+            releases.append(release)
+            self.release_ctl.set_cfg('releases', releases)
+            self.release_ctl.set_cfg('latest', release['timestamp'])
+        # the transaction has written releases.json, its mtime is the time of this change
+        self.rebuild_index()
+
+    async def push_release(self, params):
+        # the transaction waits for the file lock shared by all workers and writes the file
+        await asyncio.to_thread(self.append_release, {
+            'timestamp': int(time.time()),
+            'title': params.get('title', None),
+            'version': params.get('version', None),
+            'content': params.get('content', None)
         })
-        self.release_ctl.set_cfg('releases', releases)
-        self.release_ctl.set_cfg('latest', timestamp)
         return 'ok'
 
     def latest_release(self):
-        latest_timestamp = self.release_ctl.get_cfg('latest', None)
-        if latest_timestamp is None:
-            return None
-        releases = self.release_ctl.get_cfg('releases', [])
-        for release in releases:
-            if release['timestamp'] == latest_timestamp:
-                return release
-        return None
+        return self.get_index().latest_response.response()
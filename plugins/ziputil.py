@@ -1,13 +1,14 @@
 import asyncio
+import mmap
 import os
-import re
-import subprocess
+import struct
 import time
 
 from fastapi import HTTPException, UploadFile
+from starlette.background import BackgroundTask
 from starlette.responses import FileResponse
 
-from core import Plugin
+from core import Param, Plugin, upload_size
 
 
 def is_zip(binary: bytes):
@@ -15,48 +16,175 @@ def is_zip(binary: bytes):
     return binary.startswith(flag_zip)
 
 
-def is_pseudo_encryption(binary: bytes):
+SIG_LOCAL_HEADER = b'PK\x03\x04'
+SIG_CENTRAL_HEADER = b'PK\x01\x02'
+SIG_EOCD = b'PK\x05\x06'
+SIG_ZIP64_EOCD = b'PK\x06\x06'
+SIG_ZIP64_LOCATOR = b'PK\x06\x07'
+
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<4sHHHHHHIIIHHHHHII')
+EOCD = struct.Struct('<4sHHHHIIH')
+ZIP64_EOCD = struct.Struct('<4sQHHIIQQQQ')
+ZIP64_LOCATOR = struct.Struct('<4sIQI')
+
+# offset of the general purpose bit flag inside each header
+LOCAL_FLAG_OFFSET = 6
+CENTRAL_FLAG_OFFSET = 8
+# EOCD (22 bytes) plus the longest possible archive comment
+EOCD_SEARCH_SIZE = EOCD.size + 0xFFFF
+
+
+class ZipFormatError(ValueError):
+    pass
+
+
+def find_central_directory(mm: mmap.mmap):
+    """
+    Locate the central directory through the End of Central Directory record (and its ZIP64 variant)
+    :param mm:  Memory-mapped zip file
+    :return:    (offset of the central directory, number of entries)
+    """
+    search_start = max(0, len(mm) - EOCD_SEARCH_SIZE)
+    eocd_offset = mm.rfind(SIG_EOCD, search_start)
+    if eocd_offset < 0:
+        raise ZipFormatError('End of central directory record not found')
+    # the archive comment may contain the signature too, prefer the record whose comment ends the file
+    candidate = eocd_offset
+    while candidate >= 0:
+        if candidate + EOCD.size <= len(mm) and \
+                candidate + EOCD.size + EOCD.unpack_from(mm, candidate)[7] == len(mm):
+            eocd_offset = candidate
+            break
+        candidate = mm.rfind(SIG_EOCD, search_start, candidate)
+    _, _, _, _, entries, _, cd_offset, _ = EOCD.unpack_from(mm, eocd_offset)
+    locator_offset = eocd_offset - ZIP64_LOCATOR.size
+    if locator_offset >= 0 and mm[locator_offset:locator_offset + 4] == SIG_ZIP64_LOCATOR:
+        _, _, zip64_eocd_offset, _ = ZIP64_LOCATOR.unpack_from(mm, locator_offset)
+        if mm[zip64_eocd_offset:zip64_eocd_offset + 4] != SIG_ZIP64_EOCD:
+            raise ZipFormatError('ZIP64 end of central directory record not found')
+        _, _, _, _, _, _, _, entries, _, cd_offset = ZIP64_EOCD.unpack_from(mm, zip64_eocd_offset)
+    return cd_offset, entries
+
+
+def zip64_local_offset(extra: bytes, usize: int, csize: int, local_offset: int):
+    """
+    Read the real local header offset from the ZIP64 extended information extra field
+    """
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack_from('<HH', extra, pos)
+        if tag == 0x0001:
+            field = pos + 4
+            # the field only holds the values that overflowed, in this fixed order
+            for value in (usize, csize):
+                if value == 0xFFFFFFFF:
+                    field += 8
+            if local_offset == 0xFFFFFFFF:
+                return struct.unpack_from('<Q', extra, field)[0]
+            return local_offset
+        pos += 4 + size
+    return local_offset
+
+
+def iter_zip_entries(mm: mmap.mmap):
     """
-    Check if the zip file is pseudo encrypted
-    :param binary:  Zip file in bytes
-    :return:        1 if pseudo encrypted, 0 if true encrypted, -1 if not encrypted
+    Walk every central directory entry and its local file header
+    :param mm:  Memory-mapped zip file
+    :return:    Generator of (name, central header offset, local header offset)
     """
-    tag_content_block = b'\x50\x4B\x01\x02'
-    tag_file_header = b'\x50\x4B\x03\x04'
-    tag_file_footer = b'\x50\x4B\x05\x06'
-    flag_true = b'\x09\x00'
-    flag_none = b'\x00\x00'
-
-    print([m.start() for m in re.finditer(tag_file_header, binary)])
-    print([m.start() for m in re.finditer(tag_content_block, binary)])
-
-    flag_index = binary.find(tag_content_block)
-    if binary[6:8] == flag_none and binary[flag_index + 8:flag_index + 10] == flag_none:
-        result = -1
-    elif binary[6:8] == flag_true and binary[flag_index + 8:flag_index + 10] == flag_none:
-        result = -1
-    elif binary[6:8] == flag_none and binary[flag_index + 8:flag_index + 10] == flag_true:
-        result = 1
-    elif binary[6:8] == flag_true and binary[flag_index + 8:flag_index + 10] == flag_true:
-        result = 0
-    else:
-        result = -2
-    return result, [
-        [int(i) for i in binary[3:11]],
-        [int(i) for i in binary[flag_index + 5:flag_index + 13]],
-    ]
-
-
-# 将传入的 zip 文件 bytes 转为伪加密文件
-def convert2pseudo(binary: bytes, save_path: str):
-    flag_index = binary.find(b'\x50\x4B\x01\x02')
-    binary = binary[:6] + b'\x09\x00' + binary[8:flag_index + 8] + b'\x09\x00' + binary[flag_index + 10:]
-    with open(os.path.join(save_path, f'{int(time.time())}.zip'), 'wb') as fs:
-        fs.write(binary)
-    return os.path.join(save_path, f'{int(time.time())}.zip')
+    cd_offset, entries = find_central_directory(mm)
+    pos = cd_offset
+    for _ in range(entries):
+        if mm[pos:pos + 4] != SIG_CENTRAL_HEADER:
+            raise ZipFormatError(f'bad central directory entry at {pos}')
+        (_, _, _, _, _, _, _, _, csize, usize, name_len, extra_len, comment_len,
+         _, _, _, local_offset) = CENTRAL_HEADER.unpack_from(mm, pos)
+        name_offset = pos + CENTRAL_HEADER.size
+        name = mm[name_offset:name_offset + name_len].decode('utf-8', errors='replace')
+        if 0xFFFFFFFF in (csize, usize, local_offset):
+            extra = mm[name_offset + name_len:name_offset + name_len + extra_len]
+            local_offset = zip64_local_offset(extra, usize, csize, local_offset)
+        yield name, pos, local_offset
+        pos = name_offset + name_len + extra_len + comment_len
+
+
+def analyze_zip(path: str):
+    """
+    Check every entry of the zip file for (pseudo) encryption without loading it into memory
+    :param path:    Zip file path
+    :return:        (assert, characteristics, entries). For assert and each entry:
+                    1 if pseudo encrypted, 0 if true encrypted, -1 if not encrypted, -2 if malformed
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        entries = []
+        characteristics = []
+        for name, central_offset, local_offset in iter_zip_entries(mm):
+            central_flags = struct.unpack_from('<H', mm, central_offset + CENTRAL_FLAG_OFFSET)[0]
+            if mm[local_offset:local_offset + 4] != SIG_LOCAL_HEADER:
+                local_flags = None
+                result = -2
+            else:
+                local_flags = struct.unpack_from('<H', mm, local_offset + LOCAL_FLAG_OFFSET)[0]
+                if not central_flags & 1:
+                    result = -1
+                elif local_flags & 1:
+                    result = 0
+                else:
+                    result = 1
+            if not characteristics:
+                characteristics = [
+                    [int(i) for i in mm[local_offset + 3:local_offset + 11]],
+                    [int(i) for i in mm[central_offset + 5:central_offset + 13]],
+                ]
+            entries.append({
+                'name': name,
+                'assert': result,
+                'local_flags': local_flags,
+                'central_flags': central_flags,
+                'local_offset': local_offset,
+                'central_offset': central_offset,
+            })
+    results = {entry['assert'] for entry in entries}
+    for result in (1, 0, -2):
+        if result in results:
+            return result, characteristics, entries
+    return -1, characteristics, entries
+
+
+def set_encryption_flag(mm: mmap.mmap, offset: int):
+    flags = struct.unpack_from('<H', mm, offset)[0]
+    struct.pack_into('<H', mm, offset, flags | 1)
+
+
+# 将 zip 文件原地转为伪加密文件
+def convert2pseudo(path: str):
+    """
+    Set the encryption bit in the local and central header of every entry, in place
+    :param path:    Zip file path, patched in place
+    :return:        Number of patched entries
+    """
+    patched = 0
+    with open(path, 'r+b') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE) as mm:
+        for name, central_offset, local_offset in iter_zip_entries(mm):
+            if mm[local_offset:local_offset + 4] != SIG_LOCAL_HEADER:
+                raise ZipFormatError(f'bad local file header for {name} at {local_offset}')
+            set_encryption_flag(mm, local_offset + LOCAL_FLAG_OFFSET)
+            set_encryption_flag(mm, central_offset + CENTRAL_FLAG_OFFSET)
+            patched += 1
+        mm.flush()
+    return patched
+
+
+def upload_cost(params) -> float:
+    return 1 + upload_size(params['file']) / (16 * 1024 * 1024)
 
 
 class Ziputil(Plugin):
+    _max_upload_size = 512 * 1024 * 1024
+    _method_costs = {'pseudo_check': upload_cost, 'convert_to_pseudo': upload_cost}
+    _max_concurrency = 16
+    _response_methods = ('convert_to_pseudo',)
 
     def load(self):
         pass
@@ -67,29 +195,46 @@ class Ziputil(Plugin):
     def activate(self):
         super().activate()
 
-    @staticmethod
-    async def pseudo_check(params):
+    def methods(self):
+        return {
+            'pseudo_check': {'file': Param(UploadFile)},
+            'convert_to_pseudo': {'file': Param(UploadFile)},
+        }
+
+    async def pseudo_check(self, params):
         file: UploadFile = params.get('file', None)
-        if not file:
-            raise HTTPException(400, detail='No file provided')
-        file_content = await file.read()
-        if not is_zip(file_content):
-            raise HTTPException(400, detail='Not a zip file')
-        result, characteristics = is_pseudo_encryption(file_content)
+        upload = await self.spool_upload_file(file)
+        try:
+            with open(upload.path, 'rb') as f:
+                if not is_zip(f.read(4)):
+                    raise HTTPException(400, detail='Not a zip file')
+            result, characteristics, entries = await asyncio.to_thread(analyze_zip, upload.path)
+        except (ZipFormatError, struct.error) as e:
+            raise HTTPException(400, detail=f'Malformed zip file: {e}')
+        finally:
+            self.remove_temporary_file(upload.path)
         return {
             'assert': result,
             'characteristics': characteristics,
+            'entries': entries,
         }
 
     async def convert_to_pseudo(self, params):
         file: UploadFile = params.get('file', None)
-        if not file:
-            raise HTTPException(400, detail='No file provided')
-        file_content = await file.read()
-        if not is_zip(file_content):
-            raise HTTPException(400, detail='Not a zip file')
-        path = convert2pseudo(file_content, self._temp_dir)
+        # the spooled copy has a unique name, so it is patched in place and streamed back
+        upload = await self.spool_upload_file(file)
+        try:
+            with open(upload.path, 'rb') as f:
+                if not is_zip(f.read(4)):
+                    raise HTTPException(400, detail='Not a zip file')
+            await asyncio.to_thread(convert2pseudo, upload.path)
+        except BaseException as e:
+            self.remove_temporary_file(upload.path)
+            if isinstance(e, (ZipFormatError, struct.error)):
+                raise HTTPException(400, detail=f'Malformed zip file: {e}')
+            raise
         return FileResponse(
-            filename=os.path.basename(path),
-            path=path,
+            filename=f'{int(time.time())}.zip',
+            path=upload.path,
+            background=BackgroundTask(self.remove_temporary_file, upload.path)
         )
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from starlette.responses import StreamingResponse
+
+from core.admission import AdmissionController, TokenBuckets
+from core.http import ReleasingResponse
+from core.shared import SharedTokenBuckets
+
+
+def tokens_left(admission, client):
+    return admission.buckets.buckets[client][0]
+
+
+def test_charge_takes_tokens_until_empty():
+    admission = AdmissionController(capacity=10, refill_rate=0.001)
+    admission.charge('client', 6)
+    with pytest.raises(HTTPException) as e:
+        admission.charge('client', 6)
+    assert e.value.status_code == 429
+    assert int(e.value.headers['Retry-After']) >= 1
+    # other clients have their own bucket
+    admission.charge('other', 6)
+
+
+def test_refund_gives_the_cost_back():
+    admission = AdmissionController(capacity=10, refill_rate=0.001)
+    admission.charge('client', 6)
+    admission.refund('client', 6)
+    assert tokens_left(admission, 'client') == pytest.approx(10, abs=0.01)
+    admission.charge('client', 6)
+
+
+def test_refund_never_exceeds_capacity():
+    admission = AdmissionController(capacity=10, refill_rate=0.001)
+    admission.charge('client', 1)
+    admission.refund('client', 50)
+    assert tokens_left(admission, 'client') == 10
+
+
+def test_disabled_admission_charges_nothing():
+    admission = AdmissionController(capacity=10, refill_rate=0.001, enabled=False)
+    for _ in range(5):
+        admission.charge('client', 10)
+    admission.refund('client', 10)
+    assert admission.buckets.buckets == {}
+
+
+def test_shared_buckets_charge_and_refund(tmp_path):
+    path = str(tmp_path / 'shared.db')
+    first = AdmissionController(capacity=10, refill_rate=0.001, buckets=SharedTokenBuckets(path))
+    second = AdmissionController(capacity=10, refill_rate=0.001, buckets=SharedTokenBuckets(path))
+    first.charge('client', 6)
+    with pytest.raises(HTTPException):
+        second.charge('client', 6)
+    first.refund('client', 6)
+    second.charge('client', 6)
+
+
+def test_token_buckets_refill_over_time():
+    buckets = TokenBuckets()
+    assert buckets.take('client', 10, 10, 1000) == 0
+    assert buckets.take('client', 10, 10, 0.001) > 0
+
+
+def test_limit_rejects_when_queue_is_full():
+    admission = AdmissionController()
+
+    async def scenario():
+        async with admission.limit('plugin', 1, 0):
+            with pytest.raises(HTTPException) as e:
+                async with admission.limit('plugin', 1, 0):
+                    pass
+            assert e.value.status_code == 503
+        async with admission.limit('plugin', 1, 0):
+            pass
+
+    asyncio.run(scenario())
+
+
+def test_releasing_response_releases_when_body_never_runs():
+    released = []
+    started = []
+
+    async def body():
+        started.append(True)
+        yield b'data'
+
+    async def release():
+        released.append(True)
+
+    async def receive():
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        # the client is gone before the headers are out
+        await asyncio.sleep(10)
+
+    async def scenario():
+        response = ReleasingResponse(StreamingResponse(body()), release)
+        await response({'type': 'http', 'method': 'GET', 'headers': []}, receive, send)
+
+    asyncio.run(scenario())
+    assert released == [True]
+    assert started == []
+
+
+def test_releasing_response_releases_on_send_error():
+    released = []
+
+    async def body():
+        yield b'data'
+
+    async def release():
+        released.append(True)
+
+    async def receive():
+        await asyncio.sleep(10)
+
+    async def send(message):
+        raise OSError('connection lost')
+
+    async def scenario():
+        response = ReleasingResponse(StreamingResponse(body()), release)
+        await response({'type': 'http', 'method': 'GET', 'headers': []}, receive, send)
+
+    with pytest.raises(Exception):
+        asyncio.run(scenario())
+    assert released == [True]
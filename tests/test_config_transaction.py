@@ -0,0 +1,57 @@
+import json
+import multiprocessing
+import os
+import time
+
+from core.plugin import Plugin
+
+
+def push_release(data_dir, name, barrier):
+    cfg = Plugin.ConfigUtil(data_dir, 'releases.json', {'releases': []})
+    barrier.wait()
+    with cfg.transaction():
+        releases = cfg.get_cfg('releases')
+        releases.append(name)
+        cfg.set_cfg('releases', releases)
+        # give the other worker time to read the file if the lock did not keep it out
+        time.sleep(0.2)
+
+
+def set_key(data_dir, key, barrier):
+    cfg = Plugin.ConfigUtil(data_dir, 'config.json', {})
+    barrier.wait()
+    cfg.set_cfg(key, True)
+
+
+def run_workers(target, data_dir, names):
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(len(names))
+    processes = [context.Process(target=target, args=(data_dir, name, barrier)) for name in names]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=30)
+        assert process.exitcode == 0
+
+
+def read_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_concurrent_transactions_keep_every_change(tmp_path):
+    run_workers(push_release, str(tmp_path), ['a', 'b'])
+    assert sorted(read_json(os.path.join(tmp_path, 'releases.json'))['releases']) == ['a', 'b']
+
+
+def test_writes_merge_with_other_workers(tmp_path):
+    run_workers(set_key, str(tmp_path), ['a', 'b'])
+    assert read_json(os.path.join(tmp_path, 'config.json')) == {'a': True, 'b': True}
+
+
+def test_transaction_writes_before_releasing_lock(tmp_path):
+    cfg = Plugin.ConfigUtil(str(tmp_path), 'config.json', {'count': 0})
+    with cfg.transaction():
+        cfg.set_cfg('count', cfg.get_cfg('count') + 1)
+    assert read_json(os.path.join(tmp_path, 'config.json')) == {'count': 1}
+    assert not cfg.pending
@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from core.http import RangeFileResponse, parse_range
+
+DATA = bytes(range(100))
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=10-19', (10, 19)),
+    ('bytes=90-200', (90, 99)),
+    ('bytes=95-', (95, 99)),
+    ('bytes=-10', (90, 99)),
+    ('bytes=-500', (0, 99)),
+    (' bytes=0-0 ', (0, 0)),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, len(DATA)) == expected
+
+
+@pytest.mark.parametrize('header', [
+    # last-pos before first-pos is invalid and ignored
+    'bytes=10-5',
+    'bytes=-',
+    'bytes=0-1,5-6',
+    'items=0-1',
+    'bytes=a-b',
+])
+def test_parse_range_ignores_invalid_headers(header):
+    assert parse_range(header, len(DATA)) is None
+
+
+@pytest.mark.parametrize('header', ['bytes=100-', 'bytes=100-200', 'bytes=-0'])
+def test_parse_range_rejects_unsatisfiable_ranges(header):
+    with pytest.raises(ValueError):
+        parse_range(header, len(DATA))
+
+
+def test_parse_range_suffix_of_empty_file():
+    assert parse_range('bytes=-10', 0) is None
+
+
+def fetch(path, headers=None, method='GET'):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        'type': 'http',
+        'method': method,
+        'headers': [(key.lower().encode(), value.encode()) for key, value in (headers or {}).items()],
+    }
+    asyncio.run(RangeFileResponse(path)(scope, receive, send))
+    start = messages[0]
+    response_headers = {key.decode(): value.decode() for key, value in start['headers']}
+    body = b''.join(message.get('body', b'') for message in messages[1:])
+    return start['status'], response_headers, body
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(DATA)
+    return str(path)
+
+
+def test_full_response_without_range(data_file):
+    status, headers, body = fetch(data_file)
+    assert status == 200
+    assert headers['accept-ranges'] == 'bytes'
+    assert body == DATA
+
+
+@pytest.mark.parametrize('header, start, end', [
+    ('bytes=10-19', 10, 19),
+    ('bytes=-10', 90, 99),
+    ('bytes=95-', 95, 99),
+])
+def test_single_range(data_file, header, start, end):
+    status, headers, body = fetch(data_file, {'Range': header})
+    assert status == 206
+    assert headers['content-range'] == f'bytes {start}-{end}/{len(DATA)}'
+    assert headers['content-length'] == str(end - start + 1)
+    assert body == DATA[start:end + 1]
+
+
+@pytest.mark.parametrize('header', ['bytes=10-5', 'bytes=0-1,5-6'])
+def test_invalid_or_multi_range_gets_full_response(data_file, header):
+    status, headers, body = fetch(data_file, {'Range': header})
+    assert status == 200
+    assert 'content-range' not in headers
+    assert body == DATA
+
+
+def test_unsatisfiable_range(data_file):
+    status, headers, body = fetch(data_file, {'Range': 'bytes=100-'})
+    assert status == 416
+    assert headers['content-range'] == f'bytes */{len(DATA)}'
+
+
+def test_if_range(data_file):
+    _, headers, _ = fetch(data_file)
+    status, _, body = fetch(data_file, {'Range': 'bytes=0-9', 'If-Range': headers['etag']})
+    assert (status, body) == (206, DATA[:10])
+    status, _, body = fetch(data_file, {'Range': 'bytes=0-9', 'If-Range': headers['last-modified']})
+    assert (status, body) == (206, DATA[:10])
+    # the representation changed, send all of it
+    status, _, body = fetch(data_file, {'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert (status, body) == (200, DATA)
+
+
+def test_head_sends_no_body(data_file):
+    status, headers, body = fetch(data_file, {'Range': 'bytes=0-9'}, method='HEAD')
+    assert status == 206
+    assert headers['content-length'] == '10'
+    assert body == b''
@@ -0,0 +1,51 @@
+import os
+
+from core.janitor import TempJanitor, TempQuota
+
+
+def write(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+    return path
+
+
+def test_untrack_drops_removed_files(tmp_path):
+    janitor = TempJanitor()
+    janitor.register('test', str(tmp_path))
+    try:
+        upload = write(str(tmp_path / 'upload.bin'), 10)
+        janitor.track('test', upload)
+        os.remove(upload)
+        janitor.untrack('test', upload)
+        assert janitor.usage()['test']['files'] == 0
+        assert janitor.usage()['test']['bytes'] == 0
+    finally:
+        janitor.unregister('test')
+
+
+def test_untrack_directory_drops_its_files(tmp_path):
+    quota = TempQuota(str(tmp_path))
+    quota.add(str(tmp_path / 'artifacts' / 'a' / 'x'), 1, 5)
+    quota.add(str(tmp_path / 'artifacts' / 'a' / 'y'), 2, 5)
+    quota.add(str(tmp_path / 'artifacts' / 'ab'), 3, 5)
+    quota.discard(str(tmp_path / 'artifacts' / 'a'))
+    assert list(quota.index) == [str(tmp_path / 'artifacts' / 'ab')]
+    assert quota.total_bytes == 5
+
+
+def test_reconcile_only_fixes_differences(tmp_path):
+    quota = TempQuota(str(tmp_path))
+    kept = write(str(tmp_path / 'kept'), 10)
+    gone = str(tmp_path / 'gone')
+    quota.add(kept, 100, 10)
+    quota.add(gone, 200, 20)
+    foreign = write(str(tmp_path / 'worker' / 'foreign'), 30)
+    quota.reconcile()
+    assert quota.index[kept] == [100, 10]
+    assert gone not in quota.index
+    assert foreign in quota.index
+    assert quota.total_bytes == 40
+    # still ordered from oldest to newest
+    mtimes = [mtime for mtime, _ in quota.index.values()]
+    assert mtimes == sorted(mtimes)
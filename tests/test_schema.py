@@ -0,0 +1,117 @@
+import io
+
+import pytest
+from fastapi import UploadFile
+from starlette.datastructures import UploadFile as StarletteUploadFile
+
+from core.schema import Param, compile_params, method_openapi, plugin_openapi
+
+
+@pytest.mark.parametrize('param, value, expected', [
+    (Param(int), '42', 42),
+    (Param(int), 7, 7),
+    (Param(float), '1.5', 1.5),
+    (Param(float), 2, 2.0),
+    (Param(str), 'text', 'text'),
+    (Param(bool), False, False),
+    (Param(list), [1, 2], [1, 2]),
+    (Param(dict), {'a': 1}, {'a': 1}),
+])
+def test_compile_converts_values(param, value, expected):
+    error, converted = param.compile()(value)
+    assert error is None
+    assert converted == expected
+    assert type(converted) is type(expected)
+
+
+@pytest.mark.parametrize('param, value, error', [
+    (Param(int), True, 'must be integer'),
+    (Param(int), 1.5, 'must be integer'),
+    (Param(int), 'abc', 'must be integer'),
+    (Param(float), [1], 'must be number'),
+    (Param(str), 1, 'must be string'),
+    (Param(dict), [], 'must be object'),
+    (Param(UploadFile), 'file.bin', 'must be a file'),
+    (Param(int, minimum=1), 0, 'must be >= 1'),
+    (Param(int, maximum=10), 11, 'must be <= 10'),
+    (Param(str, min_length=2), 'a', 'is shorter than 2'),
+    (Param(list, max_length=1), [1, 2], 'is longer than 1'),
+    (Param(str, pattern=r'[a-z]+'), 'abc1', 'is malformed'),
+    (Param(str, choices=('a', 'b')), 'c', 'must be one of a, b'),
+])
+def test_compile_reports_the_failed_check(param, value, error):
+    assert param.compile()(value)[0] == error
+
+
+def test_compile_accepts_uploads():
+    upload = StarletteUploadFile(file=io.BytesIO(b''), filename='a.bin')
+    assert Param(UploadFile).compile()(upload) == (None, upload)
+
+
+def test_unsupported_type_is_rejected():
+    with pytest.raises(TypeError):
+        Param(set)
+
+
+def test_compile_params_fills_defaults_and_converts():
+    validate = compile_params({
+        'port': Param(int, minimum=1, maximum=65535),
+        'host': Param(str),
+        'timeout': Param(float, default=3.0),
+    })
+    values = {'port': '80', 'host': 'localhost'}
+    assert validate(values) is False
+    assert values == {'port': 80, 'host': 'localhost', 'timeout': 3.0}
+    assert validate({'port': 80, 'host': ''}) == 'host is required'
+    assert validate({'port': 0, 'host': 'localhost'}) == 'port must be >= 1'
+
+
+def test_method_openapi():
+    schema = method_openapi('scan', {
+        'file': Param(UploadFile),
+        'offset': Param(int, minimum=0, default=0, description='start offset'),
+        'tag': Param(str, required=False, choices=('a', 'b')),
+    }, 'Scan a file.\n\nMore details.')
+    assert schema['title'] == 'scan'
+    assert schema['required'] == ['file']
+    assert schema['properties']['file'] == {'type': 'string', 'format': 'binary'}
+    args = schema['properties']['args']
+    assert 'required' not in args
+    assert args['properties']['offset'] == {'type': 'integer', 'minimum': 0, 'default': 0,
+                                            'description': 'start offset'}
+    assert args['properties']['tag'] == {'type': 'string', 'enum': ['a', 'b']}
+    assert schema['description'] == 'Scan a file.\n\nMore details.'
+
+
+def test_method_openapi_requires_args_with_required_params():
+    schema = method_openapi('fetch', {'url': Param(str)})
+    assert schema['required'] == ['args']
+    assert schema['properties']['args']['required'] == ['url']
+    assert 'description' not in schema
+
+
+def test_plugin_openapi():
+    methods = {
+        'scan': method_openapi('scan', {'file': Param(UploadFile)}, 'Scan a file.\n\nMore details.'),
+        'check': method_openapi('check', {'url': Param(str)}),
+    }
+    path = plugin_openapi('tool', methods)
+    operation = path['post']
+    assert operation['operationId'] == 'call_tool'
+    assert operation['tags'] == ['tool']
+    parameters = {parameter['name']: parameter for parameter in operation['parameters']}
+    assert parameters['method']['schema']['enum'] == ['check', 'scan']
+    assert parameters['method']['required'] is True
+    assert parameters['async']['schema'] == {'type': 'boolean', 'default': False}
+    body = operation['requestBody']['content']['multipart/form-data']
+    assert [schema['title'] for schema in body['schema']['anyOf']] == ['check', 'scan']
+    assert body['encoding'] == {'args': {'contentType': 'application/json'}}
+    # only the first line of each docstring goes into the summary list
+    assert '* `check`\n* `scan`: Scan a file.' in operation['description']
+    assert 'More details' not in operation['description']
+
+
+def test_plugin_openapi_single_method_has_no_any_of():
+    methods = {'check': method_openapi('check', {'url': Param(str)})}
+    body = plugin_openapi('tool', methods)['post']['requestBody']['content']['multipart/form-data']
+    assert body['schema']['title'] == 'check'
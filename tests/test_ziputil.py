@@ -0,0 +1,172 @@
+import asyncio
+import io
+import struct
+import zipfile
+import zlib
+
+import pytest
+from fastapi import HTTPException
+from starlette.datastructures import UploadFile
+
+from plugins.ziputil import (CENTRAL_FLAG_OFFSET, CENTRAL_HEADER, EOCD, LOCAL_FLAG_OFFSET, LOCAL_HEADER,
+                             SIG_CENTRAL_HEADER, SIG_EOCD, SIG_LOCAL_HEADER, SIG_ZIP64_EOCD, SIG_ZIP64_LOCATOR,
+                             ZIP64_EOCD, ZIP64_LOCATOR, Ziputil, ZipFormatError, analyze_zip, convert2pseudo)
+
+
+def make_zip(files, comment=b'', password_protected=()):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as z:
+        for name, data in files.items():
+            z.writestr(name, data)
+        z.comment = comment
+    data = bytearray(buf.getvalue())
+    # zipfile cannot encrypt, set the bit in both headers as an encrypting tool would
+    cd_offset = EOCD.unpack_from(data, len(data) - EOCD.size - len(comment))[6]
+    pos = cd_offset
+    while data[pos:pos + 4] == SIG_CENTRAL_HEADER:
+        fields = CENTRAL_HEADER.unpack_from(data, pos)
+        name = bytes(data[pos + CENTRAL_HEADER.size:pos + CENTRAL_HEADER.size + fields[10]]).decode()
+        if name in password_protected:
+            data[pos + CENTRAL_FLAG_OFFSET] |= 1
+            data[fields[16] + LOCAL_FLAG_OFFSET] |= 1
+        pos += CENTRAL_HEADER.size + fields[10] + fields[11] + fields[12]
+    return bytes(data)
+
+
+def make_zip64(files):
+    """
+    ZIP64 archive whose EOCD and central directory offsets only live in the ZIP64 records
+    """
+    out = bytearray()
+    central = bytearray()
+    for name, data in files.items():
+        name = name.encode()
+        crc = zlib.crc32(data)
+        local_offset = len(out)
+        out += LOCAL_HEADER.pack(SIG_LOCAL_HEADER, 45, 0, 0, 0, 0x21, crc, len(data), len(data), len(name), 0)
+        out += name + data
+        extra = struct.pack('<HHQ', 0x0001, 8, local_offset)
+        central += CENTRAL_HEADER.pack(SIG_CENTRAL_HEADER, 45, 45, 0, 0, 0, 0x21, crc, len(data), len(data),
+                                       len(name), len(extra), 0, 0, 0, 0, 0xFFFFFFFF)
+        central += name + extra
+    cd_offset = len(out)
+    out += central
+    zip64_eocd_offset = len(out)
+    out += ZIP64_EOCD.pack(SIG_ZIP64_EOCD, ZIP64_EOCD.size - 12, 45, 45, 0, 0, len(files), len(files),
+                           len(central), cd_offset)
+    out += ZIP64_LOCATOR.pack(SIG_ZIP64_LOCATOR, 0, zip64_eocd_offset, 1)
+    out += EOCD.pack(SIG_EOCD, 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0)
+    return bytes(out)
+
+
+def write(tmp_path, data, name='test.zip'):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def make_plugin(tmp_path):
+    plugin = Ziputil()
+    plugin._temp_dir = str(tmp_path / 'temp')
+    return plugin
+
+
+def upload(data):
+    return UploadFile(file=io.BytesIO(data), filename='test.zip')
+
+
+FILES = {'a.txt': b'hello' * 10, 'dir/b.txt': b'world'}
+
+
+def test_plain_zip_is_not_encrypted(tmp_path):
+    result, characteristics, entries = analyze_zip(write(tmp_path, make_zip(FILES)))
+    assert result == -1
+    assert [entry['name'] for entry in entries] == ['a.txt', 'dir/b.txt']
+    assert all(entry['assert'] == -1 for entry in entries)
+    assert len(characteristics) == 2
+
+
+def test_pseudo_encryption_when_only_central_header_is_flagged(tmp_path):
+    data = bytearray(make_zip(FILES, password_protected=('a.txt',)))
+    # clear the local header bit again
+    data[LOCAL_FLAG_OFFSET] &= ~1
+    result, _, entries = analyze_zip(write(tmp_path, bytes(data)))
+    assert result == 1
+    assert [entry['assert'] for entry in entries] == [1, -1]
+
+
+def test_true_encryption_wins_over_plain_entries(tmp_path):
+    result, _, entries = analyze_zip(write(tmp_path, make_zip(FILES, password_protected=('dir/b.txt',))))
+    assert result == 0
+    assert [entry['assert'] for entry in entries] == [-1, 0]
+
+
+@pytest.mark.parametrize('comment', [b'a comment', b'PK\x05\x06 looks like an EOCD', b'x' * 0xFFFF])
+def test_archive_comment(tmp_path, comment):
+    result, _, entries = analyze_zip(write(tmp_path, make_zip(FILES, comment=comment)))
+    assert result == -1
+    assert len(entries) == 2
+
+
+def test_zip64(tmp_path):
+    path = write(tmp_path, make_zip64(FILES))
+    # the fixture is a valid archive for the standard library as well
+    with zipfile.ZipFile(path) as z:
+        assert z.read('dir/b.txt') == b'world'
+    result, _, entries = analyze_zip(path)
+    assert result == -1
+    assert [entry['local_offset'] for entry in entries] == [0, LOCAL_HEADER.size + 5 + 50]
+    assert convert2pseudo(path) == 2
+    assert all(entry['local_flags'] & 1 and entry['central_flags'] & 1 for entry in analyze_zip(path)[2])
+
+
+@pytest.mark.parametrize('data', [
+    b'PK\x03\x04',
+    b'PK\x03\x04' + b'\0' * 100,
+    make_zip(FILES)[:-30],
+    make_zip(FILES)[:-10],
+    make_zip64(FILES)[:-EOCD.size - ZIP64_LOCATOR.size - 4],
+])
+def test_malformed_zip_raises(tmp_path, data):
+    with pytest.raises((ZipFormatError, struct.error)):
+        analyze_zip(write(tmp_path, data))
+    with pytest.raises((ZipFormatError, struct.error)):
+        convert2pseudo(write(tmp_path, data))
+
+
+@pytest.mark.parametrize('method', ['pseudo_check', 'convert_to_pseudo'])
+@pytest.mark.parametrize('data', [b'not a zip at all', b'PK\x03\x04garbage', make_zip(FILES)[:-10]])
+def test_malformed_upload_is_rejected(tmp_path, method, data):
+    plugin = make_plugin(tmp_path)
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(getattr(plugin, method)({'file': upload(data)}))
+    assert e.value.status_code == 400
+    # the spooled copy is removed
+    assert list((tmp_path / 'temp').iterdir()) == []
+
+
+def test_pseudo_encrypt_and_restore(tmp_path):
+    original = make_zip(FILES, comment=b'comment')
+    path = write(tmp_path, original)
+    assert convert2pseudo(path) == 2
+    result, _, entries = analyze_zip(path)
+    # both headers carry the bit, by the flags alone it reads like real encryption
+    assert result == 0
+    assert all(entry['local_flags'] & 1 and entry['central_flags'] & 1 for entry in entries)
+    # only the flag bits changed, clearing them at the reported offsets restores the original
+    with open(path, 'rb') as f:
+        data = bytearray(f.read())
+    for entry in entries:
+        data[entry['local_offset'] + LOCAL_FLAG_OFFSET] &= ~1
+        data[entry['central_offset'] + CENTRAL_FLAG_OFFSET] &= ~1
+    assert bytes(data) == original
+    with zipfile.ZipFile(io.BytesIO(bytes(data))) as z:
+        assert z.read('a.txt') == FILES['a.txt']
+
+
+def test_convert_to_pseudo_streams_the_patched_file(tmp_path):
+    plugin = make_plugin(tmp_path)
+    response = asyncio.run(plugin.convert_to_pseudo({'file': upload(make_zip(FILES))}))
+    assert analyze_zip(response.path)[0] == 0
+    asyncio.run(response.background())
+    assert list((tmp_path / 'temp').iterdir()) == []